@@ -5,7 +5,9 @@ from flask_cors import CORS
 from pymongo import MongoClient
 from pymongo.server_api import ServerApi
 from bson import ObjectId
+import gridfs
 import os
+import base64
 import logging
 import pandas as pd
 import io
@@ -168,6 +170,9 @@ WHATSAPP_API_VERSION = os.getenv("WHATSAPP_API_VERSION", "v18.0")
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
 if OPENAI_API_KEY:
     openai.api_key = OPENAI_API_KEY
+# Created on first use and reused, so categorization calls share one
+# keep-alive connection pool instead of a new TLS handshake each time
+openai_client = None
 
 mongo_client = None
 db = None
@@ -175,6 +180,9 @@ collection = None
 users_collection = None
 otp_collection = None
 
+# Transaction reads never need the receipt image bytes (BSON Binary isn't JSON serializable)
+NO_IMAGE_PROJECTION = {'receipt_image': 0}
+
 def connect_to_mongodb():
     """Connect to MongoDB with retry logic and better error handling."""
     global mongo_client, db, collection, users_collection, otp_collection
@@ -536,7 +544,7 @@ def get_ccc_metrics(user_id: str) -> dict:
                 {"chat_id": int(user_id) if user_id.isdigit() else 0},  # Try to convert to int for legacy chat_id
                 {"wa_id": user_id}  # WhatsApp IDs are strings
             ]
-        }))
+        }, NO_IMAGE_PROJECTION))
         
         if not transactions:
             return {'ccc': 0, 'dso': 0, 'dio': 0, 'dpo': 0, 'error': 'No transactions found'}
@@ -555,7 +563,7 @@ def get_ccc_metrics(user_id: str) -> dict:
         
         # Calculate actual outstanding receivables
         # Match payments received to credit customers
-        credit_customers = [sale.get('customer') for sale in credit_sales if sale.get('customer')]
+        credit_customers = {sale.get('customer') for sale in credit_sales if sale.get('customer')}
         payments_for_credit_sales = [p for p in payments_received if 
                                    p.get('customer') in credit_customers]
         total_payments_for_credit = sum(payment['amount'] for payment in payments_for_credit_sales)
@@ -629,7 +637,7 @@ def get_ccc_metrics(user_id: str) -> dict:
                 {"chat_id": int(user_id) if user_id.isdigit() else 0},
                 {"wa_id": user_id}  # WhatsApp IDs are strings
             ]
-        }).sort('timestamp', -1))
+        }, NO_IMAGE_PROJECTION).sort('timestamp', -1))
         
         # Format all transactions for frontend
         formatted_recent = []
@@ -696,6 +704,7 @@ def get_ccc_metrics(user_id: str) -> dict:
 
 def categorize_purchase_with_ai(description, vendor=None, amount=None):
     """Use OpenAI to categorize a purchase transaction."""
+    global openai_client
     if not OPENAI_API_KEY:
         logger.warning("OpenAI API key not configured, returning default category")
         return "OTHER"
@@ -720,8 +729,9 @@ def categorize_purchase_with_ai(description, vendor=None, amount=None):
         Based on this information, return ONLY the category code (OPEX, CAPEX, COGS, INVENTORY, MARKETING, UTILITIES, or OTHER).
         """
         
-        client = openai.OpenAI(api_key=OPENAI_API_KEY)
-        response = client.chat.completions.create(
+        if openai_client is None:
+            openai_client = openai.OpenAI(api_key=OPENAI_API_KEY)
+        response = openai_client.chat.completions.create(
             model="gpt-5-mini",
             messages=[
                 {"role": "system", "content": "You are a financial AI assistant that categorizes business expenses. Return only the category code."},
@@ -1013,7 +1023,7 @@ def get_dashboard_stats():
                 }), 200
         
         # Get all transactions across all users from correct collection
-        all_transactions = list(collection.find().sort('timestamp', -1).limit(50))
+        all_transactions = list(collection.find({}, NO_IMAGE_PROJECTION).sort('timestamp', -1).limit(50))
         
         # Get recent transactions formatted
         recent_transactions = []
@@ -1152,12 +1162,12 @@ def get_personal_budget(wa_id):
         logger.info(f"Querying transactions with: {query}")
         
         # Also check what transactions exist for this user
-        all_user_transactions = list(db.entries.find({'wa_id': wa_id}))
+        all_user_transactions = list(db.entries.find({'wa_id': wa_id}, NO_IMAGE_PROJECTION))
         logger.info(f"Found {len(all_user_transactions)} total transactions for wa_id {wa_id}")
         if all_user_transactions:
             logger.info(f"Sample transaction: {all_user_transactions[0]}")
         
-        transactions = list(db.entries.find(query))
+        transactions = list(db.entries.find(query, NO_IMAGE_PROJECTION))
         logger.info(f"Found {len(transactions)} transactions for current month {current_month}")
         
         # Calculate spending and income
@@ -1203,7 +1213,7 @@ def get_personal_budget(wa_id):
                 'wa_id': wa_id,
                 'date_created': {'$regex': f'^{month_str}'},
                 'action': {'$in': ['purchase', 'expense']}
-            }))
+            }, NO_IMAGE_PROJECTION))
             
             month_total = sum(abs(t.get('amount', 0)) for t in month_transactions)
             monthly_spending.append({
@@ -1322,7 +1332,7 @@ def download_excel(wa_id):
             }
         
         # Get transactions
-        transactions = list(collection.find(query).sort('timestamp', -1))
+        transactions = list(collection.find(query, NO_IMAGE_PROJECTION).sort('timestamp', -1))
         
         if not transactions:
             return jsonify({'error': 'No transactions found'}), 404
@@ -1489,7 +1499,7 @@ def download_filtered_excel(wa_id, transaction_type):
             query["$and"].append({"timestamp": date_query})
         
         # Get transactions
-        transactions = list(collection.find(query).sort('timestamp', -1))
+        transactions = list(collection.find(query, NO_IMAGE_PROJECTION).sort('timestamp', -1))
         
         if not transactions:
             return jsonify({'error': f'No {transaction_type} transactions found'}), 404
@@ -1597,6 +1607,13 @@ def get_user_identifier(user_id):
     else:
         return 'chat_id'
 
+def bump_report_version(wa_id):
+    """Tell the WhatsApp bot workers their cached status/summary replies for wa_id are stale."""
+    try:
+        users_collection.update_one({'wa_id': wa_id}, {'$set': {'report_version': ObjectId()}}, upsert=True)
+    except Exception as e:
+        logger.warning(f"Could not bump report version for {wa_id}: {e}")
+
 @app.route('/api/transactions', methods=['GET'])
 def get_all_transactions():
     """Get all transactions (public endpoint for demo)."""
@@ -1606,7 +1623,7 @@ def get_all_transactions():
                 return jsonify({'error': 'Database connection failed'}), 500
         
         # Get all transactions
-        transactions = list(collection.find({}).sort('timestamp', -1).limit(100))
+        transactions = list(collection.find({}, NO_IMAGE_PROJECTION).sort('timestamp', -1).limit(100))
         
         # Convert ObjectId to string for JSON serialization
         for transaction in transactions:
@@ -1652,7 +1669,7 @@ def get_user_transactions(user_id):
         query = {user_identifier: user_id}
         
         # Get paginated transactions first (faster)
-        transactions = list(collection.find(query)
+        transactions = list(collection.find(query, NO_IMAGE_PROJECTION)
                           .sort('timestamp', -1)
                           .skip(skip)
                           .limit(limit))
@@ -1666,8 +1683,11 @@ def get_user_transactions(user_id):
             # For subsequent pages, do the actual count
             total_count = collection.count_documents(query)
         
-        # Convert ObjectId to string for JSON serialization
+        # Convert ObjectId to string for JSON serialization. The image bytes
+        # are left out; has_image tells the frontend to fetch them from
+        # /api/transactions/<id>/receipt
         for transaction in transactions:
+            transaction['has_image'] = transaction.get('has_image', False)
             transaction['_id'] = str(transaction['_id'])
         
         # Calculate pagination metadata
@@ -1689,6 +1709,46 @@ def get_user_transactions(user_id):
         logger.error(f"Error fetching transactions: {e}")
         return jsonify({'error': 'Internal server error'}), 500
 
+@app.route('/api/transactions/<transaction_id>/receipt', methods=['GET'])
+@token_required
+def get_transaction_receipt(transaction_id):
+    """Get the receipt image of a transaction as base64."""
+    try:
+        if mongo_client is None or collection is None:
+            if not connect_to_mongodb():
+                return jsonify({'error': 'Database connection failed'}), 500
+        
+        transaction = collection.find_one(
+            {'_id': ObjectId(transaction_id)},
+            {'wa_id': 1, 'chat_id': 1, 'receipt_image': 1, 'receipt_image_id': 1}
+        )
+        
+        if not transaction:
+            return jsonify({'error': 'Transaction not found'}), 404
+        
+        # Verify user has access to this transaction
+        user_identifier = get_user_identifier(request.current_user['wa_id'])
+        if transaction.get(user_identifier) != request.current_user['wa_id']:
+            return jsonify({'error': 'Access denied'}), 403
+        
+        # Small receipts are inline BSON Binary, large ones live in GridFS;
+        # very old rows may still hold a base64 string
+        image = transaction.get('receipt_image')
+        if transaction.get('receipt_image_id') is not None:
+            image = gridfs.GridFSBucket(db).open_download_stream(transaction['receipt_image_id']).read()
+        if not image:
+            return jsonify({'error': 'Receipt image not found'}), 404
+        if isinstance(image, str):
+            image_b64 = image
+        else:
+            image_b64 = base64.b64encode(bytes(image)).decode('ascii')
+        
+        return jsonify({'receipt_image': image_b64, 'content_type': 'image/jpeg'}), 200
+        
+    except Exception as e:
+        logger.error(f"Error fetching receipt image: {e}")
+        return jsonify({'error': 'Internal server error'}), 500
+
 @app.route('/api/transactions/<transaction_id>', methods=['PUT'])
 @token_required
 def update_transaction(transaction_id):
@@ -1701,7 +1761,7 @@ def update_transaction(transaction_id):
         data = request.get_json()
         
         # Find the transaction first to verify ownership
-        transaction = collection.find_one({'_id': ObjectId(transaction_id)})
+        transaction = collection.find_one({'_id': ObjectId(transaction_id)}, NO_IMAGE_PROJECTION)
         
         if not transaction:
             return jsonify({'error': 'Transaction not found'}), 404
@@ -1741,8 +1801,10 @@ def update_transaction(transaction_id):
         )
         
         if result.modified_count > 0:
+            bump_report_version(request.current_user['wa_id'])
+            
             # Get the updated transaction
-            updated_transaction = collection.find_one({'_id': ObjectId(transaction_id)})
+            updated_transaction = collection.find_one({'_id': ObjectId(transaction_id)}, NO_IMAGE_PROJECTION)
             updated_transaction['_id'] = str(updated_transaction['_id'])
             
             return jsonify({
@@ -1766,7 +1828,7 @@ def delete_transaction(transaction_id):
                 return jsonify({'error': 'Database connection failed'}), 500
         
         # Find the transaction first to verify ownership
-        transaction = collection.find_one({'_id': ObjectId(transaction_id)})
+        transaction = collection.find_one({'_id': ObjectId(transaction_id)}, NO_IMAGE_PROJECTION)
         
         if not transaction:
             return jsonify({'error': 'Transaction not found'}), 404
@@ -1780,6 +1842,7 @@ def delete_transaction(transaction_id):
         result = collection.delete_one({'_id': ObjectId(transaction_id)})
         
         if result.deleted_count > 0:
+            bump_report_version(request.current_user['wa_id'])
             return jsonify({'message': 'Transaction deleted successfully'}), 200
         else:
             return jsonify({'error': 'Failed to delete transaction'}), 500
@@ -1818,6 +1881,7 @@ def add_transaction():
         result = collection.insert_one(transaction)
         
         if result.inserted_id:
+            bump_report_version(request.current_user['wa_id'])
             transaction['_id'] = str(result.inserted_id)
             return jsonify({
                 'message': 'Transaction added successfully',
@@ -36,6 +36,12 @@ export const getContractorClaims = async (waId, page = 1, limit = 10) => {
   return response.data;
 };
 
+// Get the receipt image of a transaction (base64)
+export const getReceiptImage = async (transactionId) => {
+  const response = await apiClient.get(`/api/transactions/${transactionId}/receipt`);
+  return response.data;
+};
+
 // Mark claim as paid
 export const markClaimAsPaid = async (claimId) => {
   const response = await apiClient.patch(`/api/contractor-claims/${claimId}/paid`);
@@ -1,6 +1,6 @@
 import { useQuery, useMutation, useQueryClient } from '@tanstack/react-query';
 import { useParams, useNavigate } from 'react-router-dom';
-import { getContractorClaims, markClaimAsPaid } from '../api/workOrders';
+import { getContractorClaims, getReceiptImage, markClaimAsPaid } from '../api/workOrders';
 import { formatCurrency, formatDateTime, getStatusColor, getStatusIcon, getStatusLabel } from '../utils/formatters';
 import { ArrowLeftIcon, ArrowDownTrayIcon, CheckCircleIcon, ClockIcon, ExclamationCircleIcon, MapPinIcon, ChartBarIcon, BanknotesIcon } from '@heroicons/react/24/outline';
 import brandConfig from '../config/brand';
@@ -25,6 +25,13 @@ export default function WorkOrderDetail() {
 
   const claim = claims?.find(c => c._id === orderId);
 
+  // Listings leave out the image bytes; fetch the receipt on its own
+  const { data: receipt } = useQuery({
+    queryKey: ['receiptImage', orderId],
+    queryFn: () => getReceiptImage(orderId),
+    enabled: !!claim?.has_image,
+  });
+
   if (isLoading) {
     return (
       <div className="min-h-screen bg-[var(--brand-bg-from)] flex items-center justify-center">
@@ -215,11 +222,11 @@ export default function WorkOrderDetail() {
           {/* Right Column - Actions & E-Invoice */}
           <div className="space-y-6">
             {/* Receipt Image */}
-            {claim.receipt_image && (
+            {receipt?.receipt_image && (
               <div className="bg-[var(--brand-card-bg)] rounded-lg shadow-sm border border-[var(--brand-card-bg-hover)] p-4">
                 <h3 className="text-sm font-semibold text-[var(--brand-text-primary)] mb-3">📸 Receipt Image</h3>
                 <img
-                  src={`data:image/jpeg;base64,${claim.receipt_image}`}
+                  src={`data:${receipt.content_type};base64,${receipt.receipt_image}`}
                   alt="Receipt"
                   className="w-full rounded-lg border border-white/10"
                 />
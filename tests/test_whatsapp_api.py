@@ -1,9 +1,10 @@
 """Unit tests for whatsapp_business_api.py functionality."""
 
 import pytest
-from unittest.mock import Mock, patch, MagicMock
+from unittest.mock import Mock, patch, MagicMock, call
 import sys
 import os
+import io
 import json
 
 # Add the project root to the Python path
@@ -13,6 +14,16 @@ sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
 import whatsapp_business_api
 
 
+@pytest.fixture(autouse=True)
+def clear_report_cache():
+    """Keep cached replies and AI results from leaking between tests."""
+    whatsapp_business_api._status_cache.clear()
+    whatsapp_business_api._summary_cache.clear()
+    whatsapp_business_api._ai_parse_cache.clear()
+    whatsapp_business_api._general_response_cache.clear()
+    whatsapp_business_api._seen_message_ids.clear()
+
+
 class TestWhatsAppAPI:
     """Test cases for WhatsApp Business API functionality."""
 
@@ -54,6 +65,123 @@ class TestWhatsAppAPI:
                     # Assert
                     assert result == ('Verification failed', 403)
 
+    @patch('whatsapp_business_api.app_state_collection')
+    def test_admin_clear_caches(self, mock_app_state):
+        """Test that the admin endpoint only clears caches with the right token, and bumps the generation."""
+        # Arrange
+        mock_app_state.find_one_and_update.return_value = {'_id': 'cache_generation', 'value': 3}
+        whatsapp_business_api.detect_language("saya beli ayam")
+        assert whatsapp_business_api._detect_language_cached.cache_info().currsize > 0
+        client = whatsapp_business_api.app.test_client()
+
+        with patch.dict(os.environ, {'ADMIN_TOKEN': 'secret'}):
+            # Act / Assert
+            response = client.post('/admin/cache/clear', headers={'X-Admin-Token': 'wrong'})
+            assert response.status_code == 403
+            assert whatsapp_business_api._detect_language_cached.cache_info().currsize > 0
+            mock_app_state.find_one_and_update.assert_not_called()
+
+            response = client.post('/admin/cache/clear', headers={'X-Admin-Token': 'secret'})
+            assert response.status_code == 200
+            assert response.get_json() == {'status': 'ok', 'generation': 3, 'pid': os.getpid()}
+            assert whatsapp_business_api._detect_language_cached.cache_info().currsize == 0
+            (query, update), kwargs = mock_app_state.find_one_and_update.call_args
+            assert query == {'_id': 'cache_generation'}
+            assert update == {'$inc': {'value': 1}}
+            assert kwargs['upsert'] is True
+            assert whatsapp_business_api._cache_generation == 3
+
+    @patch('whatsapp_business_api._cache_generation_checked', 0.0)
+    @patch('whatsapp_business_api._cache_generation', 3)
+    @patch('whatsapp_business_api.app_state_collection')
+    def test_cache_clear_reaches_other_workers(self, mock_app_state):
+        """Test a worker clears its caches once another worker has bumped the generation."""
+        # Arrange
+        whatsapp_business_api.detect_language("saya beli ayam")
+        mock_app_state.find_one.return_value = {'_id': 'cache_generation', 'value': 4}
+
+        # Act
+        whatsapp_business_api.sync_cache_generation()
+
+        # Assert
+        assert whatsapp_business_api._detect_language_cached.cache_info().currsize == 0
+        assert whatsapp_business_api._cache_generation == 4
+
+    @patch('whatsapp_business_api.processed_message_collection', None)
+    def test_webhook_acknowledges_before_processing(self):
+        """Test the webhook hands messages to the worker pool grouped by sender, once."""
+        # Arrange
+        payload = {'entry': [{'changes': [{
+            'field': 'messages',
+            'value': {'messages': [
+                {'id': 'm1', 'from': 'user_a', 'type': 'text', 'text': {'body': 'hi'}},
+                {'id': 'm2', 'from': 'user_b', 'type': 'text', 'text': {'body': 'hello'}},
+                {'id': 'm3', 'from': 'user_a', 'type': 'text', 'text': {'body': 'status'}},
+            ]},
+        }]}]}
+        client = whatsapp_business_api.app.test_client()
+
+        with patch.object(whatsapp_business_api, '_graph_executor') as mock_graph, \
+             patch.object(whatsapp_business_api, '_message_executor') as mock_executor, \
+             patch.object(whatsapp_business_api, 'handle_message') as mock_handle:
+            # Act
+            response = client.post('/whatsapp/webhook', json=payload)
+
+            # Assert
+            assert response.status_code == 200
+            assert response.get_json() == {'status': 'ok'}
+            mock_handle.assert_not_called()
+            submitted = {c.args[1]: [m['id'] for m in c.args[2]]
+                         for c in mock_executor.submit.call_args_list}
+            assert submitted == {'user_a': ['m1', 'm3'], 'user_b': ['m2']}
+            marked = sorted(c.args[1] for c in mock_graph.submit.call_args_list)
+            assert marked == ['m2', 'm3']
+
+            # A redelivery of the same payload is not processed again
+            mock_executor.submit.reset_mock()
+            client.post('/whatsapp/webhook', json=payload)
+            mock_executor.submit.assert_not_called()
+
+    @patch('whatsapp_business_api.processed_message_collection')
+    def test_message_ids_are_claimed_in_mongodb(self, mock_processed):
+        """Test a message ID already claimed by any worker counts as a redelivery."""
+        # Arrange
+        claimed = set()
+
+        def insert_one(doc):
+            if doc['_id'] in claimed:
+                raise whatsapp_business_api.DuplicateKeyError('duplicate key')
+            claimed.add(doc['_id'])
+        mock_processed.insert_one.side_effect = insert_one
+
+        # Act / Assert
+        assert whatsapp_business_api._is_new_message('m1') is True
+        assert whatsapp_business_api._is_new_message('m1') is False
+        assert whatsapp_business_api._is_new_message('m2') is True
+        assert len(whatsapp_business_api._seen_message_ids) == 0
+
+    def test_webhook_status_callback_is_acknowledged(self):
+        """Test a status-only callback is acknowledged without queueing work."""
+        # Arrange
+        payload = {'entry': [{'changes': [{
+            'field': 'messages',
+            'value': {'statuses': [{'id': 'm1', 'status': 'delivered'}]},
+        }]}]}
+        client = whatsapp_business_api.app.test_client()
+
+        with patch.object(whatsapp_business_api, '_graph_executor') as mock_graph, \
+             patch.object(whatsapp_business_api, '_message_executor') as mock_executor, \
+             patch.object(whatsapp_business_api, '_is_new_message') as mock_is_new:
+            # Act
+            response = client.post('/whatsapp/webhook', json=payload)
+
+            # Assert
+            assert response.status_code == 200
+            assert response.get_json() == {'status': 'ok'}
+            mock_is_new.assert_not_called()
+            mock_graph.submit.assert_not_called()
+            mock_executor.submit.assert_not_called()
+
     @patch('whatsapp_business_api.connect_to_mongodb')
     @patch('whatsapp_business_api.collection')
     def test_handle_text_message_success(self, mock_collection, mock_connect):
@@ -114,9 +242,71 @@ class TestWhatsAppAPI:
         assert result['category'] == 'Food'
         assert result['type'] == 'expense'
 
+    @patch('whatsapp_business_api.openai_client')
+    def test_parse_transaction_with_ai_reuses_cached_result(self, mock_openai):
+        """Test that a repeated message skips the OpenAI call and returns a fresh copy."""
+        # Arrange
+        mock_response = Mock()
+        mock_response.choices = [Mock()]
+        mock_response.choices[0].message.content = json.dumps({"action": "purchase", "amount": 12.0})
+        mock_openai.chat.completions.create.return_value = mock_response
+
+        # Act
+        first = whatsapp_business_api.parse_transaction_with_ai("beli  beras rm12")
+        first['amount'] = 0
+        second = whatsapp_business_api.parse_transaction_with_ai("beli beras rm12")
+
+        # Assert
+        assert second['amount'] == 12.0
+        mock_openai.chat.completions.create.assert_called_once()
+
+    @patch('whatsapp_business_api.AI_PARSE_BATCH_WINDOW', 0.01)
+    @patch('whatsapp_business_api.openai_client')
+    def test_parse_transaction_with_ai_batched(self, mock_openai):
+        """Test that a batched parse maps the result back to its message by id."""
+        # Arrange
+        mock_response = Mock()
+        mock_response.choices = [Mock()]
+        mock_response.choices[0].message.content = json.dumps(
+            {"results": [{"id": "0", "action": "sale", "amount": 30.0}]})
+        mock_openai.chat.completions.create.return_value = mock_response
+
+        # Act
+        result = whatsapp_business_api.parse_transaction_with_ai("sold 3 cakes for rm30")
+
+        # Assert
+        assert result['action'] == 'sale'
+        assert 'id' not in result
+        mock_openai.chat.completions.create.assert_called_once()
+        messages = mock_openai.chat.completions.create.call_args.kwargs['messages']
+        assert json.loads(messages[1]['content']) == [{"id": "0", "text": "sold 3 cakes for rm30"}]
+
+    @patch('whatsapp_business_api.AI_PARSE_BATCH_WINDOW', 0.01)
+    @patch('whatsapp_business_api.openai_client')
+    def test_parse_transaction_batched_rejects_mismatched_ids(self, mock_openai):
+        """Test a batched reply with ids that weren't sent falls back to a single parse."""
+        # Arrange
+        batched, single = Mock(), Mock()
+        batched.choices = [Mock()]
+        batched.choices[0].message.content = json.dumps({"results": [
+            {"id": "0", "action": "sale", "amount": 99.0},
+            {"id": "1", "action": "purchase", "amount": 5.0},
+        ]})
+        single.choices = [Mock()]
+        single.choices[0].message.content = json.dumps({"action": "sale", "amount": 30.0})
+        mock_openai.chat.completions.create.side_effect = [batched, single]
+
+        # Act
+        result = whatsapp_business_api.parse_transaction_with_ai("sold 3 cakes for rm30")
+
+        # Assert
+        assert result['amount'] == 30.0
+        assert mock_openai.chat.completions.create.call_count == 2
+
+    @patch('whatsapp_business_api.get_user_report_context', return_value=('business', 'en', None))
     @patch('whatsapp_business_api.connect_to_mongodb')
     @patch('whatsapp_business_api.collection')
-    def test_handle_summary_command_success(self, mock_collection, mock_connect):
+    def test_handle_summary_command_success(self, mock_collection, mock_connect, mock_context):
         """Test summary command with transactions."""
         # Arrange
         mock_connect.return_value = True
@@ -126,10 +316,12 @@ class TestWhatsAppAPI:
                 'category': 'Food',
                 'description': 'Lunch',
                 'type': 'expense',
-                'timestamp': '2025-09-17T12:00:00Z'
+                'timestamp': whatsapp_business_api.datetime(2025, 9, 17, 12, 0)
             }
         ]
-        mock_collection.find.return_value = sample_transactions
+        mock_collection.aggregate.return_value = iter([
+            {'recent': sample_transactions, 'total': [{'n': 1}]}
+        ])
 
         # Act
         result = whatsapp_business_api.handle_summary_command("test_user")
@@ -138,13 +330,14 @@ class TestWhatsAppAPI:
         assert "Summary" in result
         assert "25.0" in result or "$25" in result
 
+    @patch('whatsapp_business_api.get_user_report_context', return_value=('personal', 'en', None))
     @patch('whatsapp_business_api.connect_to_mongodb')
     @patch('whatsapp_business_api.collection')
-    def test_handle_summary_command_no_transactions(self, mock_collection, mock_connect):
+    def test_handle_summary_command_no_transactions(self, mock_collection, mock_connect, mock_context):
         """Test summary command with no transactions."""
         # Arrange
         mock_connect.return_value = True
-        mock_collection.find.return_value = []
+        mock_collection.aggregate.return_value = iter([{'recent': [], 'total': []}])
 
         # Act
         result = whatsapp_business_api.handle_summary_command("test_user")
@@ -159,8 +352,7 @@ class TestWhatsAppAPI:
         """Test database test command success."""
         # Arrange
         mock_connect.return_value = True
-        mock_collection.find_one.return_value = None
-        mock_collection.count_documents.return_value = 5
+        mock_collection.aggregate.return_value = iter([{'n': 5}])
 
         # Act
         result = whatsapp_business_api.handle_test_db_command("test_user")
@@ -183,27 +375,32 @@ class TestWhatsAppAPI:
 
     def test_download_whatsapp_media_success(self, sample_image_data):
         """Test successful media download."""
-        with patch('whatsapp_business_api.requests') as mock_requests:
+        with patch('whatsapp_business_api._GRAPH_SESSION') as mock_session:
             # Arrange
             mock_response = Mock()
             mock_response.content = sample_image_data
             mock_response.status_code = 200
-            mock_requests.get.return_value = mock_response
+            mock_response.json.return_value = {'url': 'https://lookaside.example/test_media'}
+            mock_session.get.return_value = mock_response
 
             # Act
             result = whatsapp_business_api.download_whatsapp_media("test_media_id")
 
             # Assert
             assert result == sample_image_data
-            mock_requests.get.assert_called_once()
+            # Media metadata lookup, then the download itself
+            assert mock_session.get.call_args_list == [
+                call(f"{whatsapp_business_api.GRAPH_API_BASE_URL}/test_media_id"),
+                call('https://lookaside.example/test_media'),
+            ]
 
     def test_download_whatsapp_media_failure(self):
         """Test failed media download."""
-        with patch('whatsapp_business_api.requests') as mock_requests:
+        with patch('whatsapp_business_api._GRAPH_SESSION') as mock_session:
             # Arrange
             mock_response = Mock()
             mock_response.status_code = 404
-            mock_requests.get.return_value = mock_response
+            mock_session.get.return_value = mock_response
 
             # Act
             result = whatsapp_business_api.download_whatsapp_media("invalid_media_id")
@@ -233,6 +430,65 @@ class TestWhatsAppAPI:
         assert result is True
         mock_collection.insert_one.assert_called_once()
 
+    @patch('whatsapp_business_api.mongo_client', Mock())
+    @patch('whatsapp_business_api.fast_collection')
+    @patch('whatsapp_business_api.collection')
+    def test_save_uses_fast_collection_when_enabled(self, mock_collection, mock_fast):
+        """Test that live transaction inserts go through the FAST_WRITES view."""
+        # Arrange
+        mock_fast.insert_one.return_value = Mock(inserted_id='test_id')
+
+        # Act
+        result = whatsapp_business_api.save_to_mongodb_parallel(
+            {'action': 'sale', 'amount': 10.0, 'customer': 'Ali'}, "test_user")
+
+        # Assert
+        assert result is True
+        mock_fast.insert_one.assert_called_once()
+        mock_collection.insert_one.assert_not_called()
+
+    @patch('whatsapp_business_api.mongo_client', Mock())
+    @patch('whatsapp_business_api.fast_collection', None)
+    @patch('whatsapp_business_api.users_collection')
+    @patch('whatsapp_business_api.collection')
+    def test_status_after_save_is_fresh(self, mock_collection, mock_users):
+        """Test a saved transaction shows up in the next status reply, whichever worker saved it."""
+        # Arrange
+        user = {'mode': 'personal', 'language': 'en'}
+        mock_users.find_one.side_effect = lambda query, projection: dict(user)
+        mock_users.update_one.side_effect = lambda query, update, upsert: user.update(update['$set'])
+        mock_collection.insert_one.return_value = Mock(inserted_id='test_id')
+        mock_collection.find.return_value = [{'action': 'purchase', 'amount': 10.0, 'category': 'food'}]
+
+        # Act / Assert
+        assert "RM10.00" in whatsapp_business_api.handle_status_command("test_user")
+        whatsapp_business_api.handle_status_command("test_user")
+        assert mock_collection.find.call_count == 1
+
+        # Saved by this worker
+        mock_collection.find.return_value = [{'action': 'purchase', 'amount': 10.0, 'category': 'food'},
+                                             {'action': 'purchase', 'amount': 20.0, 'category': 'food'}]
+        whatsapp_business_api.save_to_mongodb({'action': 'purchase', 'amount': 20.0}, "test_user")
+        assert "RM30.00" in whatsapp_business_api.handle_status_command("test_user")
+
+        # Deleted through the dashboard API or the other worker, which only bumps the version
+        mock_collection.find.return_value = [{'action': 'purchase', 'amount': 20.0, 'category': 'food'}]
+        user['report_version'] = 'changed-elsewhere'
+        assert "RM20.00" in whatsapp_business_api.handle_status_command("test_user")
+
+    @patch('whatsapp_business_api.update_user_streak')
+    @patch('whatsapp_business_api.save_to_mongodb_parallel', return_value=False)
+    def test_failed_save_leaves_streak_untouched(self, mock_save, mock_streak):
+        """Test the streak only moves once the transaction is actually stored."""
+        # Act
+        saved, streak_info = whatsapp_business_api.persist_transaction_and_streak(
+            {'action': 'sale', 'amount': 10.0}, "test_user")
+
+        # Assert
+        assert saved is False
+        assert streak_info['updated'] is False
+        mock_streak.assert_not_called()
+
     @patch('whatsapp_business_api.connect_to_mongodb')
     def test_save_to_mongodb_failure(self, mock_connect):
         """Test failed data saving to MongoDB."""
@@ -245,6 +501,88 @@ class TestWhatsAppAPI:
         # Assert
         assert result is False
 
+    @patch('whatsapp_business_api.mongo_client', Mock())
+    @patch('whatsapp_business_api.users_collection')
+    def test_update_user_streak_single_round_trip(self, mock_users):
+        """Test that a consecutive-day log increments the streak in one update."""
+        # Arrange
+        # PyMongo returns stored dates as naive UTC datetimes
+        today = whatsapp_business_api.datetime.now(whatsapp_business_api.timezone.utc)
+        yesterday = (today - whatsapp_business_api.timedelta(days=1)).replace(
+            hour=0, minute=0, second=0, microsecond=0, tzinfo=None)
+        mock_users.find_one_and_update.return_value = {'streak': 4, 'last_log_date': yesterday}
+
+        # Act
+        result = whatsapp_business_api.update_user_streak("test_user")
+
+        # Assert
+        assert result == {"streak": 5, "is_new": False, "updated": True}
+        mock_users.find_one_and_update.assert_called_once()
+        mock_users.find_one.assert_not_called()
+        mock_users.update_one.assert_not_called()
+
+    @patch('whatsapp_business_api.registration_collection')
+    def test_registration_progress_is_stored_in_mongodb(self, mock_registrations):
+        """Test each registration step is written back so any worker can take the next reply."""
+        # Arrange
+        mock_registrations.find_one_and_update.return_value = {'step': 0, 'data': {}, 'language': 'en'}
+
+        # Act
+        whatsapp_business_api.handle_registration_step("test_user", "1")
+
+        # Assert
+        mock_registrations.find_one_and_update.assert_called_once()
+        (query, stored), _ = mock_registrations.replace_one.call_args
+        assert query == {'_id': 'test_user'}
+        assert stored['step'] == 1
+        assert stored['data'] == {'mode': 'business'}
+        assert "test_user" not in whatsapp_business_api.pending_registrations
+
+    @patch('whatsapp_business_api.category_cache_collection', None)
+    @patch('whatsapp_business_api.OPENAI_API_KEY', 'test_key')
+    @patch('whatsapp_business_api.openai_client')
+    def test_categorize_purchase_uses_cache(self, mock_openai):
+        """Test that repeated vendor/description pairs skip the AI call."""
+        # Arrange
+        whatsapp_business_api._category_cache.clear()
+        mock_response = Mock()
+        mock_response.choices = [Mock()]
+        mock_response.choices[0].message.content = "INVENTORY"
+        mock_openai.chat.completions.create.return_value = mock_response
+
+        # Act
+        first = whatsapp_business_api.categorize_purchase_with_ai("Beras 10kg", "Kedai Ali", 30)
+        second = whatsapp_business_api.categorize_purchase_with_ai("beras 10KG!", "kedai ali", 45)
+
+        # Assert
+        assert first == second == "INVENTORY"
+        mock_openai.chat.completions.create.assert_called_once()
+
+    @patch('whatsapp_business_api.users_collection', None)
+    @patch('whatsapp_business_api.categorize_purchase_with_ai', side_effect=RuntimeError('OpenAI down'))
+    @patch('whatsapp_business_api._background_executor')
+    @patch('whatsapp_business_api.collection')
+    def test_sweep_settles_stuck_pending_category(self, mock_collection, mock_executor, mock_categorize):
+        """Test a purchase left PENDING is swept and falls back to OTHER when AI fails."""
+        # Arrange
+        mock_collection.find.return_value.limit.return_value = [
+            {'_id': 'txn1', 'wa_id': 'test_user', 'items': 'Beras', 'vendor': 'Kedai Ali', 'amount': 30.0}
+        ]
+        mock_executor.submit.side_effect = lambda fn, *args: fn(*args)
+
+        # Act
+        queued = whatsapp_business_api.sweep_pending_categories()
+
+        # Assert
+        assert queued == 1
+        (query, _), _ = mock_collection.find.call_args
+        assert query['category'] == whatsapp_business_api.PENDING_CATEGORY
+        mock_categorize.assert_called_once_with('Beras', 'Kedai Ali', 30.0)
+        mock_collection.update_one.assert_called_once_with(
+            {'_id': 'txn1', 'category': whatsapp_business_api.PENDING_CATEGORY},
+            {'$set': {'category': 'OTHER'}}
+        )
+
 
 class TestImageProcessing:
     """Test cases for image processing functionality."""
@@ -288,18 +626,18 @@ class TestImageProcessing:
 
     def test_handle_image_message_success(self, sample_image_data):
         """Test successful image message handling."""
-        with patch('whatsapp_business_api.download_whatsapp_media') as mock_download:
-            with patch('whatsapp_business_api.parse_receipt_with_ai') as mock_parse:
-                with patch('whatsapp_business_api.save_to_mongodb') as mock_save:
+        with patch('whatsapp_business_api.spool_whatsapp_media') as mock_download:
+            with patch('whatsapp_business_api.process_image_parallel') as mock_parse:
+                with patch('whatsapp_business_api.persist_transaction_and_streak') as mock_save:
                     # Arrange
-                    mock_download.return_value = sample_image_data
+                    mock_download.return_value = io.BytesIO(sample_image_data)
                     mock_parse.return_value = {
+                        'action': 'purchase',
                         'amount': 25.0,
-                        'merchant': 'Test Store',
-                        'category': 'Shopping',
-                        'type': 'expense'
+                        'items': 'Stationery',
+                        'vendor': 'Test Store',
                     }
-                    mock_save.return_value = True
+                    mock_save.return_value = (True, {'streak': 1, 'is_new': True, 'updated': True})
 
                     # Act
                     result = whatsapp_business_api.handle_media_message("test_user", "test_media_id", "image")
@@ -307,10 +645,27 @@ class TestImageProcessing:
                     # Assert
                     assert "processed" in result.lower() or "recorded" in result.lower()
                     mock_download.assert_called_once_with("test_media_id")
+                    mock_parse.assert_called_once()
+                    mock_save.assert_called_once()
+
+    def test_handle_image_message_closes_file_on_clarification(self):
+        """Test the spooled image is closed when the receipt needs clarification."""
+        media_file = io.BytesIO(b'image')
+        with patch('whatsapp_business_api.spool_whatsapp_media', return_value=media_file), \
+             patch('whatsapp_business_api.downscale_image_bytes', return_value=b'image'), \
+             patch('whatsapp_business_api.process_image_parallel', return_value={'vendor': 'Test Store'}), \
+             patch('whatsapp_business_api.store_pending_transaction') as mock_store:
+            # Act
+            result = whatsapp_business_api.handle_media_message("test_user", "media_no_amount", "image")
+
+            # Assert
+            assert "clarification" in result.lower()
+            mock_store.assert_called_once()
+            assert media_file.closed
 
     def test_handle_image_message_download_failure(self):
         """Test image message handling when download fails."""
-        with patch('whatsapp_business_api.download_whatsapp_media') as mock_download:
+        with patch('whatsapp_business_api.spool_whatsapp_media') as mock_download:
             # Arrange
             mock_download.return_value = None
 
@@ -378,7 +733,7 @@ class TestErrorHandling:
         with patch.object(whatsapp_business_api, 'app') as mock_app:
             with patch('whatsapp_business_api.request') as mock_request:
                 # Arrange
-                mock_request.get_json.side_effect = Exception("Invalid JSON")
+                mock_request.get_data.return_value = b'{not json'
 
                 # Act & Assert
                 # This should not crash the application
@@ -411,6 +766,22 @@ class TestErrorHandling:
         # Assert
         assert result is False
 
+    @patch('whatsapp_business_api.connect_to_mongodb')
+    def test_write_with_reconnect_retries_once(self, mock_connect):
+        """Test that a dropped connection triggers one reconnect and retry."""
+        # Arrange
+        from pymongo.errors import AutoReconnect
+        mock_connect.return_value = True
+        write = Mock(side_effect=[AutoReconnect("connection reset"), "ok"])
+
+        # Act
+        result = whatsapp_business_api.write_with_reconnect(write)
+
+        # Assert
+        assert result == "ok"
+        assert write.call_count == 2
+        mock_connect.assert_called_once()
+
 
 if __name__ == '__main__':
     pytest.main([__file__])
\ No newline at end of file
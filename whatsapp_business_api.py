@@ -1,4 +1,15 @@
-from datetime import datetime, timezone
+import os
+
+# Cooperative I/O for gevent-based serving. This has to run before anything
+# else imports socket/ssl/threading, so it stays at the very top.
+if os.getenv("GEVENT_PATCH") == "1":
+    try:
+        from gevent import monkey
+        monkey.patch_all()
+    except ImportError:
+        print("gevent not available, GEVENT_PATCH ignored")
+
+from datetime import date, datetime, timezone, timedelta
 try:
     from dotenv import load_dotenv
     DOTENV_AVAILABLE = True
@@ -6,19 +17,35 @@ except ImportError:
     DOTENV_AVAILABLE = False
     print("dotenv not available, using system environment variables")
 from openai import OpenAI
-from pymongo import MongoClient
+from pymongo import MongoClient, IndexModel, ASCENDING, DESCENDING, ReturnDocument
 from pymongo.server_api import ServerApi
+from pymongo.write_concern import WriteConcern
+from pymongo.errors import AutoReconnect, DuplicateKeyError
+from bson import ObjectId
+from bson.binary import Binary
+import gridfs
 from flask import Flask, request, Response, jsonify
 import json
-import os
 import logging
 import base64
 import io
 import re
 import requests
+import httpx
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import concurrent.futures
 import threading
-from PIL import Image, ImageFilter, ImageEnhance
+import hashlib
+import hmac
+import functools
+import time
+import tempfile
+import copy
+from typing import BinaryIO
+from collections import ChainMap, OrderedDict
+from cachetools import TTLCache
+from PIL import Image, ImageFilter
 
 try:
     CV2_AVAILABLE = True
@@ -34,8 +61,24 @@ except ImportError:
     pytesseract = None
     print("pytesseract not available, OCR functionality disabled")
 
+try:
+    # orjson decodes the model's JSON replies several times faster
+    import orjson
+    json_loads = orjson.loads
+except ImportError:
+    json_loads = json.loads
+
+try:
+    # Aho-Corasick finds every transaction keyword in one pass over the text
+    import ahocorasick
+except ImportError:
+    ahocorasick = None
+
 # --- Setup ---
-load_dotenv()
+# Production units export the environment themselves (systemd EnvironmentFile
+# plus FLASK_ENV=production), so only local runs need to read .env from disk
+if DOTENV_AVAILABLE and os.getenv("FLASK_ENV") != "production":
+    load_dotenv()
 
 # WhatsApp Business API Configuration
 WHATSAPP_ACCESS_TOKEN = os.getenv("WHATSAPP_ACCESS_TOKEN")
@@ -45,9 +88,34 @@ WHATSAPP_API_VERSION = os.getenv("WHATSAPP_API_VERSION", "v18.0")
 
 # OpenAI Configuration
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
+# Upper bound on in-flight OpenAI requests across all worker threads
+OPENAI_MAX_CONCURRENCY = int(os.getenv("OPENAI_MAX_CONCURRENCY", "10"))
+# A streamed reply is abandoned if no token arrives for this long
+OPENAI_STREAM_READ_TIMEOUT = 10.0  # seconds
 
 # MongoDB Configuration
 MONGO_URI = os.getenv("MONGO_URI")
+# FAST_WRITES=1 writes transactions unacknowledged (w=0); user/streak writes stay acknowledged
+FAST_WRITES = os.getenv("FAST_WRITES", "0") == "1"
+# How long an AI purchase category is reused for the same vendor/description
+CATEGORY_CACHE_TTL = 30 * 24 * 3600  # seconds
+# Unanswered clarifications expire after 30 minutes
+PENDING_TRANSACTION_TTL = 1800  # seconds
+# Registrations abandoned part-way are dropped after an hour
+PENDING_REGISTRATION_TTL = 3600  # seconds
+# Reset requests must be confirmed within ten minutes
+PENDING_RESET_TTL = 600  # seconds
+# WhatsApp redeliveries of a message ID within an hour are ignored
+WEBHOOK_DEDUPE_TTL = 3600  # seconds
+# Placeholder category until the background categorization finishes
+PENDING_CATEGORY = 'PENDING'
+
+# Amount in a free-text clarification reply, e.g. "150" or "12.50"
+_AMOUNT_RE = re.compile(r'\d+(?:\.\d+)?')
+# A reply that is nothing but an amount
+_NUMBER_ONLY_RE = re.compile(r'(?:rm\s*)?\d+(?:\.\d+)?', re.IGNORECASE)
+# Preposition in front of a vendor/customer name in a clarification reply
+_VENDOR_PREP_RE = re.compile(r'^(?:dari|from|kepada|to|dengan|with)\s+', re.IGNORECASE)
 
 # Set up basic logging
 logging.basicConfig(
@@ -62,12 +130,23 @@ app = Flask(__name__)
 # --- Initialize Clients ---
 # OpenAI (initialized after loading environment variables)
 openai_client = None
+# Webhook threads queue here instead of piling onto the rate limit together
+_openai_semaphore = threading.BoundedSemaphore(OPENAI_MAX_CONCURRENCY)
 
 # MongoDB
 mongo_client = None
 db = None
 collection = None
+fast_collection = None
 users_collection = None
+category_cache_collection = None
+pending_collection = None
+registration_collection = None
+reset_collection = None
+processed_message_collection = None
+app_state_collection = None
+# Serializes swapping the globals above when several threads reconnect at once
+_mongo_connect_lock = threading.Lock()
 
 def initialize_openai_client():
     """Initialize OpenAI client with API key from environment variables."""
@@ -79,7 +158,14 @@ def initialize_openai_client():
         return False
 
     try:
-        openai_client = OpenAI(api_key=OPENAI_API_KEY)
+        # One pooled keep-alive client shared by every worker thread, so AI
+        # calls skip the TCP+TLS setup to api.openai.com after the first one
+        http_client = httpx.Client(
+            limits=httpx.Limits(max_connections=32, max_keepalive_connections=32),
+        )
+        # The SDK retries 429/5xx with exponential backoff; three attempts
+        # ride out short rate-limit bursts without failing the user's message
+        openai_client = OpenAI(api_key=OPENAI_API_KEY, http_client=http_client, max_retries=3)
         logger.info("OpenAI client initialized successfully")
         logger.info(f"OpenAI API key starts with: {OPENAI_API_KEY[:7]}...")
         return True
@@ -88,9 +174,32 @@ def initialize_openai_client():
         logger.error(f"API key length: {len(OPENAI_API_KEY) if OPENAI_API_KEY else 0}")
         return False
 
+def create_chat_completion(**kwargs):
+    """Call the chat completions API, holding a concurrency slot for the request."""
+    with _openai_semaphore:
+        return openai_client.chat.completions.create(**kwargs)
+
+def stream_chat_completion(**kwargs) -> str | None:
+    """
+    Stream a chat completion and return the joined reply text (None if empty).
+
+    The concurrency slot is held until the stream is drained. A stall longer
+    than OPENAI_STREAM_READ_TIMEOUT, before the first token or between
+    chunks, raises instead of holding the user's reply for the full timeout.
+    """
+    kwargs.setdefault('timeout', httpx.Timeout(60.0, read=OPENAI_STREAM_READ_TIMEOUT))
+    parts = []
+    with _openai_semaphore:
+        with openai_client.chat.completions.create(stream=True, **kwargs) as stream:
+            for chunk in stream:
+                if chunk.choices and chunk.choices[0].delta.content:
+                    parts.append(chunk.choices[0].delta.content)
+    return ''.join(parts) or None
+
 def connect_to_mongodb():
     """Connect to MongoDB with retry logic and better error handling."""
-    global mongo_client, db, collection, users_collection
+    global mongo_client, db, collection, fast_collection, users_collection, category_cache_collection, pending_collection
+    global registration_collection, reset_collection, processed_message_collection, app_state_collection
 
     if not MONGO_URI:
         logger.error("MONGO_URI environment variable not set!")
@@ -99,18 +208,30 @@ def connect_to_mongodb():
     try:
         logger.info("Attempting to connect to MongoDB...")
 
+        # Keep a warm pool so requests don't pay for a new TCP+TLS handshake.
+        # Connections opened for a burst above minPoolSize are closed after
+        # five idle minutes instead of being held for the life of the worker
+        pool_options = {
+            "maxPoolSize": 50,
+            "minPoolSize": 10,
+            "maxIdleTimeMS": 300000,
+            "retryWrites": True,
+            # Don't open sockets at construction; safe with forking/gevent workers
+            "connect": False
+        }
+
         # Try different SSL configurations to resolve the TLS error
         connection_options = [
             # Option 1: Default settings with Server API
             {
                 "server_api": ServerApi('1'),
-                "serverSelectionTimeoutMS": 5000,
+                "serverSelectionTimeoutMS": 3000,
                 "connectTimeoutMS": 5000,
                 "socketTimeoutMS": 5000
             },
             # Option 2: Basic settings without Server API
             {
-                "serverSelectionTimeoutMS": 5000,
+                "serverSelectionTimeoutMS": 3000,
                 "connectTimeoutMS": 5000,
                 "socketTimeoutMS": 5000
             },
@@ -120,21 +241,70 @@ def connect_to_mongodb():
             }
         ]
 
-        for i, options in enumerate(connection_options, 1):
+        def try_option(i, options):
+            """Open a client with one option set; return it if it answers a ping."""
+            client = MongoClient(MONGO_URI, **pool_options, **options)
             try:
-                mongo_client = MongoClient(MONGO_URI, **options)
-                # Test the connection
-                mongo_client.admin.command('ping')
-                logger.info(f"MongoDB connected successfully with option {i}")
+                client.admin.command('ping')
+                return client
+            except Exception as e:
+                logger.warning(f"MongoDB connection option {i} failed: {e}")
+                client.close()
+                return None
+
+        def close_unused(future):
+            try:
+                client = future.result()
+            except Exception:
+                return
+            if client is not None:
+                client.close()
+
+        # Probe all option sets at once so a cold start waits for the slowest
+        # timeout rather than the sum of them; the first client to answer wins
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=len(connection_options), thread_name_prefix="mongo-connect")
+        futures = {executor.submit(try_option, i, options): i for i, options in enumerate(connection_options, 1)}
+        client, winner = None, None
+        try:
+            for future in concurrent.futures.as_completed(futures):
+                try:
+                    client = future.result()
+                except Exception as e:
+                    logger.warning(f"MongoDB connection option {futures[future]} failed: {e}")
+                    continue
+                if client is not None:
+                    winner = future
+                    break
+        finally:
+            # Probes still in flight close their clients when they finish
+            for future in futures:
+                if future is not winner:
+                    future.add_done_callback(close_unused)
+            executor.shutdown(wait=False)
+
+        if client is not None:
+            with _mongo_connect_lock:
+                mongo_client = client
+                logger.info(f"MongoDB connected successfully with option {futures[winner]}")
 
                 db = mongo_client['transactions_db']
                 collection = db['entries']
                 users_collection = db['users']
+                category_cache_collection = db['category_cache']
+                pending_collection = db['pending_transactions']
+                registration_collection = db['pending_registrations']
+                reset_collection = db['pending_resets']
+                processed_message_collection = db['processed_messages']
+                app_state_collection = db['app_state']
+                if FAST_WRITES:
+                    fast_collection = collection.with_options(write_concern=WriteConcern(w=0))
+                    logger.info("FAST_WRITES enabled: transaction inserts are unacknowledged")
+                else:
+                    fast_collection = collection
 
-                return True
-            except Exception as e:
-                logger.warning(f"MongoDB connection option {i} failed: {e}")
-                continue
+            ensure_indexes()
+            migrate_streak_dates()
+            return True
 
         logger.error("All MongoDB connection options failed")
         return False
@@ -144,9 +314,78 @@ def connect_to_mongodb():
         mongo_client = None
         db = None
         collection = None
+        fast_collection = None
         users_collection = None
+        category_cache_collection = None
+        pending_collection = None
+        registration_collection = None
+        reset_collection = None
+        processed_message_collection = None
+        app_state_collection = None
         return False
 
+def ensure_indexes():
+    """Create the indexes used by the per-user summary, status and CCC queries.
+
+    create_indexes is idempotent, so this is safe to run on every startup.
+    """
+    try:
+        collection.create_indexes([
+            # Also serves plain wa_id and (wa_id, timestamp) lookups through its prefix
+            IndexModel([('wa_id', ASCENDING), ('timestamp', DESCENDING), ('action', ASCENDING)], name='wa_ts_action'),
+            IndexModel([('wa_id', ASCENDING), ('action', ASCENDING)], name='wa_id_action'),
+            # Only rows still waiting for a category, so the sweep stays cheap
+            IndexModel([('timestamp', ASCENDING)], name='pending_category',
+                       partialFilterExpression={'category': PENDING_CATEGORY}),
+        ])
+        # Let MongoDB expire stale purchase categories
+        category_cache_collection.create_index('updated_at', expireAfterSeconds=CATEGORY_CACHE_TTL)
+        # ...and abandoned clarifications
+        pending_collection.create_index('timestamp', expireAfterSeconds=PENDING_TRANSACTION_TTL)
+        registration_collection.create_index('timestamp', expireAfterSeconds=PENDING_REGISTRATION_TTL)
+        reset_collection.create_index('timestamp', expireAfterSeconds=PENDING_RESET_TTL)
+        # ...and webhook message IDs once WhatsApp has stopped redelivering them
+        processed_message_collection.create_index('received_at', expireAfterSeconds=WEBHOOK_DEDUPE_TTL)
+        # One user document per WhatsApp number; streak upserts rely on it
+        users_collection.create_index('wa_id', unique=True)
+        logger.info("MongoDB indexes ensured")
+    except Exception as e:
+        # Missing indexes slow queries down but shouldn't stop the bot
+        logger.warning(f"Could not create MongoDB indexes: {e}")
+
+def migrate_streak_dates():
+    """Convert legacy "%Y-%m-%d" string last_log_date values to BSON dates.
+
+    Only string values are touched, so this is a no-op once migrated.
+    """
+    try:
+        result = users_collection.update_many(
+            {'last_log_date': {'$type': 'string', '$ne': ''}},
+            [{'$set': {'last_log_date': {'$dateFromString': {'dateString': '$last_log_date', 'format': '%Y-%m-%d'}}}}]
+        )
+        if result.modified_count:
+            logger.info(f"Migrated last_log_date to BSON dates for {result.modified_count} users")
+    except Exception as e:
+        logger.warning(f"Could not migrate last_log_date values: {e}")
+
+def write_with_reconnect(write):
+    """
+    Run write() and, if the connection drops, reconnect once and retry.
+
+    write must look up the collection globals when called so the retry uses
+    the new client. pymongo assigns _id to documents before sending them, so
+    a retried insert that had already landed fails with a duplicate key
+    rather than writing the transaction twice.
+    """
+    try:
+        return write()
+    except AutoReconnect as e:
+        # Also covers NetworkTimeout and ServerSelectionTimeoutError
+        logger.warning(f"MongoDB connection lost ({e}), reconnecting and retrying once")
+        if not connect_to_mongodb():
+            raise
+        return write()
+
 # Initialize MongoDB connection
 connect_to_mongodb()
 
@@ -158,6 +397,82 @@ else:
     logger.info("✅ OpenAI client initialized successfully at startup")
 
 # --- Language Detection ---
+# Common Malay indicators
+_MALAY_INDICATORS = frozenset([
+    # Common Malay words
+    'beli', 'jual', 'bayar', 'terima', 'hutang', 'tunai', 'kredit',
+    'ringgit', 'rm', 'sen', 'kepada', 'daripada', 'untuk', 'dari',
+    'dan', 'atau', 'dengan', 'pada', 'di', 'ke', 'dalam', 'oleh',
+    'aku', 'saya', 'kami', 'kita', 'dia', 'mereka', 'ini', 'itu',
+    'yang', 'adalah', 'ada', 'tidak', 'tak', 'belum', 'sudah', 'akan',
+    'makan', 'minum', 'beras', 'ayam', 'ikan', 'sayur', 'buah',
+    'kedai', 'pasar', 'restoran', 'warung', 'gerai',
+    'hari', 'minggu', 'bulan', 'tahun', 'pagi', 'petang', 'malam',
+    'supplier', 'customer', 'pelanggan', 'pembeli', 'penjual',
+    # Malay transaction terms
+    'untung', 'rugi', 'modal', 'jualan', 'pembelian', 'pendapatan',
+    'perbelanjaan', 'kos', 'harga', 'diskaun', 'potongan'
+])
+
+# Common English indicators
+_ENGLISH_INDICATORS = frozenset([
+    # Common English words
+    'buy', 'sell', 'pay', 'receive', 'debt', 'cash', 'credit',
+    'dollar', 'cent', 'price', 'cost', 'total', 'amount',
+    'to', 'from', 'for', 'with', 'at', 'in', 'on', 'by',
+    'the', 'and', 'or', 'but', 'if', 'then', 'when', 'where',
+    'what', 'why', 'how', 'who', 'which', 'this', 'that',
+    'have', 'has', 'had', 'will', 'would', 'can', 'could',
+    'food', 'drink', 'rice', 'chicken', 'fish', 'vegetable',
+    'shop', 'market', 'restaurant', 'store', 'outlet',
+    'day', 'week', 'month', 'year', 'morning', 'evening', 'night',
+    'supplier', 'customer', 'buyer', 'seller', 'vendor',
+    # English transaction terms
+    'profit', 'loss', 'capital', 'sales', 'purchase', 'income',
+    'expense', 'discount', 'invoice', 'receipt'
+])
+
+# Every indicator is a single word, so splitting the text into runs of
+# letters and intersecting with the sets above finds them all in one pass.
+# Letters on either side block a match, so 'di' no longer counts inside
+# 'dinner' while 'rm' still matches in 'rm15'.
+_WORD_RE = re.compile(r'[a-z]+')
+
+# Sentence patterns stay separate searches: CPython's re backtracks through
+# an alternation at every offset, and one combined pattern measured ~30%
+# slower than these short literal-led searches on typical messages.
+# Common Malay sentence patterns
+_MALAY_PATTERNS = [re.compile(p) for p in (
+    r'\b(saya|aku)\s+(beli|jual|bayar)',
+    r'\brm\s*\d+',
+    r'\bringgit\b',
+    r'\bkepada\s+',
+    r'\bdaripada\s+',
+    r'\btidak\s+(ada|boleh|mahu)',
+    r'\bsudah\s+(beli|jual|bayar)',
+)]
+
+# Common English sentence patterns
+_ENGLISH_PATTERNS = [re.compile(p) for p in (
+    r'\bi\s+(buy|sell|pay|bought|sold|paid)',
+    r'\$\d+',
+    r'\bdollar[s]?\b',
+    r'\bto\s+buy\b',
+    r'\bfrom\s+\w+',
+    r'\bdon\'t\s+',
+    r'\bcan\'t\s+',
+    r'\bwon\'t\s+',
+)]
+
+# First words that decide the language of a short message outright.
+# Words common to both ("status", "customer") and greetings Malay speakers
+# also use ("hi", "hello") are left to the full scan.
+_SHORT_MALAY_WORDS = frozenset({'rm', 'beli', 'jual', 'bayar', 'terima', 'ringkasan'})
+_SHORT_ENGLISH_WORDS = frozenset({'buy', 'sell', 'pay', 'summary'})
+
+# Longest normalized text whose detected language is memoized
+DETECT_LANGUAGE_CACHE_MAX_LEN = 500
+
 def detect_language(text: str) -> str:
     """
     Detect if the text is in Malay or English based on keywords and patterns.
@@ -166,79 +481,42 @@ def detect_language(text: str) -> str:
     if not text:
         return 'en'
     
-    text_lower = text.lower().strip()
-    
-    # Common Malay indicators
-    malay_indicators = [
-        # Common Malay words
-        'beli', 'jual', 'bayar', 'terima', 'hutang', 'tunai', 'kredit',
-        'ringgit', 'rm', 'sen', 'kepada', 'daripada', 'untuk', 'dari',
-        'dan', 'atau', 'dengan', 'pada', 'di', 'ke', 'dalam', 'oleh',
-        'aku', 'saya', 'kami', 'kita', 'dia', 'mereka', 'ini', 'itu',
-        'yang', 'adalah', 'ada', 'tidak', 'tak', 'belum', 'sudah', 'akan',
-        'makan', 'minum', 'beras', 'ayam', 'ikan', 'sayur', 'buah',
-        'kedai', 'pasar', 'restoran', 'warung', 'gerai',
-        'hari', 'minggu', 'bulan', 'tahun', 'pagi', 'petang', 'malam',
-        'supplier', 'customer', 'pelanggan', 'pembeli', 'penjual',
-        # Malay transaction terms
-        'untung', 'rugi', 'modal', 'jualan', 'pembelian', 'pendapatan',
-        'perbelanjaan', 'kos', 'harga', 'diskaun', 'potongan'
-    ]
-    
-    # Common English indicators
-    english_indicators = [
-        # Common English words
-        'buy', 'sell', 'pay', 'receive', 'debt', 'cash', 'credit',
-        'dollar', 'cent', 'price', 'cost', 'total', 'amount',
-        'to', 'from', 'for', 'with', 'at', 'in', 'on', 'by',
-        'the', 'and', 'or', 'but', 'if', 'then', 'when', 'where',
-        'what', 'why', 'how', 'who', 'which', 'this', 'that',
-        'have', 'has', 'had', 'will', 'would', 'can', 'could',
-        'food', 'drink', 'rice', 'chicken', 'fish', 'vegetable',
-        'shop', 'market', 'restaurant', 'store', 'outlet',
-        'day', 'week', 'month', 'year', 'morning', 'evening', 'night',
-        'supplier', 'customer', 'buyer', 'seller', 'vendor',
-        # English transaction terms
-        'profit', 'loss', 'capital', 'sales', 'purchase', 'income',
-        'expense', 'discount', 'invoice', 'receipt'
-    ]
-    
-    # Count occurrences of language indicators
-    malay_count = sum(1 for word in malay_indicators if word in text_lower)
-    english_count = sum(1 for word in english_indicators if word in text_lower)
+    # Collapse whitespace so near-identical phrases share a cache entry
+    words = text.lower().split()
+
+    # Short messages ("beli ayam 10", "pay 20") are most of the traffic and
+    # their first word usually settles the language on its own
+    if words and len(text) < 20:
+        first = words[0]
+        if first in _SHORT_MALAY_WORDS:
+            return 'ms'
+        if first in _SHORT_ENGLISH_WORDS:
+            return 'en'
+
+    normalized = ' '.join(words)
+    # Long messages are practically never repeated; score them directly so
+    # they don't push the short, common phrases out of the LRU
+    if len(normalized) > DETECT_LANGUAGE_CACHE_MAX_LEN:
+        return _detect_language_cached.__wrapped__(normalized)
+    return _detect_language_cached(normalized)
+
+@functools.lru_cache(maxsize=4096)
+def _detect_language_cached(text_lower: str) -> str:
+    """Score normalized text; repeated phrases are answered from the LRU."""
+    # Count distinct language indicators found in the text
+    found = set(_WORD_RE.findall(text_lower))
+    malay_count = len(found & _MALAY_INDICATORS)
+    english_count = len(found & _ENGLISH_INDICATORS)
     
     # Additional pattern matching for mixed language detection
-    # Check for common Malay sentence patterns
-    malay_patterns = [
-        r'\b(saya|aku)\s+(beli|jual|bayar)',
-        r'\brm\s*\d+',
-        r'\bringgit\b',
-        r'\bkepada\s+',
-        r'\bdaripada\s+',
-        r'\btidak\s+(ada|boleh|mahu)',
-        r'\bsudah\s+(beli|jual|bayar)',
-    ]
-    
-    # Check for common English sentence patterns  
-    english_patterns = [
-        r'\bi\s+(buy|sell|pay|bought|sold|paid)',
-        r'\$\d+',
-        r'\bdollar[s]?\b',
-        r'\bto\s+buy\b',
-        r'\bfrom\s+\w+',
-        r'\bdon\'t\s+',
-        r'\bcan\'t\s+',
-        r'\bwon\'t\s+',
-    ]
-    
-    # Check patterns
-    for pattern in malay_patterns:
-        if re.search(pattern, text_lower):
-            malay_count += 2  # Give patterns higher weight
+    # Patterns get a higher weight than single words
+    for pattern in _MALAY_PATTERNS:
+        if pattern.search(text_lower):
+            malay_count += 2
     
-    for pattern in english_patterns:
-        if re.search(pattern, text_lower):
-            english_count += 2  # Give patterns higher weight
+    for pattern in _ENGLISH_PATTERNS:
+        if pattern.search(text_lower):
+            english_count += 2
     
     # Determine language based on counts
     if malay_count > english_count:
@@ -376,6 +654,8 @@ def parse_transaction_with_regex(message: str, user_mode: str = 'business') -> d
         
         # Business transaction patterns
         'business_sale': [
+            # "jual 3 kek rm30 kepada siti" / "sold 3 cakes rm30 to siti"
+            r'(?:jual|sell|sold)\s+.+?\s+rm\s*(\d+(?:\.\d{2})?)\s+(?:to|kepada)\s+(.+)',
             # "jual rm100 ayam" / "sell rm100 chicken"
             r'(?:jual|sell|sale)\s*(?:rm)?\s*(\d+(?:\.\d{2})?)\s*(.+)',
             # "sale rm500 to customer" / "jualan rm500 kepada pelanggan"
@@ -383,6 +663,8 @@ def parse_transaction_with_regex(message: str, user_mode: str = 'business') -> d
         ],
         
         'business_purchase': [
+            # "beli ayam rm25 dari ali" / "bought flour rm25 from ali"
+            r'(?:beli|buy|bought)\s+.+?\s+rm\s*(\d+(?:\.\d{2})?)\s+(?:from|dari)\s+(.+)',
             # "beli rm200 barang" / "buy rm200 items"
             r'(?:beli|buy|purchase)\s*(?:rm)?\s*(\d+(?:\.\d{2})?)\s*(.+)',
             # "purchase rm1000 from supplier"
@@ -390,6 +672,8 @@ def parse_transaction_with_regex(message: str, user_mode: str = 'business') -> d
         ],
         
         'business_payment': [
+            # "bayar sewa rm500 kepada ali" / "paid rent rm500 to ali"
+            r'(?:bayar|pay|paid)\s+.+?\s+rm\s*(\d+(?:\.\d{2})?)\s+(?:to|kepada)\s+(.+)',
             # "bayar rm300 supplier" / "pay rm300 to vendor"
             r'(?:bayar|pay|payment)\s*(?:rm)?\s*(\d+(?:\.\d{2})?)\s*(?:to|kepada)?\s*(.+)',
             # "payment made rm500 to ABC"
@@ -486,39 +770,51 @@ def extract_personal_category(message: str) -> str:
     
     return 'other'
 
+# Patterns for extract_items_from_message, compiled once at import
+# "makan ayam penyet, rm 12": action + item description + comma/space + amount
+_ITEM_RE = re.compile(r'(?:makan|food|lunch|breakfast|dinner|eat|beli|buy|jual|sell|petrol|fuel|shopping|shop)\s+(.+?)(?:\s*[,\s]+(?:rm\s*)?\d+(?:\.\d{2})?)')
+_TRAILING_PUNCT_RE = re.compile(r'[,\.\-\s]+$')
+_ITEM_AMOUNT_RES = (
+    re.compile(r'rm\s*\d+(?:\.\d{2})?', re.IGNORECASE),
+    re.compile(r'\d+(?:\.\d{2})?\s*rm', re.IGNORECASE),
+    re.compile(r'^\d+(?:\.\d{2})?'),
+)
+# Leading action words, stripped in this order
+_ITEM_ACTION_WORD_RES = tuple(
+    re.compile(rf'^\s*{word}\s+', re.IGNORECASE)
+    for word in ('makan', 'food', 'lunch', 'breakfast', 'dinner', 'beli', 'buy', 'jual', 'sell',
+                 'bayar', 'pay', 'terima', 'receive', 'petrol', 'fuel', 'shopping', 'shop', 'eat')
+)
+_PUNCT_RUN_RE = re.compile(r'[,\.\-]+')
+_WHITESPACE_RUN_RE = re.compile(r'\s+')
+
 def extract_items_from_message(message: str) -> str:
     """Extract item description from message - handles formats like 'makan ayam penyet, rm 12'."""
     original = message.strip()
     message = original.lower()
     
     # Pattern 1: "makan ayam penyet, rm 12" - extract "ayam penyet"
-    # Pattern matches: action + item description + comma/space + amount
-    item_pattern = r'(?:makan|food|lunch|breakfast|dinner|eat|beli|buy|jual|sell|petrol|fuel|shopping|shop)\s+(.+?)(?:\s*[,\s]+(?:rm\s*)?\d+(?:\.\d{2})?)'
-    match = re.search(item_pattern, message)
+    match = _ITEM_RE.search(message)
     if match:
         item_text = match.group(1).strip()
         # Clean up common punctuation and extra words
-        item_text = re.sub(r'[,\.\-\s]+$', '', item_text)  # Remove trailing punctuation
+        item_text = _TRAILING_PUNCT_RE.sub('', item_text)  # Remove trailing punctuation
         if item_text and len(item_text) > 1:
             return item_text
     
     # Pattern 2: Remove amount patterns and action words for fallback
     cleaned = message
     # Remove amounts first
-    cleaned = re.sub(r'rm\s*\d+(?:\.\d{2})?', '', cleaned, flags=re.IGNORECASE)
-    cleaned = re.sub(r'\d+(?:\.\d{2})?\s*rm', '', cleaned, flags=re.IGNORECASE) 
-    cleaned = re.sub(r'^\d+(?:\.\d{2})?', '', cleaned)
+    for amount_re in _ITEM_AMOUNT_RES:
+        cleaned = amount_re.sub('', cleaned)
     
     # Remove action words at the beginning
-    action_words = ['makan', 'food', 'lunch', 'breakfast', 'dinner', 'beli', 'buy', 'jual', 'sell', 
-                   'bayar', 'pay', 'terima', 'receive', 'petrol', 'fuel', 'shopping', 'shop', 'eat']
-    
-    for word in action_words:
-        cleaned = re.sub(rf'^\s*{word}\s+', '', cleaned, flags=re.IGNORECASE)
+    for action_re in _ITEM_ACTION_WORD_RES:
+        cleaned = action_re.sub('', cleaned)
     
     # Clean up punctuation and extra spaces
-    cleaned = re.sub(r'[,\.\-]+', ' ', cleaned)  # Replace punctuation with spaces
-    cleaned = re.sub(r'\s+', ' ', cleaned).strip()
+    cleaned = _PUNCT_RUN_RE.sub(' ', cleaned)  # Replace punctuation with spaces
+    cleaned = _WHITESPACE_RUN_RE.sub(' ', cleaned).strip()
     
     # If we extracted something meaningful, return it
     if cleaned and len(cleaned.strip()) > 1:
@@ -528,21 +824,10 @@ def extract_items_from_message(message: str) -> str:
     category = extract_personal_category(original)
     return category if category != 'other' else 'N/A'
 
-def get_localized_message(message_key: str, language: str = 'en', **kwargs) -> str:
-    """
-    Get localized messages for static bot responses.
-    
-    Args:
-        message_key: The key for the message type
-        language: 'en' for English, 'ms' for Malay
-        **kwargs: Variables to format into the message
-    
-    Returns:
-        Formatted message string in the requested language
-    """
-    messages = {
-        'welcome': {
-            'en': """Hi! I'm your financial assistant for WhatsApp. 🤖💰
+# Static bot responses by message key, then language
+_LOCALIZED_MESSAGES = {
+    'welcome': {
+        'en': """Hi! I'm your financial assistant for WhatsApp. 🤖💰
 
 You can:
 📝 Send me a text message describing a transaction
@@ -554,7 +839,7 @@ You can:
 
 All your data is kept private and separate from other users!
 Build your daily logging streak by recording transactions every day! 💪""",
-            'ms': """Hai! Saya adalah pembantu kewangan anda untuk WhatsApp. 🤖💰
+        'ms': """Hai! Saya adalah pembantu kewangan anda untuk WhatsApp. 🤖💰
 
 Anda boleh:
 📝 Hantar mesej teks yang menerangkan transaksi
@@ -566,9 +851,9 @@ Anda boleh:
 
 Semua data anda dijaga secara peribadi dan berasingan dari pengguna lain!
 Bina streak pencatatan harian dengan merekod transaksi setiap hari! 💪"""
-        },
-        'welcome_personal': {
-            'en': """Hi! I'm your personal budget tracking assistant! 💰📱
+    },
+    'welcome_personal': {
+        'en': """Hi! I'm your personal budget tracking assistant! 💰📱
 
 *Personal Budget Mode* 🏠
 I'll help you track your daily expenses and income:
@@ -591,7 +876,7 @@ I'll help you track your daily expenses and income:
 • Check your status regularly to stay on budget
 
 Start tracking: Just type what you spent! 🚀""",
-            'ms': """Hai! Saya pembantu penjejakan belanja peribadi anda! 💰📱
+        'ms': """Hai! Saya pembantu penjejakan belanja peribadi anda! 💰📱
 
 *Mod Belanja Peribadi* 🏠
 Saya akan bantu jejak perbelanjaan dan pendapatan harian anda:
@@ -614,9 +899,9 @@ Saya akan bantu jejak perbelanjaan dan pendapatan harian anda:
 • Semak status kerap untuk kekal dalam bajet
 
 Mula jejak: Taip apa yang anda belanjakan! 🚀"""
-        },
-        'welcome_business': {
-            'en': """Hi! I'm your business financial assistant for WhatsApp! 🤖💼
+    },
+    'welcome_business': {
+        'en': """Hi! I'm your business financial assistant for WhatsApp! 🤖💼
 
 *Business Mode* 🏢
 I'll help you track sales, purchases, payments and analyze cash flow:
@@ -640,7 +925,7 @@ I'll help you track sales, purchases, payments and analyze cash flow:
 • Separate business from personal expenses
 
 Build your business discipline with daily tracking! 💪""",
-            'ms': """Hai! Saya pembantu kewangan perniagaan anda di WhatsApp! 🤖💼
+        'ms': """Hai! Saya pembantu kewangan perniagaan anda di WhatsApp! 🤖💼
 
 *Mod Perniagaan* 🏢
 Saya akan bantu jejak jualan, pembelian, pembayaran dan analisis aliran tunai:
@@ -664,61 +949,61 @@ Saya akan bantu jejak jualan, pembelian, pembayaran dan analisis aliran tunai:
 • Asingkan perniagaan dari perbelanjaan peribadi
 
 Bina disiplin perniagaan dengan penjejakan harian! 💪"""
-        },
-        'error_parse': {
-            'en': "🤖 Sorry, I couldn't understand that. Please try rephrasing.",
-            'ms': "🤖 Maaf, saya tidak faham. Sila cuba tulis semula."
-        },
-        'error_db': {
-            'en': "❌ Database connection failed. Please try again later.",
-            'ms': "❌ Sambungan pangkalan data gagal. Sila cuba lagi nanti."
-        },
-        'clarification_items': {
-            'en': "🛒 What item did you buy?",
-            'ms': "🛒 Barang apa yang anda beli?"
-        },
-        'clarification_items_sell': {
-            'en': "🏪 What item did you sell?",
-            'ms': "🏪 Barang apa yang anda jual?"
-        },
-        'clarification_amount': {
-            'en': "💰 What was the amount?",
-            'ms': "💰 Berapakah jumlahnya?"
-        },
-        'clarification_customer_buy': {
-            'en': "🏪 Who did you buy from?",
-            'ms': "🏪 Anda beli daripada siapa?"
-        },
-        'clarification_customer_sell': {
-            'en': "👤 Who did you sell to?",
-            'ms': "👤 Anda jual kepada siapa?"
-        },
-        'clarification_payment_to': {
-            'en': "💸 Who did you pay?",
-            'ms': "💸 Anda bayar kepada siapa?"
-        },
-        'clarification_payment_from': {
-            'en': "💰 Who paid you?",
-            'ms': "💰 Siapa yang bayar anda?"
-        },
-        'clarification_prefix': {
-            'en': "I need a bit more information to record this transaction:",
-            'ms': "Saya perlukan sedikit maklumat tambahan untuk merekod transaksi ini:"
-        },
-        'clarification_suffix': {
-            'en': "Please provide the missing details, and I'll record the transaction for you! 📝",
-            'ms': "Sila berikan butiran yang hilang, dan saya akan rekodkan transaksi untuk anda! 📝"
-        },
-        'transaction_saved': {
-            'en': "✅ Transaction recorded successfully!\n\n{summary}",
-            'ms': "✅ Transaksi berjaya direkodkan!\n\n{summary}"
-        },
-        'transaction_error': {
-            'en': "❌ Error saving transaction: {error}",
-            'ms': "❌ Ralat menyimpan transaksi: {error}"
-        },
-        'multiple_transactions': {
-            'en': """🤖 I detected multiple transactions in your message!
+    },
+    'error_parse': {
+        'en': "🤖 Sorry, I couldn't understand that. Please try rephrasing.",
+        'ms': "🤖 Maaf, saya tidak faham. Sila cuba tulis semula."
+    },
+    'error_db': {
+        'en': "❌ Database connection failed. Please try again later.",
+        'ms': "❌ Sambungan pangkalan data gagal. Sila cuba lagi nanti."
+    },
+    'clarification_items': {
+        'en': "🛒 What item did you buy?",
+        'ms': "🛒 Barang apa yang anda beli?"
+    },
+    'clarification_items_sell': {
+        'en': "🏪 What item did you sell?",
+        'ms': "🏪 Barang apa yang anda jual?"
+    },
+    'clarification_amount': {
+        'en': "💰 What was the amount?",
+        'ms': "💰 Berapakah jumlahnya?"
+    },
+    'clarification_customer_buy': {
+        'en': "🏪 Who did you buy from?",
+        'ms': "🏪 Anda beli daripada siapa?"
+    },
+    'clarification_customer_sell': {
+        'en': "👤 Who did you sell to?",
+        'ms': "👤 Anda jual kepada siapa?"
+    },
+    'clarification_payment_to': {
+        'en': "💸 Who did you pay?",
+        'ms': "💸 Anda bayar kepada siapa?"
+    },
+    'clarification_payment_from': {
+        'en': "💰 Who paid you?",
+        'ms': "💰 Siapa yang bayar anda?"
+    },
+    'clarification_prefix': {
+        'en': "I need a bit more information to record this transaction:",
+        'ms': "Saya perlukan sedikit maklumat tambahan untuk merekod transaksi ini:"
+    },
+    'clarification_suffix': {
+        'en': "Please provide the missing details, and I'll record the transaction for you! 📝",
+        'ms': "Sila berikan butiran yang hilang, dan saya akan rekodkan transaksi untuk anda! 📝"
+    },
+    'transaction_saved': {
+        'en': "✅ Transaction recorded successfully!\n\n{summary}",
+        'ms': "✅ Transaksi berjaya direkodkan!\n\n{summary}"
+    },
+    'transaction_error': {
+        'en': "❌ Error saving transaction: {error}",
+        'ms': "❌ Ralat menyimpan transaksi: {error}"
+    },
+    'multiple_transactions': {
+        'en': """🤖 I detected multiple transactions in your message!
 
 For accuracy, please record **one transaction at a time**:
 
@@ -729,7 +1014,7 @@ For accuracy, please record **one transaction at a time**:
 📥 "purchase rm50 sugar"
 
 This helps me record each transaction correctly! 📝""",
-            'ms': """🤖 Saya kesan beberapa transaksi dalam mesej anda!
+        'ms': """🤖 Saya kesan beberapa transaksi dalam mesej anda!
 
 Untuk ketepatan, sila rekod **satu transaksi pada satu masa**:
 
@@ -740,9 +1025,9 @@ Untuk ketepatan, sila rekod **satu transaksi pada satu masa**:
 📥 "beli rm50 gula"
 
 Ini membantu saya merekod setiap transaksi dengan betul! 📝"""
-        },
-        'ambiguous_message': {
-            'en': """🤖 I'm having trouble understanding your message!
+    },
+    'ambiguous_message': {
+        'en': """🤖 I'm having trouble understanding your message!
 
 📝 **Please send clear transaction details like:**
 
@@ -757,7 +1042,7 @@ Ini membantu saya merekod setiap transaksi dengan betul! 📝"""
 • Unclear messages: "???"
 
 💡 **Tip:** Use simple words with amounts and items for best results!""",
-            'ms': """🤖 Saya sukar memahami mesej anda!
+        'ms': """🤖 Saya sukar memahami mesej anda!
 
 📝 **Sila hantar butiran transaksi yang jelas seperti:**
 
@@ -772,9 +1057,9 @@ Ini membantu saya merekod setiap transaksi dengan betul! 📝"""
 • Mesej tidak jelas: "???"
 
 💡 **Tip:** Guna perkataan mudah dengan jumlah dan barang untuk hasil terbaik!"""
-        },
-        'greeting_response': {
-            'en': """👋 Hello! I'm your financial assistant bot!
+    },
+    'greeting_response': {
+        'en': """👋 Hello! I'm your financial assistant bot!
 
 📝 **How to Record Transactions:**
 
@@ -801,7 +1086,7 @@ Ini membantu saya merekod setiap transaksi dengan betul! 📝"""
 • *streak* - Daily logging streak
 
 Just describe your transaction naturally and I'll understand! 🤖✨""",
-            'ms': """👋 Hai! Saya pembantu kewangan bot anda!
+        'ms': """👋 Hai! Saya pembantu kewangan bot anda!
 
 📝 **Cara Rekod Transaksi:**
 
@@ -828,9 +1113,9 @@ Just describe your transaction naturally and I'll understand! 🤖✨""",
 • *streak* - Streak pencatatan harian
 
 Terangkan transaksi anda secara semula jadi dan saya akan faham! 🤖✨"""
-        },
-        'help_response': {
-            'en': """🆘 **Need Help?**
+    },
+    'help_response': {
+        'en': """🆘 **Need Help?**
 
 **📝 Transaction Recording Examples:**
 
@@ -862,7 +1147,7 @@ Just snap a photo of your receipt and send it to me!
 • Be specific about quantities when possible
 
 Ready to track your finances! 💪""",
-            'ms': """🆘 **Perlukan Bantuan?**
+        'ms': """🆘 **Perlukan Bantuan?**
 
 **📝 Contoh Rekod Transaksi:**
 
@@ -894,61 +1179,61 @@ Ambil gambar resit dan hantar kepada saya!
 • Nyatakan kuantiti jika boleh
 
 Sedia untuk jejak kewangan anda! 💪"""
-        },
-        'registration_welcome': {
-            'en': """🎉 Welcome to Aliran Tunai!
+    },
+    'registration_welcome': {
+        'en': """🎉 Welcome to Aliran Tunai!
 
 Before we start tracking your finances, I need to collect some basic information about your business:
 
 This is a **one-time setup** and helps me provide better insights for your specific business! 📊
 
 Let's begin! ✨""",
-            'ms': """🎉 Selamat datang ke Aliran Tunai!
+        'ms': """🎉 Selamat datang ke Aliran Tunai!
 
 Sebelum kita mula jejak kewangan anda, saya perlu kumpul maklumat asas tentang perniagaan anda:
 
 Ini adalah **persediaan sekali sahaja** dan membantu saya beri pandangan yang lebih baik untuk perniagaan anda! 📊
 
 Mari kita mulakan! ✨"""
-        },
-        'registration_email': {
-            'en': "📧 **Step 1/5:** What is your email address?\n\n*This will be used for important notifications and account recovery.*",
-            'ms': "📧 **Langkah 1/5:** Apakah alamat emel anda?\n\n*Ini akan digunakan untuk pemberitahuan penting dan pemulihan akaun.*"
-        },
-        'registration_owner_name': {
-            'en': "👤 **Step 2/5:** What is your name (business owner)?",
-            'ms': "👤 **Langkah 2/5:** Siapakah nama anda (pemilik perniagaan)?"
-        },
-        'registration_company_name': {
-            'en': "🏢 **Step 3/5:** What is your company/business name?",
-            'ms': "🏢 **Langkah 3/5:** Apakah nama syarikat/perniagaan anda?"
-        },
-        'registration_location': {
-            'en': "📍 **Step 4/5:** Where is your business located? (City/State)",
-            'ms': "📍 **Langkah 4/5:** Di manakah lokasi perniagaan anda? (Bandar/Negeri)"
-        },
-        'registration_business_type': {
-            'en': """🏪 **Step 5/5:** What type of business do you run?
+    },
+    'registration_email': {
+        'en': "📧 **Step 1/5:** What is your email address?\n\n*This will be used for important notifications and account recovery.*",
+        'ms': "📧 **Langkah 1/5:** Apakah alamat emel anda?\n\n*Ini akan digunakan untuk pemberitahuan penting dan pemulihan akaun.*"
+    },
+    'registration_owner_name': {
+        'en': "👤 **Step 2/5:** What is your name (business owner)?",
+        'ms': "👤 **Langkah 2/5:** Siapakah nama anda (pemilik perniagaan)?"
+    },
+    'registration_company_name': {
+        'en': "🏢 **Step 3/5:** What is your company/business name?",
+        'ms': "🏢 **Langkah 3/5:** Apakah nama syarikat/perniagaan anda?"
+    },
+    'registration_location': {
+        'en': "📍 **Step 4/5:** Where is your business located? (City/State)",
+        'ms': "📍 **Langkah 4/5:** Di manakah lokasi perniagaan anda? (Bandar/Negeri)"
+    },
+    'registration_business_type': {
+        'en': """🏪 **Step 5/5:** What type of business do you run?
 
 **Examples:** Restaurant, Retail Shop, Freelance Service, Trading, Manufacturing, etc.""",
-            'ms': """🏪 **Langkah 5/5:** Apakah jenis perniagaan yang anda jalankan?
+        'ms': """🏪 **Langkah 5/5:** Apakah jenis perniagaan yang anda jalankan?
 
 **Contoh:** Restoran, Kedai Runcit, Perkhidmatan Freelance, Perdagangan, Pembuatan, dll."""
-        },
-        'personal_registration_name': {
-            'en': """👤 *Personal Information*
+    },
+    'personal_registration_name': {
+        'en': """👤 *Personal Information*
 
 What's your name?
 
 Example: John Doe""",
-            'ms': """👤 *Maklumat Peribadi*
+        'ms': """👤 *Maklumat Peribadi*
 
 Siapakah nama anda?
 
 Contoh: Ahmad Ali"""
-        },
-        'registration_complete': {
-            'en': """✅ **Registration Complete!**
+    },
+    'registration_complete': {
+        'en': """✅ **Registration Complete!**
 
 Welcome aboard, **{owner_name}**! 🎉
 
@@ -961,7 +1246,7 @@ Your business profile:
 You can now start recording your transactions! Just describe them naturally and I'll help you track your finances. 💰
 
 Type *help* anytime for transaction examples! 📝""",
-            'ms': """✅ **Pendaftaran Selesai!**
+        'ms': """✅ **Pendaftaran Selesai!**
 
 Selamat datang, **{owner_name}**! 🎉
 
@@ -974,15 +1259,41 @@ Profil perniagaan anda:
 Anda kini boleh mula merekod transaksi! Huraikan secara semula jadi dan saya akan bantu jejak kewangan anda. 💰
 
 Taip *help* bila-bila masa untuk contoh transaksi! 📝"""
-        }
     }
+}
+
+# Flattened to (key, language) so a lookup is a single probe
+_MESSAGES = {
+    (key, lang): text
+    for key, by_language in _LOCALIZED_MESSAGES.items()
+    for lang, text in by_language.items()
+}
+
+# Only these entries contain placeholders (or brace escapes); the rest are
+# returned as-is even when a caller passes format arguments
+_TEMPLATED_MESSAGES = frozenset(key for key, text in _MESSAGES.items() if '{' in text or '}' in text)
+
+def get_localized_message(message_key: str, language: str = 'en', **kwargs) -> str:
+    """
+    Get localized messages for static bot responses.
+    
+    Args:
+        message_key: The key for the message type
+        language: 'en' for English, 'ms' for Malay
+        **kwargs: Variables to format into the message
     
+    Returns:
+        Formatted message string in the requested language
+    """
     # Get the message for the specified language, fallback to English
-    message_dict = messages.get(message_key, {})
-    message = message_dict.get(language, message_dict.get('en', ''))
+    key = (message_key, language)
+    message = _MESSAGES.get(key)
+    if message is None:
+        key = (message_key, 'en')
+        message = _MESSAGES.get(key, '')
     
     # Format the message with provided variables
-    if kwargs:
+    if kwargs and key in _TEMPLATED_MESSAGES:
         try:
             message = message.format(**kwargs)
         except KeyError as e:
@@ -991,16 +1302,27 @@ Taip *help* bila-bila masa untuk contoh transaksi! 📝"""
     return message
 
 # --- WhatsApp Business API Functions ---
+# One pooled keep-alive session for every Graph API call, so sends reuse
+# the TLS connection instead of handshaking per request. urllib3 only
+# retries idempotent methods on status codes, so a POST is never re-sent
+# after the server has seen it.
+_GRAPH_SESSION = requests.Session()
+_GRAPH_SESSION.mount("https://", HTTPAdapter(
+    pool_connections=10,
+    pool_maxsize=50,
+    max_retries=Retry(total=3, backoff_factor=0.2, status_forcelist=[429, 500, 502, 503, 504]),
+))
+_GRAPH_SESSION.headers.update({"Authorization": f"Bearer {WHATSAPP_ACCESS_TOKEN}"})
+# Version and phone number ID are fixed for the process, so build the URLs once
+GRAPH_API_BASE_URL = f"https://graph.facebook.com/{WHATSAPP_API_VERSION}"
+GRAPH_MESSAGES_URL = f"{GRAPH_API_BASE_URL}/{WHATSAPP_PHONE_NUMBER_ID}/messages"
+# Read receipts and webhook replies are sent from here so the webhook can
+# return its 200 without waiting on Graph API round-trips
+_graph_executor = concurrent.futures.ThreadPoolExecutor(max_workers=16, thread_name_prefix="graph-io")
+
 def send_whatsapp_message(to_number: str, message: str) -> bool:
     """Send a WhatsApp message using the Business API."""
     try:
-        url = f"https://graph.facebook.com/{WHATSAPP_API_VERSION}/{WHATSAPP_PHONE_NUMBER_ID}/messages"
-
-        headers = {
-            "Authorization": f"Bearer {WHATSAPP_ACCESS_TOKEN}",
-            "Content-Type": "application/json"
-        }
-
         payload = {
             "messaging_product": "whatsapp",
             "to": to_number,
@@ -1010,7 +1332,7 @@ def send_whatsapp_message(to_number: str, message: str) -> bool:
             }
         }
 
-        response = requests.post(url, headers=headers, json=payload)
+        response = _GRAPH_SESSION.post(GRAPH_MESSAGES_URL, json=payload)
         response.raise_for_status()
 
         logger.info(f"WhatsApp message sent successfully to {to_number}")
@@ -1023,20 +1345,13 @@ def send_whatsapp_message(to_number: str, message: str) -> bool:
 def mark_message_as_read(message_id: str) -> bool:
     """Mark a WhatsApp message as read."""
     try:
-        url = f"https://graph.facebook.com/{WHATSAPP_API_VERSION}/{WHATSAPP_PHONE_NUMBER_ID}/messages"
-
-        headers = {
-            "Authorization": f"Bearer {WHATSAPP_ACCESS_TOKEN}",
-            "Content-Type": "application/json"
-        }
-
         payload = {
             "messaging_product": "whatsapp",
             "status": "read",
             "message_id": message_id
         }
 
-        response = requests.post(url, headers=headers, json=payload)
+        response = _GRAPH_SESSION.post(GRAPH_MESSAGES_URL, json=payload)
         response.raise_for_status()
 
         return True
@@ -1049,19 +1364,15 @@ def download_whatsapp_media(media_id: str) -> bytes | None:
     """Download media from WhatsApp."""
     try:
         # First get the media URL
-        url = f"https://graph.facebook.com/{WHATSAPP_API_VERSION}/{media_id}"
-
-        headers = {
-            "Authorization": f"Bearer {WHATSAPP_ACCESS_TOKEN}"
-        }
+        url = f"{GRAPH_API_BASE_URL}/{media_id}"
 
-        response = requests.get(url, headers=headers)
+        response = _GRAPH_SESSION.get(url)
         response.raise_for_status()
 
         media_url = response.json().get("url")
 
         # Download the actual media
-        response = requests.get(media_url, headers=headers)
+        response = _GRAPH_SESSION.get(media_url)
         response.raise_for_status()
 
         return response.content
@@ -1070,6 +1381,66 @@ def download_whatsapp_media(media_id: str) -> bytes | None:
         logger.error(f"Failed to download WhatsApp media: {e}")
         return None
 
+def stream_whatsapp_media(media_id: str):
+    """
+    Open a WhatsApp media download as a file-like stream.
+
+    The body is not buffered into memory; the returned object can be handed
+    straight to Image.open(). Returns None if the media could not be opened.
+    """
+    try:
+        url = f"{GRAPH_API_BASE_URL}/{media_id}"
+
+        response = _GRAPH_SESSION.get(url)
+        response.raise_for_status()
+
+        media_url = response.json().get("url")
+
+        # Stream the actual media instead of reading response.content
+        response = _GRAPH_SESSION.get(media_url, stream=True)
+        response.raise_for_status()
+
+        # Let urllib3 undo any gzip/deflate transfer encoding while reading
+        response.raw.decode_content = True
+        return response.raw
+
+    except Exception as e:
+        logger.error(f"Failed to stream WhatsApp media: {e}")
+        return None
+
+# Media is copied in 64KB chunks; anything above the GridFS threshold spills
+# to a temp file instead of staying in memory.
+MEDIA_CHUNK_SIZE = 64 * 1024
+MAX_MEDIA_BYTES = 16 * 1024 * 1024
+
+def spool_whatsapp_media(media_id: str) -> BinaryIO | None:
+    """
+    Download WhatsApp media into a spooled temp file, 64KB at a time.
+
+    Small files stay in memory, large ones roll over to disk. The returned
+    file is rewound to the start. Returns None on failure or oversize media.
+    """
+    stream = stream_whatsapp_media(media_id)
+    if stream is None:
+        return None
+
+    spool = tempfile.SpooledTemporaryFile(max_size=GRIDFS_THRESHOLD)
+    try:
+        while chunk := stream.read(MEDIA_CHUNK_SIZE):
+            spool.write(chunk)
+            if spool.tell() > MAX_MEDIA_BYTES:
+                logger.warning(f"WhatsApp media {media_id} exceeds {MAX_MEDIA_BYTES} bytes, rejecting")
+                spool.close()
+                return None
+        spool.seek(0)
+        return spool
+    except Exception as e:
+        logger.error(f"Failed to download WhatsApp media: {e}")
+        spool.close()
+        return None
+    finally:
+        stream.close()
+
 # --- Utility Functions ---
 def escape_markdown(text):
     """Escape special characters for WhatsApp Markdown."""
@@ -1088,46 +1459,147 @@ def safe_text(text):
     return str(text)
 
 # --- Conversation State Management ---
-# Store pending transactions waiting for clarification
-pending_transactions = {}
+# Transactions waiting for clarification live in MongoDB (pending_collection)
+# so any worker can pick up the user's reply; a TTL index expires them.
+# The in-process cache below only stands in while MongoDB is unavailable,
+# and is bounded so abandoned conversations can't grow memory without limit.
+pending_transactions = TTLCache(maxsize=10000, ttl=PENDING_TRANSACTION_TTL)
+# TTLCache isn't thread-safe and background workers store pending entries too
+_pending_lock = threading.Lock()
 
 def store_pending_transaction(wa_id: str, transaction_data: dict, missing_fields: list) -> None:
     """Store a transaction that needs clarification."""
-    pending_transactions[wa_id] = {
+    pending = {
         'data': transaction_data,
         'missing_fields': missing_fields,
         'timestamp': datetime.now(timezone.utc)
     }
+    if pending_collection is not None:
+        try:
+            pending_collection.replace_one({'_id': wa_id}, pending, upsert=True)
+            # Drop any copy kept during an outage so it can't resurface later
+            with _pending_lock:
+                pending_transactions.pop(wa_id, None)
+            logger.info(f"Stored pending transaction for wa_id {wa_id}: missing {missing_fields}")
+            return
+        except Exception as e:
+            logger.warning(f"Could not store pending transaction in MongoDB, keeping it in memory: {e}")
+
+    with _pending_lock:
+        pending_transactions[wa_id] = pending
     logger.info(f"Stored pending transaction for wa_id {wa_id}: missing {missing_fields}")
 
 def get_pending_transaction(wa_id: str) -> dict | None:
     """Get pending transaction for a user."""
-    return pending_transactions.get(wa_id)
+    if pending_collection is not None:
+        try:
+            # The TTL monitor only runs once a minute, so filter on age as well
+            cutoff = datetime.now(timezone.utc) - timedelta(seconds=PENDING_TRANSACTION_TTL)
+            pending = pending_collection.find_one(
+                {'_id': wa_id, 'timestamp': {'$gt': cutoff}},
+                {'_id': 0}
+            )
+            if pending is not None:
+                return pending
+        except Exception as e:
+            logger.warning(f"Could not read pending transaction from MongoDB: {e}")
+
+    with _pending_lock:
+        return pending_transactions.get(wa_id)
 
 def clear_pending_transaction(wa_id: str) -> None:
     """Clear pending transaction for a user."""
-    if wa_id in pending_transactions:
-        del pending_transactions[wa_id]
+    removed = False
+    if pending_collection is not None:
+        try:
+            removed = pending_collection.delete_one({'_id': wa_id}).deleted_count > 0
+        except Exception as e:
+            logger.warning(f"Could not clear pending transaction in MongoDB: {e}")
+
+    with _pending_lock:
+        removed = pending_transactions.pop(wa_id, None) is not None or removed
+    if removed:
         logger.info(f"Cleared pending transaction for wa_id {wa_id}")
 
+# Registrations in progress and reset confirmations follow the same scheme:
+# one MongoDB document per user keyed by wa_id with a TTL index on timestamp,
+# and a bounded in-process cache only while MongoDB is unavailable
+
+def _store_conversation_state(state_collection, fallback: TTLCache, lock: threading.Lock,
+                              wa_id: str, state: dict) -> None:
+    """Save a user's conversation state, restarting its expiry."""
+    state['timestamp'] = datetime.now(timezone.utc)
+    if state_collection is not None:
+        try:
+            state_collection.replace_one({'_id': wa_id}, state, upsert=True)
+            with lock:
+                fallback.pop(wa_id, None)
+            return
+        except Exception as e:
+            logger.warning(f"Could not store conversation state in MongoDB, keeping it in memory: {e}")
+
+    with lock:
+        fallback[wa_id] = state
+
+def _load_conversation_state(state_collection, fallback: TTLCache, lock: threading.Lock,
+                             wa_id: str, ttl: int, refresh: bool = False) -> dict | None:
+    """Get a user's conversation state; refresh=True also restarts its expiry."""
+    if state_collection is not None:
+        try:
+            now = datetime.now(timezone.utc)
+            # The TTL monitor only runs once a minute, so filter on age as well
+            query = {'_id': wa_id, 'timestamp': {'$gt': now - timedelta(seconds=ttl)}}
+            if refresh:
+                state = state_collection.find_one_and_update(
+                    query, {'$set': {'timestamp': now}},
+                    projection={'_id': 0}, return_document=ReturnDocument.AFTER
+                )
+            else:
+                state = state_collection.find_one(query, {'_id': 0})
+            if state is not None:
+                return state
+        except Exception as e:
+            logger.warning(f"Could not read conversation state from MongoDB: {e}")
+
+    with lock:
+        state = fallback.get(wa_id)
+        if state is not None and refresh:
+            fallback[wa_id] = state
+        return state
+
+def _clear_conversation_state(state_collection, fallback: TTLCache, lock: threading.Lock, wa_id: str) -> None:
+    """Drop a user's conversation state."""
+    if state_collection is not None:
+        try:
+            state_collection.delete_one({'_id': wa_id})
+        except Exception as e:
+            logger.warning(f"Could not clear conversation state in MongoDB: {e}")
+
+    with lock:
+        fallback.pop(wa_id, None)
+
+# Prepositions that introduce a vendor/customer, matched as whole words
+_CLARIFY_VENDOR_KW = frozenset({'dari', 'from', 'kepada', 'to', 'dengan', 'with'})
+# Transaction verbs, matched as substrings so 'bayaran' or 'payment' count too
+_CLARIFY_TX_RE = re.compile(r'beli|jual|bayar|buy|sell|pay|purchase|sale')
+
 def is_clarification_response(text: str, missing_fields: list) -> bool:
     """Check if the message is likely a clarification response."""
     # Simple heuristics to detect clarification responses
     text_lower = text.lower()
+    words = text_lower.split()
 
     # If user is providing vendor/customer info
     if 'customer/vendor' in missing_fields:
-        vendor_keywords = ['dari', 'from', 'kepada', 'to', 'dengan', 'with']
-        if any(keyword in text_lower for keyword in vendor_keywords):
+        if not _CLARIFY_VENDOR_KW.isdisjoint(words):
             return True
 
     # If user is providing just an item name or amount (short responses)
-    if len(text.split()) <= 5:  # Short responses are likely clarifications
+    if len(words) <= 5:  # Short responses are likely clarifications
         return True
 
     # If user is not using transaction keywords, likely a clarification
-    transaction_keywords = ['beli', 'jual', 'bayar', 'buy', 'sell', 'pay', 'purchase', 'sale']
-    if not any(keyword in text_lower for keyword in transaction_keywords):
+    if not _CLARIFY_TX_RE.search(text_lower):
         return True
 
     return False
@@ -1150,58 +1622,56 @@ def update_user_streak(wa_id: str) -> dict:
             return {"streak": 0, "is_new": False, "updated": False, "error": True}
 
     try:
-        today = datetime.now(timezone.utc).strftime("%Y-%m-%d")
-
-        # Find user's existing data
-        user_data = users_collection.find_one({"wa_id": wa_id})
+        # last_log_date is a BSON date at UTC midnight, so days compare directly
+        today = datetime.now(timezone.utc).replace(hour=0, minute=0, second=0, microsecond=0)
+        yesterday = today - timedelta(days=1)
+
+        # One atomic round-trip: the pipeline works out the new streak from
+        # the stored last_log_date, and the pre-update document tells us
+        # which branch was taken. Concurrent messages can't double-count.
+        user_data = users_collection.find_one_and_update(
+            {"wa_id": wa_id},
+            [{"$set": {
+                "streak": {"$switch": {
+                    "branches": [
+                        # Already logged today, no change
+                        {"case": {"$eq": ["$last_log_date", today]}, "then": "$streak"},
+                        # Consecutive day, increment streak
+                        {"case": {"$eq": ["$last_log_date", yesterday]},
+                         "then": {"$add": [{"$ifNull": ["$streak", 0]}, 1]}},
+                    ],
+                    # New user, no last_log_date, or streak broken
+                    "default": 1
+                }},
+                "last_log_date": today
+            }}],
+            projection={"_id": 0, "streak": 1, "last_log_date": 1},
+            upsert=True,
+            return_document=ReturnDocument.BEFORE
+        )
 
         if not user_data:
-            # New user - start streak at 1
-            new_user = {
-                "wa_id": wa_id,
-                "streak": 1,
-                "last_log_date": today
-            }
-            users_collection.insert_one(new_user)
             logger.info(f"Created new user streak for wa_id {wa_id}")
             return {"streak": 1, "is_new": True, "updated": True}
 
-        last_log_date = user_data.get("last_log_date", "")
+        last_log_date = user_data.get("last_log_date")
         current_streak = user_data.get("streak", 0)
 
-        if not last_log_date:
-            # User exists but no last_log_date, treat as new
-            users_collection.update_one(
-                {"wa_id": wa_id},
-                {"$set": {"streak": 1, "last_log_date": today}}
-            )
+        if not isinstance(last_log_date, datetime):
+            # User existed but had no last_log_date, treated as new
             return {"streak": 1, "is_new": True, "updated": True}
 
-        # Calculate date difference
-        from datetime import datetime as dt
-        last_date = dt.strptime(last_log_date, "%Y-%m-%d")
-        today_date = dt.strptime(today, "%Y-%m-%d")
-        day_diff = (today_date - last_date).days
-
-        if day_diff == 0:
+        # PyMongo hands dates back naive, so compare calendar days
+        last_log_date = last_log_date.date()
+        if last_log_date == today.date():
             # Already logged today, no update needed
             return {"streak": current_streak, "is_new": False, "updated": False}
-        elif day_diff == 1:
-            # Consecutive day, increment streak
+        elif last_log_date == yesterday.date():
             new_streak = current_streak + 1
-            users_collection.update_one(
-                {"wa_id": wa_id},
-                {"$set": {"streak": new_streak, "last_log_date": today}}
-            )
             logger.info(f"Incremented streak for wa_id {wa_id} to {new_streak}")
             return {"streak": new_streak, "is_new": False, "updated": True}
         else:
-            # Streak broken, reset to 1
-            users_collection.update_one(
-                {"wa_id": wa_id},
-                {"$set": {"streak": 1, "last_log_date": today}}
-            )
-            logger.info(f"Reset streak for wa_id {wa_id} (gap of {day_diff} days)")
+            logger.info(f"Reset streak for wa_id {wa_id} (last logged {last_log_date})")
             return {"streak": 1, "is_new": False, "updated": True, "was_broken": True}
 
     except Exception as e:
@@ -1225,11 +1695,13 @@ def get_user_streak(wa_id: str) -> dict:
             return {"streak": 0, "last_log_date": "", "exists": False, "error": True}
 
     try:
-        user_data = users_collection.find_one({"wa_id": wa_id})
+        user_data = users_collection.find_one({"wa_id": wa_id}, {"_id": 0, "streak": 1, "last_log_date": 1})
         if user_data:
+            last_log_date = user_data.get("last_log_date")
             return {
                 "streak": user_data.get("streak", 0),
-                "last_log_date": user_data.get("last_log_date", ""),
+                # Callers expect the "%Y-%m-%d" form
+                "last_log_date": last_log_date.date().isoformat() if isinstance(last_log_date, datetime) else "",
                 "exists": True
             }
         else:
@@ -1239,8 +1711,27 @@ def get_user_streak(wa_id: str) -> dict:
         return {"streak": 0, "last_log_date": "", "exists": False, "error": True}
 
 # --- User Registration Management ---
-# Store pending registrations
-pending_registrations = {}
+# Registrations in progress live in MongoDB (registration_collection) so any
+# worker can handle the next reply; this cache only stands in during an outage
+pending_registrations = TTLCache(maxsize=10000, ttl=PENDING_REGISTRATION_TTL)
+_registration_lock = threading.Lock()
+
+def store_pending_registration(wa_id: str, registration: dict) -> None:
+    """Save a user's registration progress."""
+    _store_conversation_state(registration_collection, pending_registrations, _registration_lock, wa_id, registration)
+
+def get_pending_registration(wa_id: str, refresh: bool = False) -> dict | None:
+    """Get a user's registration in progress, if any."""
+    return _load_conversation_state(registration_collection, pending_registrations, _registration_lock,
+                                    wa_id, PENDING_REGISTRATION_TTL, refresh)
+
+def clear_pending_registration(wa_id: str) -> None:
+    """Drop a user's registration in progress."""
+    _clear_conversation_state(registration_collection, pending_registrations, _registration_lock, wa_id)
+
+# Only the fields is_user_registered inspects
+REGISTRATION_PROJECTION = {'_id': 0, 'mode': 1, 'email': 1, 'owner_name': 1, 'company_name': 1,
+                           'location': 1, 'business_type': 1, 'name': 1, 'monthly_budget': 1}
 
 def is_user_registered(wa_id: str) -> bool:
     """Check if user is already registered in the system."""
@@ -1253,7 +1744,7 @@ def is_user_registered(wa_id: str) -> bool:
             return False
     
     try:
-        user_data = users_collection.find_one({"wa_id": wa_id})
+        user_data = users_collection.find_one({"wa_id": wa_id}, REGISTRATION_PROJECTION)
         
         if not user_data:
             return False
@@ -1288,7 +1779,7 @@ def get_user_mode(wa_id: str) -> str:
             return 'business'  # Default fallback
     
     try:
-        user_data = users_collection.find_one({"wa_id": wa_id})
+        user_data = users_collection.find_one({"wa_id": wa_id}, {"_id": 0, "mode": 1})
         return user_data.get('mode', 'business') if user_data else 'business'
     except Exception as e:
         logger.error(f"Error getting user mode for wa_id {wa_id}: {e}")
@@ -1303,21 +1794,42 @@ def get_user_language(wa_id: str) -> str:
             return 'en'  # Default fallback
     
     try:
-        user_data = users_collection.find_one({"wa_id": wa_id})
+        user_data = users_collection.find_one({"wa_id": wa_id}, {"_id": 0, "language": 1})
         return user_data.get('language', 'en') if user_data else 'en'
     except Exception as e:
         logger.error(f"Error getting user language for wa_id {wa_id}: {e}")
         return 'en'  # Default fallback
 
+def get_user_report_context(wa_id: str) -> tuple[str, str, str | None]:
+    """Get the user's mode, preferred language and report version from a single lookup.
+
+    The version is None when it can't be read, which disables report caching.
+    """
+    global users_collection
+    
+    if users_collection is None:
+        if not connect_to_mongodb():
+            return 'business', 'en', None  # Default fallback
+    
+    try:
+        user_data = users_collection.find_one(
+            {"wa_id": wa_id}, {"_id": 0, "mode": 1, "language": 1, "report_version": 1}
+        ) or {}
+        # Users who have never saved anything have no version yet
+        version = str(user_data.get('report_version', ''))
+        return user_data.get('mode', 'business'), user_data.get('language', 'en'), version
+    except Exception as e:
+        logger.error(f"Error getting user mode and language for wa_id {wa_id}: {e}")
+        return 'business', 'en', None  # Default fallback
+
 def start_user_registration(wa_id: str, user_language: str) -> str:
     """Start the user registration process with mode selection."""
     # Initialize registration data with mode selection step
-    pending_registrations[wa_id] = {
+    store_pending_registration(wa_id, {
         'step': 0,  # Start with step 0 (mode selection)
         'data': {},
         'language': user_language,
-        'timestamp': datetime.now(timezone.utc)
-    }
+    })
     
     logger.info(f"Started registration process for wa_id {wa_id}")
     
@@ -1361,11 +1873,22 @@ Please choose: *1* or *2*"""
 
 def handle_registration_step(wa_id: str, message_body: str) -> str:
     """Handle each step of the registration process."""
-    if wa_id not in pending_registrations:
-        # Registration not started, this shouldn't happen
+    # Refreshing on read makes the expiry count from the user's latest reply
+    registration = get_pending_registration(wa_id, refresh=True)
+    if registration is None:
+        # Registration not started (or expired), start over
         return start_user_registration(wa_id, detect_language(message_body))
-    
-    registration = pending_registrations[wa_id]
+
+    current_step = registration['step']
+    reply = _advance_registration(wa_id, registration, message_body)
+    # Completed registrations are cleared without moving the step, so only
+    # progress is written back
+    if registration['step'] != current_step:
+        store_pending_registration(wa_id, registration)
+    return reply
+
+def _advance_registration(wa_id: str, registration: dict, message_body: str) -> str:
+    """Apply the user's reply to the current registration step, updating registration in place."""
     current_step = registration['step']
     user_language = registration['language']
     registration_data = registration['data']
@@ -1427,7 +1950,7 @@ def handle_registration_step(wa_id: str, message_body: str) -> str:
         
         if success:
             # Clear pending registration
-            del pending_registrations[wa_id]
+            clear_pending_registration(wa_id)
             
             # Return completion message
             return get_localized_message('registration_complete', user_language, 
@@ -1481,7 +2004,7 @@ def handle_registration_step(wa_id: str, message_body: str) -> str:
             
             if success:
                 # Clear pending registration
-                del pending_registrations[wa_id]
+                clear_pending_registration(wa_id)
                 
                 # Return completion message for personal user
                 if user_language == 'ms':
@@ -1615,7 +2138,7 @@ def save_personal_registration(wa_id: str, registration_data: dict) -> bool:
 
 def is_in_registration_process(wa_id: str) -> bool:
     """Check if user is currently in the registration process."""
-    return wa_id in pending_registrations
+    return get_pending_registration(wa_id) is not None
 
 def validate_email(email: str) -> bool:
     """Validate email format using basic regex pattern."""
@@ -1796,8 +2319,64 @@ def parse_transaction_with_regex_legacy(text: str) -> dict | None:
     
     return {'success': False, 'data': None}
 
+# --- AI Parse Cache ---
+# Users often resend the same message or receipt; identical inputs reuse the
+# parsed result instead of paying another OpenAI round-trip.
+AI_PARSE_CACHE_TTL = 24 * 3600  # seconds
+_ai_parse_cache = TTLCache(maxsize=1024, ttl=AI_PARSE_CACHE_TTL)
+_ai_parse_lock = threading.Lock()
+
+def _ai_parse_key(kind: str, payload: str | bytes) -> str:
+    """Hash the parser kind and its exact input into a cache key."""
+    if isinstance(payload, str):
+        payload = payload.encode()
+    return hashlib.blake2b(kind.encode() + b'|' + payload, digest_size=16).hexdigest()
+
+def _lookup_ai_parse(key: str) -> dict | None:
+    """Return a copy of a cached parse result; callers mutate what they get."""
+    with _ai_parse_lock:
+        result = _ai_parse_cache.get(key)
+    return copy.deepcopy(result) if result is not None else None
+
+def _remember_ai_parse(key: str, result: dict) -> None:
+    """Cache a successful parse result."""
+    if "error" in result:
+        return
+    with _ai_parse_lock:
+        _ai_parse_cache[key] = copy.deepcopy(result)
+
+def _cached_ai_parse(kind: str, payload: str | bytes, parse) -> dict:
+    """Run parse(payload) unless an identical input was parsed recently."""
+    key = _ai_parse_key(kind, payload)
+    result = _lookup_ai_parse(key)
+    if result is not None:
+        logger.info(f"Reusing cached {kind} parse result")
+        return result
+    result = parse(payload)
+    _remember_ai_parse(key, result)
+    return result
+
 # --- Core AI Function ---
+# System prompts only vary by detected language, so build both once
+_TX_SYSTEM_PROMPT = """Extract transaction details from user message.
+Required fields: action, amount, items, customer/vendor, terms, description, category.
+
+Actions: "sale", "purchase", "payment_received", "payment_made"
+Categories (purchases only): OPEX, CAPEX, COGS, INVENTORY, MARKETING, UTILITIES, OTHER
+Language: LANGUAGE_TOKEN (match description language)
+
+IMPORTANT: Only classify as "payment_received" if it's clearly INCOME from these words only: gaji, salary, income, pendapatan, elaun, allowance, payment (received). 
+Bills, tolls, utilities are always "purchase" or "payment_made", never income.
+
+Return JSON only."""
+_TX_SYSTEM_PROMPTS = {lang: _TX_SYSTEM_PROMPT.replace("LANGUAGE_TOKEN", lang) for lang in ('en', 'ms')}
+
 def parse_transaction_with_ai(text: str) -> dict:
+    """Parse a transaction message with OpenAI, reusing results for repeated messages."""
+    # Only whitespace is normalized; case can matter for names in the description
+    return _cached_ai_parse('text', ' '.join(text.split()), _parse_transaction_with_ai_uncached)
+
+def _parse_transaction_with_ai_uncached(text: str) -> dict:
     logger.info(f"Sending text to OpenAI for parsing and categorization: '{text}'")
     
     # Check if OpenAI client is initialized
@@ -1808,20 +2387,16 @@ def parse_transaction_with_ai(text: str) -> dict:
     # Detect the language of the input text
     user_language = detect_language(text)
     
-    system_prompt = f"""Extract transaction details from user message.
-Required fields: action, amount, items, customer/vendor, terms, description, category.
-
-Actions: "sale", "purchase", "payment_received", "payment_made"
-Categories (purchases only): OPEX, CAPEX, COGS, INVENTORY, MARKETING, UTILITIES, OTHER
-Language: {user_language} (match description language)
-
-IMPORTANT: Only classify as "payment_received" if it's clearly INCOME from these words only: gaji, salary, income, pendapatan, elaun, allowance, payment (received). 
-Bills, tolls, utilities are always "purchase" or "payment_made", never income.
-
-Return JSON only."""
+    if AI_PARSE_BATCH_WINDOW > 0:
+        result = _parse_transaction_batched(text, user_language)
+        if result is not None:
+            return result
+        # The batched reply was rejected or failed; parse it on its own below
+    
+    system_prompt = _TX_SYSTEM_PROMPTS[user_language]
     
     try:
-        response = openai_client.chat.completions.create(
+        response = create_chat_completion(
             model="gpt-4o-mini",
             messages=[
                 {"role": "system", "content": system_prompt},
@@ -1836,7 +2411,7 @@ Return JSON only."""
             logger.error("OpenAI returned None as response content")
             return {"error": "No response from OpenAI"}
             
-        result = json.loads(result_json)
+        result = json_loads(result_json)
         
         # Add the detected language to the result for later use
         result['detected_language'] = user_language
@@ -1846,30 +2421,183 @@ Return JSON only."""
         logger.error(f"Error calling OpenAI: {e}")
         return {"error": str(e)}
 
-def categorize_purchase_with_ai(description, vendor=None, amount=None):
-    """Use OpenAI to categorize a purchase transaction."""
-    if not OPENAI_API_KEY or openai_client is None:
-        logger.warning("OpenAI not configured, returning default category")
-        return "OTHER"
-    
+# --- AI Parse Micro-Batching ---
+# With AI_PARSE_BATCH_WINDOW_MS set, text parses arriving within the window
+# share one request per language instead of each sending the system prompt.
+# Off by default, since every parse then waits up to the window. A batch holds
+# different users' messages (one user's messages are handled in order, so a
+# per-user batch would never fill); a reply that doesn't echo back exactly the
+# ids that were sent, each once, is discarded and every message in the batch
+# is parsed on its own.
+AI_PARSE_BATCH_WINDOW = int(os.getenv("AI_PARSE_BATCH_WINDOW_MS", "0")) / 1000  # seconds
+AI_PARSE_BATCH_SIZE = 20
+
+_BATCH_TX_INSTRUCTIONS = """
+
+The user message is a JSON array of separate messages, each {"id": ..., "text": ...}.
+Extract each one independently and return {"results": [{"id": <same id>, ...fields}]} with one entry per message."""
+
+_parse_batches: dict[str, list] = {'en': [], 'ms': []}
+_parse_batch_timers: dict = {'en': None, 'ms': None}
+_parse_batch_lock = threading.Lock()
+
+def _flush_parse_batch(user_language: str) -> None:
+    """Parse all queued texts for one language in a single request and resolve their futures."""
+    with _parse_batch_lock:
+        items = _parse_batches[user_language]
+        _parse_batches[user_language] = []
+        if _parse_batch_timers[user_language] is not None:
+            _parse_batch_timers[user_language].cancel()
+            _parse_batch_timers[user_language] = None
+
+    if not items:
+        return
+
+    by_id = {}
     try:
-        # Create a shortened prompt for categorization
-        prompt = f"""Categorize: {description} (${amount or 'N/A'})
-Categories: OPEX, CAPEX, COGS, INVENTORY, MARKETING, UTILITIES, OTHER
-Return code only:"""
-        
-        response = openai_client.chat.completions.create(
+        response = create_chat_completion(
             model="gpt-4o-mini",
             messages=[
-                {"role": "system", "content": "Categorize expenses. Return code only."},
-                {"role": "user", "content": prompt}
+                {"role": "system", "content": _TX_SYSTEM_PROMPTS[user_language] + _BATCH_TX_INSTRUCTIONS},
+                {"role": "user", "content": json.dumps([{"id": str(i), "text": text} for i, (text, _) in enumerate(items)],
+                                                       ensure_ascii=False)}
             ],
-            max_completion_tokens=50,
-            temperature=0.1
+            response_format={"type": "json_object"}
         )
-        
-        category = response.choices[0].message.content.strip().upper()
-        
+        results = json_loads(response.choices[0].message.content or '{}').get('results')
+        expected = sorted(str(i) for i in range(len(items)))
+        if (isinstance(results, list) and all(isinstance(r, dict) for r in results)
+                and sorted(str(r.get('id')) for r in results) == expected):
+            by_id = {str(r.pop('id')): r for r in results}
+            logger.info(f"Batched AI parse returned all {len(items)} results")
+        else:
+            logger.warning(f"Batched AI parse reply doesn't match the {len(items)} messages sent, parsing individually")
+    except Exception as e:
+        logger.error(f"Error in batched AI parse of {len(items)} messages: {e}")
+
+    for i, (_, future) in enumerate(items):
+        result = by_id.get(str(i))
+        if result is not None:
+            result['detected_language'] = user_language
+        future.set_result(result)
+
+def _parse_transaction_batched(text: str, user_language: str) -> dict | None:
+    """Queue text for the next batched parse. None means it should be parsed on its own."""
+    future = concurrent.futures.Future()
+    with _parse_batch_lock:
+        batch = _parse_batches[user_language]
+        batch.append((text, future))
+        flush_now = len(batch) >= AI_PARSE_BATCH_SIZE
+        if not flush_now and _parse_batch_timers[user_language] is None:
+            timer = threading.Timer(AI_PARSE_BATCH_WINDOW, _flush_parse_batch, args=(user_language,))
+            timer.daemon = True
+            timer.start()
+            _parse_batch_timers[user_language] = timer
+
+    if flush_now:
+        _flush_parse_batch(user_language)
+
+    try:
+        return future.result(timeout=AI_PARSE_BATCH_WINDOW + 60)
+    except concurrent.futures.TimeoutError:
+        logger.warning("Batched AI parse timed out, parsing individually")
+        return None
+
+# --- Purchase Category Cache ---
+# The same vendor/item combinations come up again and again, so AI categories
+# are kept in a bounded in-process TTL cache backed by the category_cache
+# collection (which survives restarts).
+CATEGORY_CACHE_MAXSIZE = 4096
+
+_category_cache: "OrderedDict[str, tuple[str, float]]" = OrderedDict()
+_category_cache_lock = threading.Lock()
+_NON_ALNUM_RE = re.compile(r'[\W_]+')
+
+def _category_cache_key(description, vendor=None) -> str:
+    """Hash the normalized vendor and description into a cache key."""
+    vendor_norm = _NON_ALNUM_RE.sub('', str(vendor or '').lower())
+    desc_norm = _NON_ALNUM_RE.sub('', str(description or '').lower())
+    return hashlib.blake2b(f"{vendor_norm}|{desc_norm}".encode(), digest_size=16).hexdigest()
+
+def _remember_category(key: str, category: str, persist: bool = True) -> None:
+    """Store a category in the in-process cache and optionally in MongoDB."""
+    with _category_cache_lock:
+        _category_cache[key] = (category, time.monotonic() + CATEGORY_CACHE_TTL)
+        _category_cache.move_to_end(key)
+        while len(_category_cache) > CATEGORY_CACHE_MAXSIZE:
+            _category_cache.popitem(last=False)
+
+    if persist and category_cache_collection is not None:
+        try:
+            category_cache_collection.update_one(
+                {'_id': key},
+                {'$set': {'category': category, 'updated_at': datetime.now(timezone.utc)}},
+                upsert=True
+            )
+        except Exception as e:
+            logger.warning(f"Could not persist category cache entry: {e}")
+
+def _lookup_category(key: str) -> str | None:
+    """Return a cached category from memory, falling back to MongoDB."""
+    with _category_cache_lock:
+        entry = _category_cache.get(key)
+        if entry is not None:
+            if entry[1] > time.monotonic():
+                _category_cache.move_to_end(key)
+                return entry[0]
+            del _category_cache[key]
+
+    if category_cache_collection is not None:
+        try:
+            doc = category_cache_collection.find_one({'_id': key}, {'category': 1})
+            if doc:
+                _remember_category(key, doc['category'], persist=False)
+                return doc['category']
+        except Exception as e:
+            logger.warning(f"Category cache lookup failed: {e}")
+
+    return None
+
+def categorize_purchase_with_ai(description, vendor=None, amount=None):
+    """Use OpenAI to categorize a purchase transaction, reusing cached results."""
+    if not OPENAI_API_KEY or openai_client is None:
+        logger.warning("OpenAI not configured, returning default category")
+        return "OTHER"
+
+    key = _category_cache_key(description, vendor)
+    category = _lookup_category(key)
+    if category is not None:
+        logger.info(f"Category cache hit: {category}")
+        return category
+
+    category = _categorize_purchase_uncached(description, amount)
+    if category is None:
+        # Don't cache failed AI calls
+        return "OTHER"
+
+    _remember_category(key, category)
+    return category
+
+def _categorize_purchase_uncached(description, amount=None):
+    """Ask OpenAI for a purchase category. Returns None if the call fails."""
+    try:
+        # Create a shortened prompt for categorization
+        prompt = f"""Categorize: {description} (${amount or 'N/A'})
+Categories: OPEX, CAPEX, COGS, INVENTORY, MARKETING, UTILITIES, OTHER
+Return code only:"""
+        
+        response = create_chat_completion(
+            model="gpt-4o-mini",
+            messages=[
+                {"role": "system", "content": "Categorize expenses. Return code only."},
+                {"role": "user", "content": prompt}
+            ],
+            max_completion_tokens=50,
+            temperature=0.1
+        )
+        
+        category = response.choices[0].message.content.strip().upper()
+        
         # Validate that the returned category is one of our expected categories
         valid_categories = ['OPEX', 'CAPEX', 'COGS', 'INVENTORY', 'MARKETING', 'UTILITIES', 'OTHER']
         if category in valid_categories:
@@ -1881,22 +2609,55 @@ Return code only:"""
             
     except Exception as e:
         logger.error(f"Error calling OpenAI API for categorization: {e}")
-        return "OTHER"
+        return None
 
 # --- Image Processing Functions ---
-def preprocess_image_for_ocr(image_bytes: bytes):
-    """Preprocess image to improve OCR accuracy using PIL only."""
+# Longest edge, in pixels, of a receipt image sent for OCR/Vision. Plenty for
+# receipt text, and OpenAI downsizes anything larger on its side anyway.
+MAX_RECEIPT_IMAGE_SIDE = 2000
+
+def downscale_image_bytes(image_bytes: bytes, max_side: int = MAX_RECEIPT_IMAGE_SIDE) -> bytes:
+    """
+    Shrink an encoded image so its longest edge is at most max_side pixels.
+
+    Returns JPEG bytes when the image was resized; images already small
+    enough, or that can't be decoded, are returned unchanged.
+    """
     try:
-        # Convert bytes to PIL Image
         pil_image = Image.open(io.BytesIO(image_bytes))
+        if max(pil_image.size) <= max_side:
+            return image_bytes
+        pil_image.thumbnail((max_side, max_side), Image.LANCZOS)
+        output = io.BytesIO()
+        pil_image.convert('RGB').save(output, format='JPEG', quality=85)
+        return output.getvalue()
+    except Exception as e:
+        logger.warning(f"Could not downscale image, using original: {e}")
+        return image_bytes
+
+def preprocess_image_for_ocr(image_file):
+    """
+    Preprocess image to improve OCR accuracy using PIL only.
+
+    image_file is a binary file-like object (e.g. from stream_whatsapp_media);
+    raw bytes are still accepted for existing callers.
+    """
+    try:
+        # PIL reads file-like objects directly, so only wrap raw bytes
+        if isinstance(image_file, (bytes, bytearray)):
+            image_file = io.BytesIO(image_file)
+        pil_image = Image.open(image_file)
+
+        # OCR accuracy peaks well below phone-camera resolution and its cost
+        # grows with pixel count, so shrink big photos (in colour) first
+        if max(pil_image.size) > MAX_RECEIPT_IMAGE_SIDE:
+            pil_image.thumbnail((MAX_RECEIPT_IMAGE_SIDE, MAX_RECEIPT_IMAGE_SIDE), Image.LANCZOS)
 
         if CV2_AVAILABLE:
             # Use OpenCV if available
-            # Convert PIL to OpenCV format
-            opencv_image = cv2.cvtColor(np.array(pil_image), cv2.COLOR_RGB2BGR)
-
-            # Convert to grayscale
-            gray = cv2.cvtColor(opencv_image, cv2.COLOR_BGR2GRAY)
+            # Convert to grayscale in one pass; PIL's 'L' conversion uses the
+            # same ITU-R 601 weights as cv2 and also handles RGBA/palette input
+            gray = np.asarray(pil_image.convert('L'))
 
             # Apply Gaussian blur to reduce noise
             blurred = cv2.GaussianBlur(gray, (5, 5), 0)
@@ -1910,9 +2671,12 @@ def preprocess_image_for_ocr(image_bytes: bytes):
             # Convert to grayscale
             gray_image = pil_image.convert('L')
 
-            # Apply contrast enhancement
-            enhancer = ImageEnhance.Contrast(gray_image)
-            enhanced_image = enhancer.enhance(2.0)
+            # Apply contrast enhancement (x2 around the mean grey level) as a
+            # single lookup-table pass; same output as ImageEnhance.Contrast
+            # without building and blending a second full-size image
+            histogram = gray_image.histogram()
+            mean = int(sum(i * count for i, count in enumerate(histogram)) / (gray_image.width * gray_image.height) + 0.5)
+            enhanced_image = gray_image.point([min(255, max(0, int(mean + 2.0 * (v - mean)))) for v in range(256)])
 
             # Apply sharpening filter
             sharpened_image = enhanced_image.filter(ImageFilter.SHARPEN)
@@ -1923,20 +2687,20 @@ def preprocess_image_for_ocr(image_bytes: bytes):
         logger.error(f"Error preprocessing image: {e}")
         raise
 
-def extract_text_from_image(image_bytes: bytes) -> str:
-    """Extract text from image using GPT Vision."""
+def extract_text_from_image(image_bytes: bytes, image_base64: str | None = None) -> str:
+    """Extract text from image using GPT Vision; image_base64 skips re-encoding."""
     if openai_client is None:
         logger.warning("OpenAI Vision not available - client not initialized")
         return ""
 
     try:
         # Convert image bytes to base64
-        import base64
-        image_base64 = base64.b64encode(image_bytes).decode('utf-8')
+        if image_base64 is None:
+            image_base64 = base64.b64encode(image_bytes).decode('utf-8')
         
         logger.info("Using GPT Vision to extract text from image...")
         
-        response = openai_client.chat.completions.create(
+        response = create_chat_completion(
             model="gpt-4o-mini",
             messages=[
                 {
@@ -1971,7 +2735,12 @@ def extract_text_from_image(image_bytes: bytes) -> str:
         logger.error(f"Error extracting text from image using GPT Vision: {e}")
         return ""
 
-def parse_receipt_with_vision(image_bytes: bytes) -> dict:
+def parse_receipt_with_vision(image_bytes: bytes, image_base64: str | None = None) -> dict:
+    """Parse receipt image directly using GPT Vision, reusing results for re-sent images."""
+    parse = functools.partial(_parse_receipt_with_vision_uncached, image_base64=image_base64)
+    return _cached_ai_parse('vision', image_bytes, parse)
+
+def _parse_receipt_with_vision_uncached(image_bytes: bytes, image_base64: str | None = None) -> dict:
     """Parse receipt image directly using GPT Vision to extract transaction details."""
     if openai_client is None:
         logger.warning("OpenAI Vision not available - client not initialized")
@@ -1979,8 +2748,8 @@ def parse_receipt_with_vision(image_bytes: bytes) -> dict:
 
     try:
         # Convert image bytes to base64
-        import base64
-        image_base64 = base64.b64encode(image_bytes).decode('utf-8')
+        if image_base64 is None:
+            image_base64 = base64.b64encode(image_bytes).decode('utf-8')
         
         logger.info("Using GPT Vision to parse receipt directly...")
         
@@ -2023,7 +2792,7 @@ def parse_receipt_with_vision(image_bytes: bytes) -> dict:
         Return the result ONLY as a JSON object.
         """
         
-        response = openai_client.chat.completions.create(
+        response = create_chat_completion(
             model="gpt-4o-mini",
             messages=[
                 {
@@ -2053,7 +2822,7 @@ def parse_receipt_with_vision(image_bytes: bytes) -> dict:
         result_json = response.choices[0].message.content
         if result_json:
             logger.info(f"GPT Vision parsed receipt: {result_json}")
-            result = json.loads(result_json)
+            result = json_loads(result_json)
             result['detected_language'] = user_language
             return result
         else:
@@ -2064,19 +2833,7 @@ def parse_receipt_with_vision(image_bytes: bytes) -> dict:
         logger.error(f"Error parsing receipt with GPT Vision: {e}")
         return {"error": str(e)}
 
-def parse_receipt_with_ai(extracted_text: str) -> dict:
-    """Parse receipt text using AI to extract transaction details."""
-    logger.info(f"Sending receipt text to OpenAI for parsing: '{extracted_text[:200]}...'")
-    
-    # Check if OpenAI client is initialized
-    if openai_client is None:
-        logger.error("OpenAI client not initialized")
-        return {"error": "OpenAI client not available"}
-    
-    # Detect the language of the receipt text
-    user_language = detect_language(extracted_text)
-    
-    system_prompt = """
+_RECEIPT_TEXT_SYSTEM_PROMPT = """
     You are an expert at parsing receipts and invoices. Extract transaction details AND categorize purchases from the receipt text provided.
 
     Extract the following fields:
@@ -2118,10 +2875,29 @@ def parse_receipt_with_ai(extracted_text: str) -> dict:
     If it's an invoice sent to a customer, it's usually a "sale".
 
     Return the result ONLY as a JSON object.
-    """.replace("LANGUAGE_TOKEN", user_language)
+    """
+_RECEIPT_TEXT_SYSTEM_PROMPTS = {lang: _RECEIPT_TEXT_SYSTEM_PROMPT.replace("LANGUAGE_TOKEN", lang) for lang in ('en', 'ms')}
+
+def parse_receipt_with_ai(extracted_text: str) -> dict:
+    """Parse receipt text using AI, reusing results for identical text."""
+    return _cached_ai_parse('receipt_text', extracted_text, _parse_receipt_with_ai_uncached)
+
+def _parse_receipt_with_ai_uncached(extracted_text: str) -> dict:
+    """Parse receipt text using AI to extract transaction details."""
+    logger.info(f"Sending receipt text to OpenAI for parsing: '{extracted_text[:200]}...'")
+    
+    # Check if OpenAI client is initialized
+    if openai_client is None:
+        logger.error("OpenAI client not initialized")
+        return {"error": "OpenAI client not available"}
+    
+    # Detect the language of the receipt text
+    user_language = detect_language(extracted_text)
+    
+    system_prompt = _RECEIPT_TEXT_SYSTEM_PROMPTS[user_language]
     
     try:
-        response = openai_client.chat.completions.create(
+        response = create_chat_completion(
             model="gpt-4o-mini",
             messages=[
                 {"role": "system", "content": system_prompt},
@@ -2136,7 +2912,7 @@ def parse_receipt_with_ai(extracted_text: str) -> dict:
             logger.error("OpenAI returned None as response content")
             return {"error": "No response from OpenAI"}
             
-        result = json.loads(result_json)
+        result = json_loads(result_json)
         
         # Add the detected language to the result for later use
         result['detected_language'] = user_language
@@ -2146,62 +2922,78 @@ def parse_receipt_with_ai(extracted_text: str) -> dict:
         logger.error(f"Error calling OpenAI for receipt parsing: {e}")
         return {"error": str(e)}
 
-def generate_ai_response(text: str, wa_id: str) -> str:
-    """Generate AI response for general queries in the user's language."""
+# General questions ("apa itu DSO", "how do I log a sale") repeat across
+# users and don't depend on anyone's data, so answers are shared per language.
+GENERAL_RESPONSE_CACHE_TTL = 6 * 3600  # seconds
+_general_response_cache = TTLCache(maxsize=2048, ttl=GENERAL_RESPONSE_CACHE_TTL)
+_general_response_lock = threading.Lock()
+
+def _general_response_key(text: str, user_language: str) -> tuple[str, str]:
+    """Normalize case, punctuation and spacing so trivially different phrasings match."""
+    return user_language, ' '.join(_NON_ALNUM_RE.sub(' ', text.lower()).split())
+
+# System prompts for general questions. Kept byte-identical between calls so
+# OpenAI's automatic prompt caching can reuse the prefix.
+_GENERAL_SYSTEM_PROMPTS = {
+    'ms': """Anda adalah pembantu kewangan yang ramah dan membantu untuk aplikasi aliran tunai WhatsApp.
+Pengguna menghantar mesej dalam Bahasa Malaysia, jadi anda MESTI membalas dalam Bahasa Malaysia.
+
+Anda boleh membantu dengan:
+- Soalan umum tentang pengurusan kewangan
+- Nasihat tentang pencatatan transaksi
+- Penjelasan tentang ciri-ciri aplikasi
+- Tips untuk menguruskan perniagaan kecil
+
+Berikan jawapan yang berguna, ringkas, dan ramah. Gunakan emoji yang sesuai.
+Jika pengguna bertanya tentang transaksi tertentu, ingatkan mereka untuk menghantar butiran transaksi tersebut.""",
+    'en': """You are a helpful and friendly financial assistant for a WhatsApp cash flow app.
+The user has written in English, so you MUST respond in English.
+
+You can help with:
+- General questions about financial management
+- Advice about transaction recording
+- Explanations about app features
+- Tips for managing small businesses
+
+Provide helpful, concise, and friendly responses. Use appropriate emojis.
+If the user asks about specific transactions, remind them to send the transaction details.""",
+}
+
+def generate_ai_response(text: str, wa_id: str, user_language: str | None = None) -> str:
+    """Generate AI response for general queries in the user's language.
+
+    Callers that already ran detect_language on text can pass the result as
+    user_language to skip detecting it again.
+    """
     logger.info(f"Generating AI response for general query from wa_id {wa_id}: '{text}'")
     
+    # Detect the language of the user's query
+    if user_language is None:
+        user_language = detect_language(text)
+    
     # Check if OpenAI client is initialized
     if openai_client is None:
         logger.error("OpenAI client not initialized")
-        user_language = detect_language(text)
         if user_language == 'ms':
             return "🤖 Maaf, perkhidmatan AI tidak tersedia sekarang. Sila cuba lagi nanti."
         else:
             return "🤖 Sorry, AI service is not available right now. Please try again later."
-    
-    # Detect the language of the user's query
-    user_language = detect_language(text)
-    
-    # Create appropriate system prompt based on detected language
-    if user_language == 'ms':
-        system_prompt = """
-        Anda adalah pembantu kewangan yang ramah dan membantu untuk aplikasi aliran tunai WhatsApp.
-        Pengguna menghantar mesej dalam Bahasa Malaysia, jadi anda MESTI membalas dalam Bahasa Malaysia.
-        
-        Anda boleh membantu dengan:
-        - Soalan umum tentang pengurusan kewangan
-        - Nasihat tentang pencatatan transaksi
-        - Penjelasan tentang ciri-ciri aplikasi
-        - Tips untuk menguruskan perniagaan kecil
-        
-        Berikan jawapan yang berguna, ringkas, dan ramah. Gunakan emoji yang sesuai.
-        Jika pengguna bertanya tentang transaksi tertentu, ingatkan mereka untuk menghantar butiran transaksi tersebut.
-        """
-    else:
-        system_prompt = """
-        You are a helpful and friendly financial assistant for a WhatsApp cash flow app.
-        The user has written in English, so you MUST respond in English.
-        
-        You can help with:
-        - General questions about financial management
-        - Advice about transaction recording
-        - Explanations about app features
-        - Tips for managing small businesses
-        
-        Provide helpful, concise, and friendly responses. Use appropriate emojis.
-        If the user asks about specific transactions, remind them to send the transaction details.
-        """
+
+    cache_key = _general_response_key(text, user_language)
+    with _general_response_lock:
+        cached_response = _general_response_cache.get(cache_key)
+    if cached_response is not None:
+        logger.info("Reusing cached AI response for general query")
+        return cached_response
     
     try:
-        response = openai_client.chat.completions.create(
+        ai_response = stream_chat_completion(
             model="gpt-4o-mini",
             messages=[
-                {"role": "system", "content": system_prompt},
+                {"role": "system", "content": _GENERAL_SYSTEM_PROMPTS[user_language]},
                 {"role": "user", "content": text}
             ]
         )
-        
-        ai_response = response.choices[0].message.content
         logger.info(f"Generated AI response: {ai_response}")
         
         if ai_response is None:
@@ -2210,7 +3002,9 @@ def generate_ai_response(text: str, wa_id: str) -> str:
                 return "🤖 Maaf, saya tidak dapat menjana respons sekarang. Sila cuba lagi."
             else:
                 return "🤖 Sorry, I couldn't generate a response right now. Please try again."
-            
+
+        with _general_response_lock:
+            _general_response_cache[cache_key] = ai_response
         return ai_response
         
     except Exception as e:
@@ -2299,16 +3093,25 @@ def is_reset_command(text: str) -> bool:
     
     return False
 
-# Store pending reset confirmations (wa_id -> confirmation_data)
-pending_resets = {}
+# Reset confirmations live in MongoDB (reset_collection) like registrations;
+# this cache only stands in during an outage
+pending_resets = TTLCache(maxsize=10000, ttl=PENDING_RESET_TTL)
+_reset_lock = threading.Lock()
+
+def get_pending_reset(wa_id: str) -> dict | None:
+    """Get a user's unconfirmed reset request, if any."""
+    return _load_conversation_state(reset_collection, pending_resets, _reset_lock, wa_id, PENDING_RESET_TTL)
+
+def clear_pending_reset(wa_id: str) -> None:
+    """Drop a user's unconfirmed reset request."""
+    _clear_conversation_state(reset_collection, pending_resets, _reset_lock, wa_id)
 
 def handle_reset_request(wa_id: str, user_language: str) -> str:
     """Handle initial reset request with confirmation."""
     # Store pending reset
-    pending_resets[wa_id] = {
-        'timestamp': datetime.now(timezone.utc),
+    _store_conversation_state(reset_collection, pending_resets, _reset_lock, wa_id, {
         'language': user_language
-    }
+    })
     
     if user_language == 'ms':
         return """⚠️ *Tetapkan Semula Pendaftaran*
@@ -2341,10 +3144,10 @@ Type *NO* to cancel"""
 
 def handle_reset_confirmation(wa_id: str, message_body: str) -> str:
     """Handle reset confirmation response."""
-    if wa_id not in pending_resets:
+    reset_data = get_pending_reset(wa_id)
+    if reset_data is None:
         return "❌ No reset request pending. Type 'reset' to start."
     
-    reset_data = pending_resets[wa_id]
     user_language = reset_data['language']
     confirmation = message_body.strip().lower()
     
@@ -2354,7 +3157,7 @@ def handle_reset_confirmation(wa_id: str, message_body: str) -> str:
         success = delete_user_registration(wa_id)
         
         # Clear pending reset
-        del pending_resets[wa_id]
+        clear_pending_reset(wa_id)
         
         if success:
             if user_language == 'ms':
@@ -2385,7 +3188,7 @@ Welcome back! 🎉"""
     
     elif confirmation in ['no', 'tidak', 'n', 'cancel', 'batal']:
         # Cancel reset
-        del pending_resets[wa_id]
+        clear_pending_reset(wa_id)
         
         if user_language == 'ms':
             return "✅ Reset dibatalkan. Maklumat anda selamat!"
@@ -2578,6 +3381,50 @@ def detect_multiple_transactions(text: str) -> bool:
     
     return False
 
+# Transaction indicators (strong signals), matched as substrings
+_TX_INDICATORS = (
+    # Malay transaction terms
+    'beli', 'jual', 'bayar', 'terima', 'hutang', 'kredit', 'tunai',
+    'rm ', 'ringgit', 'sen', 'harga', 'kos', 'jualan', 'pembelian',
+    'untung', 'rugi', 'modal', 'pendapatan', 'perbelanjaan',
+    # English transaction terms
+    'buy', 'bought', 'sell', 'sold', 'pay', 'paid', 'receive', 'received',
+    'cash', 'credit', 'debt', 'price', 'cost', 'sales', 'purchase',
+    'profit', 'loss', 'income', 'expense', 'revenue'
+)
+
+def _build_tx_automaton():
+    """Build the Aho-Corasick automaton over _TX_INDICATORS, or None without pyahocorasick."""
+    if ahocorasick is None:
+        return None
+    automaton = ahocorasick.Automaton()
+    for indicator in _TX_INDICATORS:
+        automaton.add_word(indicator, indicator)
+    automaton.make_automaton()
+    return automaton
+
+_TX_AUTOMATON = _build_tx_automaton()
+
+# Amount patterns (strong indicators), most common first
+_TX_AMOUNT_PATTERNS = tuple(re.compile(p) for p in (
+    r'rm\s*\d+', r'\$\d+', r'\d+\s*(ringgit|dollar)', r'\d+\.\d+',
+    r'\d+\s*(rm|usd|myr)', r'(total|amount|harga|kos|price|cost).*\d+'
+))
+
+# General question indicators (signals it's NOT a transaction)
+_QUESTION_WORDS = (
+    # Malay questions
+    'apa', 'bagaimana', 'mengapa', 'bila', 'di mana', 'siapa', 'berapa',
+    'boleh', 'adakah', 'macam mana', 'kenapa', 'camana',
+    # English questions
+    'what', 'how', 'why', 'when', 'where', 'who', 'which', 'can',
+    'could', 'would', 'should', 'is', 'are', 'do', 'does', 'did'
+)
+# Space-padded forms for the mid-sentence check
+_QUESTION_PADDED = tuple(f" {word} " for word in _QUESTION_WORDS)
+# A question word opening the message, as a whole word ("is it", not "island")
+_QSTART = re.compile(r'^(?:' + '|'.join(word.replace(' ', r'\s+') for word in _QUESTION_WORDS) + r')\b')
+
 def is_transaction_query(text: str) -> bool:
     """
     Determine if the user's message is likely a transaction vs a general question.
@@ -2589,57 +3436,26 @@ def is_transaction_query(text: str) -> bool:
     if is_greeting_or_help(text):
         return False
     
-    # Transaction indicators (strong signals)
-    transaction_indicators = [
-        # Malay transaction terms
-        'beli', 'jual', 'bayar', 'terima', 'hutang', 'kredit', 'tunai',
-        'rm ', 'ringgit', 'sen', 'harga', 'kos', 'jualan', 'pembelian',
-        'untung', 'rugi', 'modal', 'pendapatan', 'perbelanjaan',
-        # English transaction terms  
-        'buy', 'bought', 'sell', 'sold', 'pay', 'paid', 'receive', 'received',
-        'cash', 'credit', 'debt', 'price', 'cost', 'sales', 'purchase',
-        'profit', 'loss', 'income', 'expense', 'revenue'
-    ]
-    
-    # Amount patterns (strong indicators)
-    amount_patterns = [
-        r'rm\s*\d+', r'\$\d+', r'\d+\s*(ringgit|dollar)', r'\d+\.\d+',
-        r'\d+\s*(rm|usd|myr)', r'(total|amount|harga|kos|price|cost).*\d+'
-    ]
-    
-    # General question indicators (signals it's NOT a transaction)
-    question_indicators = [
-        # Malay questions
-        'apa', 'bagaimana', 'mengapa', 'bila', 'di mana', 'siapa', 'berapa',
-        'boleh', 'adakah', 'macam mana', 'kenapa', 'camana',
-        # English questions
-        'what', 'how', 'why', 'when', 'where', 'who', 'which', 'can',
-        'could', 'would', 'should', 'is', 'are', 'do', 'does', 'did'
-    ]
-    
-    # Count transaction indicators
-    transaction_count = sum(1 for indicator in transaction_indicators if indicator in text_lower)
-    
-    # Check amount patterns
-    for pattern in amount_patterns:
-        if re.search(pattern, text_lower):
-            transaction_count += 3  # High weight for amount patterns
+    # An amount alone outweighs any question wording (it scores 3 against a
+    # threshold of 2), so stop at the first amount match
+    if any(pattern.search(text_lower) for pattern in _TX_AMOUNT_PATTERNS):
+        return True
     
-    # Check question indicators
-    question_count = sum(1 for indicator in question_indicators if text_lower.startswith(indicator) or f" {indicator} " in text_lower)
+    # Count distinct transaction indicators present in the text
+    if _TX_AUTOMATON is not None:
+        transaction_count = len({indicator for _, indicator in _TX_AUTOMATON.iter(text_lower)})
+    else:
+        transaction_count = sum(1 for indicator in _TX_INDICATORS if indicator in text_lower)
     
     # If it starts with a question word, likely not a transaction
-    question_starters = ['what', 'how', 'why', 'when', 'where', 'who', 'which', 'can', 'could', 'would', 'should', 'is', 'are', 'do', 'does', 'did',
-                         'apa', 'bagaimana', 'mengapa', 'bila', 'di mana', 'siapa', 'berapa', 'boleh', 'adakah', 'macam mana', 'kenapa', 'camana']
-    
-    starts_with_question = any(text_lower.startswith(starter) for starter in question_starters)
+    starts_with_question = _QSTART.match(text_lower) is not None
     
     # Decision logic
     if starts_with_question and transaction_count < 2:
         return False  # Likely a question
     elif transaction_count >= 2:
         return True   # Likely a transaction
-    elif question_count > 0 and transaction_count == 0:
+    elif transaction_count == 0 and any(padded in text_lower for padded in _QUESTION_PADDED):
         return False  # Likely a question
     else:
         return True   # Default to transaction (current behavior)
@@ -2662,37 +3478,63 @@ def get_ccc_metrics(wa_id: str) -> dict:
             return {'ccc': 0, 'dso': 0, 'dio': 0, 'dpo': 0, 'error': 'Database collection not available'}
 
     try:
-        from datetime import datetime, timedelta
         ninety_days_ago = datetime.now(timezone.utc) - timedelta(days=90)
         period_days = 90
 
-        # Get all transactions for the period
-        transactions = list(collection.find({
-            "timestamp": {"$gte": ninety_days_ago},
-            "wa_id": wa_id
-        }))
+        # Sum the period server-side. Buckets are split by action and credit
+        # terms, and by customer for sales/payments received so payments can
+        # be matched to credit customers below.
+        credit_terms = ['credit', 'hutang', 'receivable', 'kredit']
+        buckets = list(collection.aggregate([
+            {'$match': {'wa_id': wa_id, 'timestamp': {'$gte': ninety_days_ago}}},
+            {'$group': {
+                '_id': {
+                    'action': '$action',
+                    'credit': {'$in': ['$terms', credit_terms]},
+                    'customer': {'$cond': [
+                        {'$in': ['$action', ['sale', 'payment_received']]},
+                        {'$ifNull': ['$customer', None]},
+                        None
+                    ]}
+                },
+                'total': {'$sum': '$amount'},
+                'count': {'$sum': 1}
+            }}
+        ]))
 
-        if not transactions:
+        if not buckets:
             return {'ccc': 0, 'dso': 0, 'dio': 0, 'dpo': 0, 'error': 'No transactions found'}
 
-        # Separate transactions by type
-        sales = [t for t in transactions if t['action'] == 'sale']
-        purchases = [t for t in transactions if t['action'] == 'purchase']
-        payments_received = [t for t in transactions if t['action'] == 'payment_received']
-        payments_made = [t for t in transactions if t['action'] == 'payment_made']
+        # Fold the buckets into the per-action totals the formulas need
+        totals = {}
+        credit_totals = {}
+        action_summary = {}
+        credit_customers = set()
+        received_by_customer = {}
+        for bucket in buckets:
+            key = bucket['_id']
+            action = key.get('action')
+            totals[action] = totals.get(action, 0) + bucket['total']
+            if key.get('credit'):
+                credit_totals[action] = credit_totals.get(action, 0) + bucket['total']
+                if action == 'sale' and key.get('customer'):
+                    credit_customers.add(key['customer'])
+            if action == 'payment_received':
+                customer = key.get('customer')
+                received_by_customer[customer] = received_by_customer.get(customer, 0) + bucket['total']
+
+            summary = action_summary.setdefault(action or 'unknown', {'count': 0, 'total_amount': 0})
+            summary['count'] += bucket['count']
+            summary['total_amount'] += bucket['total']
 
         # FIXED DSO CALCULATION
-        # Get credit sales (sales with terms indicating credit)
-        credit_terms = ['credit', 'hutang', 'receivable', 'kredit']
-        credit_sales = [s for s in sales if s.get('terms') in credit_terms]
-        total_credit_sales = sum(sale['amount'] for sale in credit_sales)
+        # Credit sales are sales with terms indicating credit
+        total_credit_sales = credit_totals.get('sale', 0)
 
         # Calculate actual outstanding receivables
         # Match payments received to credit customers
-        credit_customers = [sale.get('customer') for sale in credit_sales if sale.get('customer')]
-        payments_for_credit_sales = [p for p in payments_received if
-                                   p.get('customer') in credit_customers]
-        total_payments_for_credit = sum(payment['amount'] for payment in payments_for_credit_sales)
+        total_payments_for_credit = sum(amount for customer, amount in received_by_customer.items()
+                                        if customer in credit_customers)
 
         outstanding_receivables = max(0, total_credit_sales - total_payments_for_credit)
 
@@ -2702,8 +3544,8 @@ def get_ccc_metrics(wa_id: str) -> dict:
             dso = 0  # No credit sales = immediate payment
 
         # FIXED DIO CALCULATION
-        total_purchases = sum(p['amount'] for p in purchases)
-        total_sales = sum(s['amount'] for s in sales)
+        total_purchases = totals.get('purchase', 0)
+        total_sales = totals.get('sale', 0)
 
         # Use realistic COGS estimation instead of the often-empty 'cogs' field
         # For service/food business, COGS is typically 60-70% of sales
@@ -2722,12 +3564,11 @@ def get_ccc_metrics(wa_id: str) -> dict:
                 dio = 0
 
         # FIXED DPO CALCULATION
-        # Get credit purchases
-        credit_purchases = [p for p in purchases if p.get('terms') in credit_terms]
-        total_credit_purchases = sum(p['amount'] for p in credit_purchases)
+        # Credit purchases
+        total_credit_purchases = credit_totals.get('purchase', 0)
 
         # Total payments made (assuming they pay down credit purchases)
-        total_payments_made_amount = sum(p['amount'] for p in payments_made)
+        total_payments_made_amount = totals.get('payment_made', 0)
 
         outstanding_payables = max(0, total_credit_purchases - total_payments_made_amount)
 
@@ -2741,14 +3582,6 @@ def get_ccc_metrics(wa_id: str) -> dict:
 
         # Enhanced transaction breakdown with null safety
         transaction_breakdown_list = []
-        action_summary = {}
-        for transaction in transactions:
-            action = transaction.get('action') or 'unknown'
-            if action not in action_summary:
-                action_summary[action] = {'count': 0, 'total_amount': 0}
-            action_summary[action]['count'] += 1
-            action_summary[action]['total_amount'] += transaction.get('amount', 0)
-
         for action, data in action_summary.items():
             transaction_breakdown_list.append({
                 '_id': action,
@@ -2777,7 +3610,7 @@ def get_ccc_metrics(wa_id: str) -> dict:
                 'outstanding_receivables': outstanding_receivables,
                 'total_credit_purchases': total_credit_purchases,
                 'outstanding_payables': outstanding_payables,
-                'total_payments_received': sum(p['amount'] for p in payments_received),
+                'total_payments_received': totals.get('payment_received', 0),
                 'total_payments_made': total_payments_made_amount
             }
         }
@@ -2848,8 +3681,132 @@ def generate_actionable_advice(metrics: dict) -> str:
 
     return advice
 
+# --- Receipt Image Storage ---
+# Receipts are stored as raw BSON Binary; anything over 1MB goes to GridFS
+# and only its ObjectId is kept on the transaction document.
+GRIDFS_THRESHOLD = 1024 * 1024
+
+def attach_receipt_image(doc: dict, image_data: bytes | BinaryIO, wa_id: str) -> None:
+    """
+    Attach a receipt image to a transaction document.
+
+    image_data is raw bytes or a binary file-like object. File-like images over
+    the threshold are streamed into GridFS chunk by chunk without being read
+    into memory first.
+    """
+    if isinstance(image_data, (bytes, bytearray)):
+        size = len(image_data)
+    else:
+        size = image_data.seek(0, io.SEEK_END)
+        image_data.seek(0)
+
+    if size > GRIDFS_THRESHOLD and db is not None:
+        filename = f"{wa_id}-{datetime.now(timezone.utc).strftime('%Y%m%d%H%M%S%f')}"
+        bucket = gridfs.GridFSBucket(db)
+        if isinstance(image_data, (bytes, bytearray)):
+            image_data = io.BytesIO(image_data)
+        doc['receipt_image_id'] = bucket.upload_from_stream(filename, image_data, metadata={'wa_id': wa_id})
+    else:
+        if not isinstance(image_data, (bytes, bytearray)):
+            image_data = image_data.read()
+        doc['receipt_image'] = Binary(image_data)
+    doc['has_image'] = True
+
+# --- Transaction Read Helpers ---
+# Fields the summary lists and status reports actually display
+SUMMARY_PROJECTION = {'_id': 0, 'action': 1, 'amount': 1, 'vendor': 1, 'customer': 1,
+                      'items': 1, 'category': 1, 'timestamp': 1}
+
+def get_recent_transactions(wa_id: str, limit: int = 5) -> tuple[list, int]:
+    """Return the user's latest transactions and their total count in one query."""
+    result = next(collection.aggregate([
+        {'$match': {'wa_id': wa_id}},
+        {'$sort': {'timestamp': -1}},
+        {'$project': SUMMARY_PROJECTION},
+        {'$facet': {
+            'recent': [{'$limit': limit}],
+            'total': [{'$count': 'n'}]
+        }}
+    ]), None)
+
+    if not result:
+        return [], 0
+    total = result['total'][0]['n'] if result['total'] else 0
+    return result['recent'], total
+
+# --- Background Finalization ---
+# Slow follow-up work (AI categorization) runs here so the reply isn't held up
+_background_executor = concurrent.futures.ThreadPoolExecutor(max_workers=8, thread_name_prefix="txn-finalize")
+# Queued finalizations are lost on a restart, and with FAST_WRITES the update
+# can race ahead of its insert; rows still PENDING after a few minutes are
+# picked up again by sweep_pending_categories
+PENDING_CATEGORY_SWEEP_AGE = 300  # seconds
+PENDING_CATEGORY_SWEEP_INTERVAL = 600  # seconds
+PENDING_CATEGORY_SWEEP_LIMIT = 100
+_pending_sweep_checked = 0.0
+_pending_sweep_lock = threading.Lock()
+
+def _finalize_transaction_category(inserted_id, wa_id, description, vendor, amount) -> None:
+    """Categorize a saved purchase with AI and write the category back."""
+    try:
+        category = categorize_purchase_with_ai(description, vendor, amount) or 'OTHER'
+    except Exception as e:
+        logger.error(f"Error in fallback categorization: {e}")
+        category = 'OTHER'
+
+    try:
+        result = write_with_reconnect(lambda: collection.update_one(
+            {'_id': inserted_id, 'category': PENDING_CATEGORY},
+            {'$set': {'category': category}}
+        ))
+        if result.modified_count:
+            invalidate_report_cache(wa_id)
+        logger.info(f"Fallback categorization for {inserted_id}: {category}")
+    except Exception as e:
+        # Left PENDING for the next sweep
+        logger.error(f"Error updating category for {inserted_id}: {e}")
+
+def sweep_pending_categories() -> int:
+    """Re-queue categorization for transactions stuck in PENDING; returns how many were queued."""
+    if collection is None:
+        return 0
+    cutoff = datetime.now(timezone.utc) - timedelta(seconds=PENDING_CATEGORY_SWEEP_AGE)
+    try:
+        stuck = list(collection.find(
+            {'category': PENDING_CATEGORY, 'timestamp': {'$lt': cutoff}},
+            {'wa_id': 1, 'description': 1, 'items': 1, 'vendor': 1, 'customer': 1, 'amount': 1}
+        ).limit(PENDING_CATEGORY_SWEEP_LIMIT))
+    except Exception as e:
+        logger.warning(f"Could not look up pending categories: {e}")
+        return 0
+
+    for doc in stuck:
+        _background_executor.submit(
+            _finalize_transaction_category, doc['_id'], doc.get('wa_id'),
+            doc.get('description') or doc.get('items', ''),
+            doc.get('vendor') or doc.get('customer', ''), doc.get('amount', 0)
+        )
+    if stuck:
+        logger.info(f"Re-queued categorization for {len(stuck)} pending transactions")
+    return len(stuck)
+
+def maybe_sweep_pending_categories() -> None:
+    """Run sweep_pending_categories in the background at most once per interval."""
+    global _pending_sweep_checked
+
+    now = time.monotonic()
+    with _pending_sweep_lock:
+        if _pending_sweep_checked and now - _pending_sweep_checked < PENDING_CATEGORY_SWEEP_INTERVAL:
+            return
+        _pending_sweep_checked = now
+    _background_executor.submit(sweep_pending_categories)
+
 # --- Database Function ---
-def save_to_mongodb_parallel(data: dict, wa_id: str, image_data: bytes | None = None) -> bool:
+def _transaction_sink():
+    """Collection new transactions are inserted through: the w=0 view with FAST_WRITES."""
+    return fast_collection if fast_collection is not None else collection
+
+def save_to_mongodb_parallel(data: dict, wa_id: str, image_data: bytes | BinaryIO | None = None) -> bool:
     """Saves transaction data with parallel database operations for better performance."""
     global mongo_client, collection
 
@@ -2865,7 +3822,8 @@ def save_to_mongodb_parallel(data: dict, wa_id: str, image_data: bytes | None =
             return False
 
     try:
-        # Prepare transaction document
+        # Prepare transaction document; one clock read keeps the three stamps consistent
+        now = datetime.now(timezone.utc)
         transaction_doc = {
             "wa_id": wa_id,
             "action": data.get('action'),
@@ -2877,27 +3835,21 @@ def save_to_mongodb_parallel(data: dict, wa_id: str, image_data: bytes | None =
             "description": data.get('description'),
             "category": data.get('category'),
             "detected_language": data.get('detected_language', 'en'),
-            "timestamp": datetime.now(timezone.utc),
-            "date_created": datetime.now(timezone.utc).strftime("%Y-%m-%d"),
-            "time_created": datetime.now(timezone.utc).strftime("%H:%M:%S")
+            "timestamp": now,
+            "date_created": now.date().isoformat(),
+            "time_created": now.time().isoformat('seconds')
         }
 
         # Handle category logic
+        categorize_args = None
         if data.get('action') in ['purchase', 'payment_made'] and not data.get('category'):
-            # Fallback categorization if needed
-            try:
-                description = data.get('description', '') or data.get('items', '')
+            # Fallback categorization runs after the insert, off the reply path
+            description = data.get('description', '') or data.get('items', '')
+            if description:
                 vendor = data.get('vendor', '') or data.get('customer', '')
-                amount = data.get('amount', 0)
-                
-                if description:
-                    category = categorize_purchase_with_ai(description, vendor, amount)
-                    transaction_doc['category'] = category
-                    logger.info(f"Fallback categorization: {category}")
-                else:
-                    transaction_doc['category'] = 'OTHER'
-            except Exception as e:
-                logger.error(f"Error in fallback categorization: {e}")
+                categorize_args = (description, vendor, data.get('amount', 0))
+                transaction_doc['category'] = PENDING_CATEGORY
+            else:
                 transaction_doc['category'] = 'OTHER'
         elif data.get('category'):
             logger.info(f"Using AI-provided category: {data.get('category')}")
@@ -2908,39 +3860,26 @@ def save_to_mongodb_parallel(data: dict, wa_id: str, image_data: bytes | None =
 
         # Add image data if provided
         if image_data:
-            import base64
-            transaction_doc['receipt_image'] = base64.b64encode(image_data).decode('utf-8')
+            attach_receipt_image(transaction_doc, image_data, wa_id)
 
-        # Define parallel operations
-        def save_transaction():
-            """Save the transaction to MongoDB"""
-            try:
-                result = collection.insert_one(transaction_doc)
-                logger.info(f"Transaction saved with ID: {result.inserted_id}")
-                return True
-            except Exception as e:
-                logger.error(f"Error saving transaction: {e}")
-                return False
+        try:
+            result = write_with_reconnect(lambda: _transaction_sink().insert_one(transaction_doc))
+            logger.info(f"Transaction saved with ID: {result.inserted_id}")
+        except Exception as e:
+            logger.error(f"Error saving transaction: {e}")
+            return False
+        invalidate_report_cache(wa_id)
 
-        def update_streak():
-            """Update user's daily logging streak"""
-            try:
-                streak_result = update_user_streak(wa_id)
-                return streak_result
-            except Exception as e:
-                logger.error(f"Error updating user streak: {e}")
-                return {"streak": 0, "updated": False, "error": True}
+        if categorize_args:
+            _background_executor.submit(_finalize_transaction_category, result.inserted_id, wa_id, *categorize_args)
 
-        # Execute only critical operation - DB save
-        # Streak update is handled separately after response is sent
-        save_success = save_transaction()
-        return save_success
+        return True
 
     except Exception as e:
         logger.error(f"Error in parallel save operation: {e}")
         return False
 
-def save_to_mongodb_simple(data: dict, wa_id: str, image_data: bytes | None = None) -> bool:
+def save_to_mongodb_simple(data: dict, wa_id: str, image_data: bytes | BinaryIO | None = None) -> bool:
     """Simplified MongoDB save - just saves transaction without parallel operations."""
     global mongo_client, collection
 
@@ -2952,6 +3891,7 @@ def save_to_mongodb_simple(data: dict, wa_id: str, image_data: bytes | None = No
             return False
 
     try:
+        now = datetime.now(timezone.utc)
         transaction_doc = {
             "wa_id": wa_id,
             "action": data.get('action'),
@@ -2963,22 +3903,22 @@ def save_to_mongodb_simple(data: dict, wa_id: str, image_data: bytes | None = No
             "description": data.get('description'),
             "category": data.get('category'),
             "detected_language": data.get('detected_language', 'en'),
-            "timestamp": datetime.now(timezone.utc),
-            "date_created": datetime.now(timezone.utc).strftime("%Y-%m-%d"),
-            "time_created": datetime.now(timezone.utc).strftime("%H:%M:%S")
+            "timestamp": now,
+            "date_created": now.date().isoformat(),
+            "time_created": now.time().isoformat('seconds')
         }
 
         if image_data:
-            import base64
-            transaction_doc['receipt_image'] = base64.b64encode(image_data).decode('utf-8')
+            attach_receipt_image(transaction_doc, image_data, wa_id)
 
-        result = collection.insert_one(transaction_doc)
+        result = write_with_reconnect(lambda: _transaction_sink().insert_one(transaction_doc))
+        invalidate_report_cache(wa_id)
         return result.inserted_id is not None
     except Exception as e:
         logger.error(f"Error saving to MongoDB: {e}")
         return False
 
-def save_to_mongodb(data: dict, wa_id: str, image_data: bytes | None = None) -> bool:
+def save_to_mongodb(data: dict, wa_id: str, image_data: bytes | BinaryIO | None = None) -> bool:
     """Saves the transaction data to MongoDB with user isolation."""
     global mongo_client, collection
 
@@ -3033,23 +3973,18 @@ def save_to_mongodb(data: dict, wa_id: str, image_data: bytes | None = None) ->
 
         # Add image data if provided
         if image_data:
-            # Convert image to base64 for storage
-            image_base64 = base64.b64encode(image_data).decode('utf-8')
-            data['receipt_image'] = image_base64
-            data['has_image'] = True
+            attach_receipt_image(data, image_data, wa_id)
         else:
             data['has_image'] = False
 
-        # Check if MongoDB client and collection are available
-        if mongo_client is None or collection is None:
-            logger.error("MongoDB client or collection not initialized")
+        # Check if the collection is available
+        if collection is None:
+            logger.error("MongoDB collection not initialized")
             return False
 
-        # Test connection before inserting
-        mongo_client.admin.command('ping')
-
         # Insert the data into the collection
-        result = collection.insert_one(data)
+        result = write_with_reconnect(lambda: _transaction_sink().insert_one(data))
+        invalidate_report_cache(wa_id)
         logger.info(f"Successfully inserted data into MongoDB for wa_id {wa_id}: {data.get('action', 'Unknown')} - {data.get('amount', 'N/A')} (ID: {result.inserted_id})")
         return True
 
@@ -3059,6 +3994,20 @@ def save_to_mongodb(data: dict, wa_id: str, image_data: bytes | None = None) ->
         connect_to_mongodb()
         return False
 
+def persist_transaction_and_streak(data: dict, wa_id: str, image_data: bytes | BinaryIO | None = None) -> tuple[bool, dict]:
+    """
+    Save a transaction and, only once it is stored, update the user's streak.
+
+    Returns (saved, streak_info); a failed save leaves the streak untouched.
+    """
+    if "error" in data:
+        logger.error(f"Cannot save transaction with error: {data['error']}")
+        return False, {"streak": 0, "is_new": False, "updated": False, "error": True}
+
+    if not save_to_mongodb_parallel(data, wa_id, image_data):
+        return False, {"streak": 0, "is_new": False, "updated": False}
+    return True, update_user_streak(wa_id)
+
 def create_immediate_success_response(parsed_data: dict, user_mode: str, user_language: str) -> str:
     """Create immediate success response for regex-parsed transactions without waiting for DB."""
     action = (parsed_data.get('action') or 'transaction').capitalize()
@@ -3118,12 +4067,10 @@ def schedule_background_transaction_processing(parsed_data: dict, wa_id: str, us
         try:
             logger.info(f"🔄 Background processing transaction for {wa_id}: {parsed_data.get('action')} RM{parsed_data.get('amount')}")
             
-            # Save to MongoDB
-            save_success = save_to_mongodb_parallel(parsed_data, wa_id)
+            # Save to MongoDB and update the streak in parallel
+            save_success, streak_info = persist_transaction_and_streak(parsed_data, wa_id)
             
             if save_success:
-                # Update user streak
-                streak_info = update_user_streak(wa_id)
                 logger.info(f"✅ Background processing complete for {wa_id}: DB={save_success}, Streak={streak_info.get('updated', False)}")
                 
                 # Optional: Send follow-up message about streak (commented out to avoid spam)
@@ -3140,6 +4087,18 @@ def schedule_background_transaction_processing(parsed_data: dict, wa_id: str, us
     thread.start()
     logger.info(f"🚀 Background processing scheduled for {wa_id}")
 
+# Clarification question (localized message key) per transaction action
+ACTION_ITEM_Q = {
+    'purchase': 'clarification_items',
+    'sale': 'clarification_items_sell',
+}
+ACTION_PARTY_Q = {
+    'purchase': 'clarification_customer_buy',
+    'payment_made': 'clarification_payment_to',
+    'payment_received': 'clarification_payment_from',
+}
+PAYMENT_ACTIONS = frozenset(('payment_made', 'payment_received'))
+
 def schedule_background_ai_processing(message_body: str, wa_id: str, user_mode: str, user_language: str):
     """Schedule background AI parsing and processing for complex transactions."""
     def background_ai_process():
@@ -3165,14 +4124,14 @@ def schedule_background_ai_processing(message_body: str, wa_id: str, user_mode:
             missing_fields = []
             clarification_questions = []
             
+            action = parsed_data.get('action') or 'transaction'
+
             # Check for missing items (mode-aware)
             if not parsed_data.get('items') or parsed_data.get('items') in [None, 'null', 'N/A', '']:
-                action = parsed_data.get('action') or 'transaction'
-                if user_mode == 'business' and action not in ['payment_made', 'payment_received']:
-                    if action == 'purchase':
-                        clarification_questions.append(get_localized_message('clarification_items', user_language))
-                    elif action == 'sale':
-                        clarification_questions.append(get_localized_message('clarification_items_sell', user_language))
+                if user_mode == 'business' and action not in PAYMENT_ACTIONS:
+                    question_key = ACTION_ITEM_Q.get(action)
+                    if question_key:
+                        clarification_questions.append(get_localized_message(question_key, user_language))
                     missing_fields.append('items')
             
             # Check for missing amount
@@ -3182,19 +4141,15 @@ def schedule_background_ai_processing(message_body: str, wa_id: str, user_mode:
             
             # Check for missing customer/vendor (business mode only)
             if user_mode == 'business' and not parsed_data.get('customer') and not parsed_data.get('vendor'):
-                action = parsed_data.get('action') or 'transaction'
-                if action == 'purchase':
-                    clarification_questions.append(get_localized_message('clarification_customer_buy', user_language))
-                    missing_fields.append('customer/vendor')
-                elif action in ['payment_made', 'payment_received']:
-                    clarification_questions.append(get_localized_message('clarification_payment_to' if action == 'payment_made' else 'clarification_payment_from', user_language))
+                question_key = ACTION_PARTY_Q.get(action)
+                if question_key:
+                    clarification_questions.append(get_localized_message(question_key, user_language))
                     missing_fields.append('customer/vendor')
             
             # If missing fields, ask for clarification
             if clarification_questions:
                 store_pending_transaction(wa_id, parsed_data, missing_fields)
                 
-                action = parsed_data.get('action') or 'transaction'
                 if user_language == 'ms':
                     clarification_text = f"🤔 Saya faham ini sebagai *{action}* tetapi saya perlukan penjelasan:\n\n"
                 else:
@@ -3278,15 +4233,28 @@ def handle_test_db_command(wa_id: str) -> str:
     try:
         logger.info(f"Manual database test requested by wa_id {wa_id}")
 
-        # Test connection
-        if connect_to_mongodb():
+        # Ping the pooled client; only rebuild it if the ping fails
+        connected = False
+        if mongo_client is not None:
+            try:
+                mongo_client.admin.command('ping')
+                connected = True
+            except Exception as e:
+                logger.warning(f"MongoDB ping failed, reconnecting: {e}")
+        if not connected:
+            connected = connect_to_mongodb()
+
+        if connected:
             # Check if collection is available before performing queries
             if collection is None:
                 return "❌ **Database Connection Failed!**\n\n🚫 Collection not initialized properly."
             
-            # Try to perform a simple query
-            test_result = collection.find_one({"wa_id": wa_id})
-            count = collection.count_documents({"wa_id": wa_id})
+            # Count the user's records in one index-covered query
+            count_result = list(collection.aggregate([
+                {'$match': {'wa_id': wa_id}},
+                {'$count': 'n'}
+            ]))
+            count = count_result[0]['n'] if count_result else 0
 
             # Format MongoDB URI for display
             mongo_uri_display = "Not configured"
@@ -3348,7 +4316,7 @@ def handle_message(wa_id: str, message_body: str) -> str:
         return handle_registration_step(wa_id, message_body)
     
     # PRIORITY 2: Check for reset confirmation (if pending)
-    if wa_id in pending_resets:
+    if get_pending_reset(wa_id) is not None:
         return handle_reset_confirmation(wa_id, message_body)
     
     # PRIORITY 3: Check for reset command
@@ -3359,13 +4327,16 @@ def handle_message(wa_id: str, message_body: str) -> str:
     if not is_user_registered(wa_id):
         return start_user_registration(wa_id, user_language)
 
+    # Only registered users can have a clarification pending
+    pending = get_pending_transaction(wa_id)
+
     # Check for greetings/thanks first, even if there's a pending transaction
     greeting_type = is_greeting_or_help(message_body)
     logger.info(f"Greeting detection for '{message_body}': {greeting_type}")
     if greeting_type:
         logger.info(f"Processing as {greeting_type}, clearing any pending transactions")
         # If there's a pending transaction and user says thanks/greeting, assume they're done
-        if get_pending_transaction(wa_id):
+        if pending:
             clear_pending_transaction(wa_id)
         
         if greeting_type == 'greeting':
@@ -3377,8 +4348,6 @@ def handle_message(wa_id: str, message_body: str) -> str:
             return get_localized_message('help_response', user_language)
 
     # Check if user has a pending transaction waiting for clarification
-    pending = get_pending_transaction(wa_id)
-
     if pending:
         # This might be a clarification response
         missing_fields = pending['missing_fields']
@@ -3391,16 +4360,9 @@ def handle_message(wa_id: str, message_body: str) -> str:
             clear_pending_transaction(wa_id)
 
     # Check for commands
-    if message_body.lower().strip() in ['status', '/status']:
-        return handle_status_command(wa_id)
-    elif message_body.lower().strip() in ['summary', '/summary']:
-        return handle_summary_command(wa_id)
-    elif message_body.lower().strip() in ['streak', '/streak']:
-        return handle_streak_command(wa_id)
-    elif message_body.lower().strip() in ['test_db', '/test_db', 'testdb']:
-        return handle_test_db_command(wa_id)
-    elif message_body.lower().strip() in ['start', '/start', 'help', '/help']:
-        return handle_start_command(wa_id, message_body)
+    command_handler = _COMMANDS.get(message_body.strip().lower())
+    if command_handler:
+        return command_handler(wa_id, message_body)
 
     # Check for ambiguous messages (emojis, gibberish, random text)
     if is_ambiguous_message(message_body):
@@ -3409,7 +4371,7 @@ def handle_message(wa_id: str, message_body: str) -> str:
     # Determine if this is a transaction or general query
     if not is_transaction_query(message_body):
         # Handle as general query
-        return generate_ai_response(message_body, wa_id)
+        return generate_ai_response(message_body, wa_id, user_language)
 
     # Multiple transaction detection removed - allowing multiple transactions now
 
@@ -3444,6 +4406,48 @@ def handle_message(wa_id: str, message_body: str) -> str:
         
         return immediate_response
 
+# Streak footers keyed by (updated, is_new, was_broken); is_new takes
+# precedence over was_broken, and (False, False, False) is "already logged today"
+_STREAK_FOOTERS = {
+    (True, True, False): "\n\n🎯 *New daily logging streak started!* Current streak: *{streak} days*",
+    (True, False, True): "\n\n🔄 *Streak restarted!* Current streak: *{streak} days*",
+    (True, False, False): "\n\n🔥 *Streak extended!* Current streak: *{streak} days*",
+    (False, False, False): "\n\n🔥 You've already logged today! Current streak: *{streak} {day_word}*",
+}
+
+def _streak_footer(streak_info: dict) -> str:
+    """Render the streak line appended to a success reply ('' on streak errors)."""
+    if streak_info.get('error', False):
+        return ""
+    if not streak_info.get('updated', False):
+        key = (False, False, False)
+    elif streak_info.get('is_new', False):
+        key = (True, True, False)
+    else:
+        key = (True, False, bool(streak_info.get('was_broken', False)))
+    streak = streak_info.get('streak', 0)
+    return _STREAK_FOOTERS[key].format(streak=streak, day_word="day" if streak == 1 else "days")
+
+def _format_success_reply(title: str, txn: dict, streak_info: dict) -> str:
+    """Build the confirmation for a saved transaction, with its streak footer."""
+    action = (txn.get('action') or 'transaction').capitalize()
+    amount = txn.get('amount', 0)
+    customer = safe_text(txn.get('customer') or txn.get('vendor', 'N/A'))
+    items = safe_text(txn.get('items', 'N/A'))
+
+    reply_text = f"✅ *{title}* {action} of *{amount}* with *{customer}*"
+    if items and items != 'N/A':
+        reply_text += f"\n📦 Items: {items}"
+
+    return reply_text + _streak_footer(streak_info)
+
+# Follow-up questions for fields still missing after a clarification reply
+_FOLLOWUP_QUESTIONS = {
+    'items': "📦 What items were involved?",
+    'amount': "💰 What was the amount?",
+    'customer/vendor': "👥 Who was the other party?",
+}
+
 def handle_clarification_response(wa_id: str, message_body: str, pending: dict) -> str:
     """Handle user's clarification response to complete the transaction."""
     transaction_data = pending['data'].copy()
@@ -3451,19 +4455,15 @@ def handle_clarification_response(wa_id: str, message_body: str, pending: dict)
 
     logger.info(f"Processing clarification for wa_id {wa_id}: '{message_body}' for fields {missing_fields}")
 
-    # Try to extract missing information from the clarification
-    message_lower = message_body.lower()
+    # A bare amount reply ("150", "RM12.50") only answers the amount question;
+    # it shouldn't also be taken as the vendor name or the items
+    amount_only = 'amount' in missing_fields and _NUMBER_ONLY_RE.fullmatch(message_body.strip()) is not None
 
     # Handle vendor/customer clarification
-    if 'customer/vendor' in missing_fields:
+    if 'customer/vendor' in missing_fields and not amount_only:
         # Extract vendor/customer name from clarification
-        vendor_patterns = ['dari', 'from', 'kepada', 'to', 'dengan', 'with']
-        extracted_name = message_body.strip()
-
-        # Remove common prepositions
-        for pattern in vendor_patterns:
-            if extracted_name.lower().startswith(pattern + ' '):
-                extracted_name = extracted_name[len(pattern) + 1:]
+        # Remove a leading preposition ("dari Ali" -> "Ali")
+        extracted_name = _VENDOR_PREP_RE.sub('', message_body.strip())
 
         action = transaction_data.get('action') or ''
         if action == 'purchase':
@@ -3478,16 +4478,16 @@ def handle_clarification_response(wa_id: str, message_body: str, pending: dict)
         missing_fields.remove('customer/vendor')
 
     # Handle items clarification
-    if 'items' in missing_fields and not transaction_data.get('items'):
+    if 'items' in missing_fields and not transaction_data.get('items') and not amount_only:
         transaction_data['items'] = message_body.strip()
         missing_fields.remove('items')
 
     # Handle amount clarification
     if 'amount' in missing_fields and not transaction_data.get('amount'):
         # Try to extract number from the message
-        numbers = re.findall(r'\d+(?:\.\d+)?', message_body)
-        if numbers:
-            transaction_data['amount'] = float(numbers[0])
+        amount_match = _AMOUNT_RE.search(message_body)
+        if amount_match:
+            transaction_data['amount'] = float(amount_match.group())
             missing_fields.remove('amount')
 
     # Check if we still have missing fields
@@ -3495,14 +4495,7 @@ def handle_clarification_response(wa_id: str, message_body: str, pending: dict)
         # Update pending transaction and ask for remaining info
         store_pending_transaction(wa_id, transaction_data, missing_fields)
 
-        clarification_questions = []
-        for field in missing_fields:
-            if field == 'items':
-                clarification_questions.append("📦 What items were involved?")
-            elif field == 'amount':
-                clarification_questions.append("💰 What was the amount?")
-            elif field == 'customer/vendor':
-                clarification_questions.append("👥 Who was the other party?")
+        clarification_questions = [_FOLLOWUP_QUESTIONS[f] for f in missing_fields if f in _FOLLOWUP_QUESTIONS]
 
         clarification_text = "👍 Got it! I still need:\n\n"
         clarification_text += "\n".join(clarification_questions)
@@ -3511,53 +4504,114 @@ def handle_clarification_response(wa_id: str, message_body: str, pending: dict)
 
     # All fields completed, save the transaction with parallel processing
     clear_pending_transaction(wa_id)
-    success = save_to_mongodb_parallel(transaction_data, wa_id)
+    success, streak_info = persist_transaction_and_streak(transaction_data, wa_id)
 
     if success:
-        # Update user's daily logging streak
-        streak_info = update_user_streak(wa_id)
+        return _format_success_reply("Transaction completed!", transaction_data, streak_info)
+    else:
+        return "❌ There was an error saving your transaction to the database."
+
+# --- Report Cache ---
+# Rendered status/summary replies per wa_id, stored with the (mode, language,
+# report_version) they were rendered for. report_version lives on the user
+# document and gets a fresh ObjectId on every write to the user's
+# transactions, from either gunicorn worker or the dashboard API, so a
+# cached reply is only served while the data behind it is unchanged.
+_status_cache = TTLCache(maxsize=5000, ttl=300)
+_summary_cache = TTLCache(maxsize=5000, ttl=60)
+_report_cache_lock = threading.Lock()
+
+def _get_cached_report(cache: TTLCache, wa_id: str, variant: tuple) -> str | None:
+    """Return a cached report if it was rendered for the same mode/language."""
+    with _report_cache_lock:
+        entry = cache.get(wa_id)
+    if entry is not None and entry[0] == variant:
+        return entry[1]
+    return None
 
-        action = (transaction_data.get('action') or 'transaction').capitalize()
-        amount = transaction_data.get('amount', 0)
-        customer = safe_text(transaction_data.get('customer') or transaction_data.get('vendor', 'N/A'))
-        items = safe_text(transaction_data.get('items', 'N/A'))
+def _cache_report(cache: TTLCache, wa_id: str, variant: tuple, report: str) -> None:
+    """Cache a rendered report; error replies are never cached."""
+    if report.startswith("❌"):
+        return
+    with _report_cache_lock:
+        cache[wa_id] = (variant, report)
+
+def invalidate_report_cache(wa_id: str) -> None:
+    """Drop cached status/summary replies in every process after the user's data changes."""
+    with _report_cache_lock:
+        _status_cache.pop(wa_id, None)
+        _summary_cache.pop(wa_id, None)
+    if users_collection is None:
+        return
+    try:
+        users_collection.update_one({'wa_id': wa_id}, {'$set': {'report_version': ObjectId()}}, upsert=True)
+    except Exception as e:
+        logger.warning(f"Could not bump report version for wa_id {wa_id}: {e}")
 
-        reply_text = f"✅ *Transaction completed!* {action} of *{amount}* with *{customer}*"
-        if items and items != 'N/A':
-            reply_text += f"\n📦 Items: {items}"
+# Business status report bodies, filled from the CCC metrics plus advice
+_BUSINESS_STATUS_TMPL = {
+    'ms': """💡 *Status Kesihatan Kewangan Perniagaan* (90 hari lepas)
 
-        # Add streak information if updated
-        if streak_info.get('updated', False) and not streak_info.get('error', False):
-            streak = streak_info.get('streak', 0)
-            if streak_info.get('is_new', False):
-                reply_text += f"\n\n🎯 *New daily logging streak started!* Current streak: *{streak} days*"
-            elif streak_info.get('was_broken', False):
-                reply_text += f"\n\n🔄 *Streak restarted!* Current streak: *{streak} days*"
-            else:
-                reply_text += f"\n\n🔥 *Streak extended!* Current streak: *{streak} days*"
-        elif not streak_info.get('updated', False) and not streak_info.get('error', False):
-            # Already logged today
-            streak = streak_info.get('streak', 0)
-            day_word = "day" if streak == 1 else "days"
-            reply_text += f"\n\n🔥 You've already logged today! Current streak: *{streak} {day_word}*"
+Kitaran Penukaran Tunai anda adalah *{ccc} hari*.
+_Ini adalah tempoh wang anda terikat dalam operasi sebelum menjadi tunai semula._
 
-        return reply_text
-    else:
-        return "❌ There was an error saving your transaction to the database."
+*Analisis Komponen:*
+🤝 Hari Jualan Tertunggak (DSO): *{dso} hari*
+   _Masa untuk mengutip wang daripada jualan kredit_
+
+📦 Hari Inventori Tertunggak (DIO): *{dio} hari*
+   _Masa inventori duduk sebelum dijual_
+
+💸 Hari Hutang Tertunggak (DPO): *{dpo} hari*
+   _Masa anda ambil untuk bayar pembekal_
+
+*Formula:* CCC = DSO + DIO - DPO = {dso} + {dio} - {dpo} = *{ccc} hari*
+
+---
+{advice}""",
+    'en': """💡 *Your Business Financial Health Status* (last 90 days)
+
+Your Cash Conversion Cycle is *{ccc} days*.
+_This is how long your money is tied up in operations before becoming cash again._
+
+*Component Analysis:*
+🤝 Days Sales Outstanding (DSO): *{dso} days*
+   _Time to collect money from credit sales_
+
+📦 Days Inventory Outstanding (DIO): *{dio} days*
+   _Time inventory sits before being sold_
+
+💸 Days Payable Outstanding (DPO): *{dpo} days*
+   _Time you take to pay suppliers_
+
+*Formula:* CCC = DSO + DIO - DPO = {dso} + {dio} - {dpo} = *{ccc} days*
+
+---
+{advice}""",
+}
 
 def handle_status_command(wa_id: str) -> str:
     """Send mode-aware status report - personal budget vs business financial health."""
     try:
         logger.info(f"Generating status report for wa_id {wa_id}")
         
-        # Get user mode and language
-        user_mode = get_user_mode(wa_id)
-        user_language = get_user_language(wa_id)
+        # Get user mode, language and report version in one round-trip
+        user_mode, user_language, version = get_user_report_context(wa_id)
+
+        variant = (user_mode, user_language, version)
+        cached = _get_cached_report(_status_cache, wa_id, variant)
+        if cached is not None:
+            logger.info(f"Serving cached status report for wa_id {wa_id}")
+            return cached
         
         if user_mode == 'personal':
-            return handle_personal_status_command(wa_id, user_language)
+            report = handle_personal_status_command(wa_id, user_language)
         else:
-            return handle_business_status_command(wa_id, user_language)
+            report = handle_business_status_command(wa_id, user_language)
+
+        if version is not None:
+            _cache_report(_status_cache, wa_id, variant, report)
+        return report
 
     except Exception as e:
         logger.error(f"Error generating status report: {e}")
@@ -3577,7 +4631,7 @@ def handle_personal_status_command(wa_id: str, user_language: str = 'en') -> str
         user_transactions = list(collection.find({
             'wa_id': wa_id,
             'timestamp': {'$gte': thirty_days_ago}
-        }).sort('timestamp', -1))
+        }, {'_id': 0, 'action': 1, 'amount': 1, 'category': 1}))
         
         if not user_transactions:
             if user_language == 'ms':
@@ -3645,46 +4699,8 @@ def handle_business_status_command(wa_id: str, user_language: str = 'en') -> str
         advice = generate_actionable_advice(metrics)
 
         # Create the formatted report
-        if user_language == 'ms':
-            report = f"""💡 *Status Kesihatan Kewangan Perniagaan* (90 hari lepas)
-
-Kitaran Penukaran Tunai anda adalah *{metrics['ccc']} hari*.
-_Ini adalah tempoh wang anda terikat dalam operasi sebelum menjadi tunai semula._
-
-*Analisis Komponen:*
-🤝 Hari Jualan Tertunggak (DSO): *{metrics['dso']} hari*
-   _Masa untuk mengutip wang daripada jualan kredit_
-
-📦 Hari Inventori Tertunggak (DIO): *{metrics['dio']} hari*
-   _Masa inventori duduk sebelum dijual_
-
-💸 Hari Hutang Tertunggak (DPO): *{metrics['dpo']} hari*
-   _Masa anda ambil untuk bayar pembekal_
-
-*Formula:* CCC = DSO + DIO - DPO = {metrics['dso']} + {metrics['dio']} - {metrics['dpo']} = *{metrics['ccc']} hari*
-
----
-{advice}"""
-        else:
-            report = f"""💡 *Your Business Financial Health Status* (last 90 days)
-
-Your Cash Conversion Cycle is *{metrics['ccc']} days*.
-_This is how long your money is tied up in operations before becoming cash again._
-
-*Component Analysis:*
-🤝 Days Sales Outstanding (DSO): *{metrics['dso']} days*
-   _Time to collect money from credit sales_
-
-📦 Days Inventory Outstanding (DIO): *{metrics['dio']} days*
-   _Time inventory sits before being sold_
-
-💸 Days Payable Outstanding (DPO): *{metrics['dpo']} days*
-   _Time you take to pay suppliers_
-
-*Formula:* CCC = DSO + DIO - DPO = {metrics['dso']} + {metrics['dio']} - {metrics['dpo']} = *{metrics['ccc']} days*
-
----
-{advice}"""
+        template = _BUSINESS_STATUS_TMPL.get(user_language, _BUSINESS_STATUS_TMPL['en'])
+        report = template.format_map(ChainMap({'advice': advice}, metrics))
 
         return report
 
@@ -3697,14 +4713,22 @@ def handle_summary_command(wa_id: str) -> str:
     try:
         logger.info(f"Generating summary for wa_id {wa_id}")
         
-        # Get user mode and language
-        user_mode = get_user_mode(wa_id)
-        user_language = get_user_language(wa_id)
+        # Get user mode, language and report version in one round-trip
+        user_mode, user_language, version = get_user_report_context(wa_id)
+
+        variant = (user_mode, user_language, version)
+        cached = _get_cached_report(_summary_cache, wa_id, variant)
+        if cached is not None:
+            return cached
         
         if user_mode == 'personal':
-            return handle_personal_summary_command(wa_id, user_language)
+            summary = handle_personal_summary_command(wa_id, user_language)
         else:
-            return handle_business_summary_command(wa_id, user_language)
+            summary = handle_business_summary_command(wa_id, user_language)
+
+        if version is not None:
+            _cache_report(_summary_cache, wa_id, variant, summary)
+        return summary
 
     except Exception as e:
         logger.error(f"Error generating summary for wa_id {wa_id}: {e}")
@@ -3717,8 +4741,8 @@ def handle_personal_summary_command(wa_id: str, user_language: str = 'en') -> st
         if collection is None:
             return "❌ Database connection not available. Please try again later."
 
-        # Query only this user's transactions
-        user_transactions = list(collection.find({'wa_id': wa_id}).sort('timestamp', -1).limit(10))
+        # Latest transactions and the true total in one round-trip
+        user_transactions, total_count = get_recent_transactions(wa_id)
 
         if not user_transactions:
             if user_language == 'ms':
@@ -3726,21 +4750,20 @@ def handle_personal_summary_command(wa_id: str, user_language: str = 'en') -> st
             else:
                 return "📭 You don't have any transactions recorded yet. Start by sending 'food rm15' or a receipt photo!"
 
-        # Format the personal budget summary
+        # Format the personal budget summary; parts are joined once at the end
         if user_language == 'ms':
-            summary_text = f"📊 *Ringkasan Belanja Peribadi*\n\n"
+            parts = ["📊 *Ringkasan Belanja Peribadi*\n\n"]
         else:
-            summary_text = f"📊 *Personal Budget Summary*\n\n"
+            parts = ["📊 *Personal Budget Summary*\n\n"]
         
         total_spent = 0
         total_income = 0
 
-        for i, transaction in enumerate(user_transactions[:5], 1):
+        for i, transaction in enumerate(user_transactions, 1):
             action = transaction.get('action', 'N/A')
             amount = transaction.get('amount', 0)
             items = safe_text(transaction.get('items', ''))
-            category = transaction.get('category', 'other')
-            date = transaction.get('timestamp', datetime.now()).strftime('%m/%d') if transaction.get('timestamp') else 'N/A'
+            date_str = transaction.get('timestamp', datetime.now()).strftime('%m/%d') if transaction.get('timestamp') else 'N/A'
 
             # Personal-friendly formatting
             if action in ['purchase', 'payment_made']:
@@ -3759,33 +4782,35 @@ def handle_personal_summary_command(wa_id: str, user_language: str = 'en') -> st
                 emoji = "💰"
 
             # Format the line for personal budget - Professional styling
-            line = f"{i}. {emoji} *{action_text}* - RM{amount:.2f}"
+            parts.append(f"{i}. {emoji} *{action_text}* - RM{amount:.2f}")
             if items and items != 'N/A':
-                line += f"\n   📦 {items}"
-            line += f" ({date})\n"
-
-            summary_text += line
+                parts.append(f"\n   📦 {items}")
+            parts.append(f" ({date_str})\n")
 
         # Personal budget totals
         net_amount = total_income - total_spent
         if user_language == 'ms':
-            summary_text += f"\n💸 *Jumlah Perbelanjaan*: RM{total_spent:.2f}"
-            summary_text += f"\n💰 *Jumlah Pendapatan*: RM{total_income:.2f}"
-            summary_text += f"\n📈 *Baki*: RM{net_amount:.2f}"
-            summary_text += f"\n� *Jumlah Transaksi*: {len(user_transactions)}"
+            parts.append(
+                f"\n💸 *Jumlah Perbelanjaan*: RM{total_spent:.2f}"
+                f"\n💰 *Jumlah Pendapatan*: RM{total_income:.2f}"
+                f"\n📈 *Baki*: RM{net_amount:.2f}"
+                f"\n📝 *Jumlah Transaksi*: {total_count}"
+            )
         else:
-            summary_text += f"\n💸 *Total Spent*: RM{total_spent:.2f}"
-            summary_text += f"\n💰 *Total Income*: RM{total_income:.2f}"
-            summary_text += f"\n📈 *Net Balance*: RM{net_amount:.2f}"
-            summary_text += f"\n📝 *Total Transactions*: {len(user_transactions)}"
+            parts.append(
+                f"\n💸 *Total Spent*: RM{total_spent:.2f}"
+                f"\n💰 *Total Income*: RM{total_income:.2f}"
+                f"\n📈 *Net Balance*: RM{net_amount:.2f}"
+                f"\n📝 *Total Transactions*: {total_count}"
+            )
 
-        if len(user_transactions) > 5:
+        if total_count > len(user_transactions):
             if user_language == 'ms':
-                summary_text += f"\n\n_Menunjukkan 5 terkini daripada {len(user_transactions)} transaksi_"
+                parts.append(f"\n\n_Menunjukkan 5 terkini daripada {total_count} transaksi_")
             else:
-                summary_text += f"\n\n_Showing latest 5 of {len(user_transactions)} transactions_"
+                parts.append(f"\n\n_Showing latest 5 of {total_count} transactions_")
 
-        return summary_text
+        return ''.join(parts)
 
     except Exception as e:
         logger.error(f"Error generating personal summary for wa_id {wa_id}: {e}")
@@ -3798,8 +4823,8 @@ def handle_business_summary_command(wa_id: str, user_language: str = 'en') -> st
         if collection is None:
             return "❌ Database connection not available. Please try again later."
 
-        # Query only this user's transactions
-        user_transactions = list(collection.find({'wa_id': wa_id}).sort('timestamp', -1).limit(10))
+        # Latest transactions and the true total in one round-trip
+        user_transactions, total_count = get_recent_transactions(wa_id)
 
         if not user_transactions:
             if user_language == 'ms':
@@ -3807,55 +4832,62 @@ def handle_business_summary_command(wa_id: str, user_language: str = 'en') -> st
             else:
                 return "📭 You don't have any business transactions recorded yet. Start by sending me a transaction or receipt photo!"
 
-        # Format the business summary
+        # Format the business summary; parts are joined once at the end
         if user_language == 'ms':
-            summary_text = f"📊 *Ringkasan Transaksi Perniagaan*\n\n"
+            parts = ["📊 *Ringkasan Transaksi Perniagaan*\n\n"]
         else:
-            summary_text = f"📊 *Business Transaction Summary*\n\n"
+            parts = ["📊 *Business Transaction Summary*\n\n"]
         
-        total_amount = 0
+        total_amount = sum(t['amount'] for t in user_transactions if isinstance(t.get('amount'), (int, float)))
 
-        for i, transaction in enumerate(user_transactions[:5], 1):
+        for i, transaction in enumerate(user_transactions, 1):
             action = transaction.get('action', 'N/A').capitalize()
             amount = transaction.get('amount', 0)
             vendor = safe_text(transaction.get('vendor') or transaction.get('customer', 'N/A'))
             items = safe_text(transaction.get('items', ''))
-            date = transaction.get('timestamp', datetime.now()).strftime('%m/%d') if transaction.get('timestamp') else 'N/A'
+            date_str = transaction.get('timestamp', datetime.now()).strftime('%m/%d') if transaction.get('timestamp') else 'N/A'
 
             # Format the line with business context
             if user_language == 'ms':
-                line = f"{i}. *{action}* - RM{amount} dengan {vendor}"
+                parts.append(f"{i}. *{action}* - RM{amount} dengan {vendor}")
             else:
-                line = f"{i}. *{action}* - RM{amount} with {vendor}"
+                parts.append(f"{i}. *{action}* - RM{amount} with {vendor}")
             
             if items and items != 'N/A':
-                line += f"\n   📦 {items}"
-            line += f" ({date})\n"
-
-            summary_text += line
-
-            if isinstance(amount, (int, float)):
-                total_amount += amount
+                parts.append(f"\n   📦 {items}")
+            parts.append(f" ({date_str})\n")
 
         if user_language == 'ms':
-            summary_text += f"\n💰 *Jumlah Nilai*: RM{total_amount}"
-            summary_text += f"\n📝 *Jumlah Transaksi*: {len(user_transactions)}"
+            parts.append(f"\n💰 *Jumlah Nilai*: RM{total_amount}\n📝 *Jumlah Transaksi*: {total_count}")
         else:
-            summary_text += f"\n💰 *Total Amount*: RM{total_amount}"
-            summary_text += f"\n📝 *Total Transactions*: {len(user_transactions)}"
+            parts.append(f"\n💰 *Total Amount*: RM{total_amount}\n📝 *Total Transactions*: {total_count}")
 
-        if len(user_transactions) > 5:
+        if total_count > len(user_transactions):
             if user_language == 'ms':
-                summary_text += f"\n\n_Menunjukkan 5 terkini daripada {len(user_transactions)} transaksi_"
+                parts.append(f"\n\n_Menunjukkan 5 terkini daripada {total_count} transaksi_")
             else:
-                summary_text += f"\n\n_Showing latest 5 of {len(user_transactions)} transactions_"
+                parts.append(f"\n\n_Showing latest 5 of {total_count} transactions_")
 
-        return summary_text
+        return ''.join(parts)
 
     except Exception as e:
         logger.error(f"Error generating business summary for wa_id {wa_id}: {e}")
         return "❌ Sorry, there was an error generating your business transaction summary."
 
+_STREAK_REPORT_TMPL = """🔥 *Your Daily Logging Streak*
+
+Current streak: *{streak} {day_word}*
+Last logged: {last_logged}
+
+{status}
+
+Keep logging every day to build up your streak! 📈"""
+
+_STREAK_NOT_STARTED = """🔥 *Your Daily Logging Streak*
+
+You haven't started logging yet!
+Send me your first transaction to begin your streak! 💪"""
+
 def handle_streak_command(wa_id: str) -> str:
     """Send user's current daily logging streak."""
     try:
@@ -3868,12 +4900,9 @@ def handle_streak_command(wa_id: str) -> str:
             last_log_date = streak_info.get('last_log_date', '')
 
             # Check if streak is current (logged today or yesterday)
-            today = datetime.now(timezone.utc).strftime("%Y-%m-%d")
             if last_log_date:
-                from datetime import datetime as dt
-                last_date = dt.strptime(last_log_date, "%Y-%m-%d")
-                today_date = dt.strptime(today, "%Y-%m-%d")
-                days_diff = (today_date - last_date).days
+                today_date = datetime.now(timezone.utc).date()
+                days_diff = (today_date - date.fromisoformat(last_log_date)).days
 
                 if days_diff <= 1:
                     status = "🔥 *Active streak!*"
@@ -3882,33 +4911,38 @@ def handle_streak_command(wa_id: str) -> str:
             else:
                 status = "📅 *No recent activity*"
 
-            day_word = "day" if streak == 1 else "days"
-            reply_text = f"""🔥 *Your Daily Logging Streak*
-
-Current streak: *{streak} {day_word}*
-Last logged: {last_log_date if last_log_date else 'Never'}
-
-{status}
-
-Keep logging every day to build up your streak! 📈"""
-            return reply_text
+            return _STREAK_REPORT_TMPL.format(
+                streak=streak,
+                day_word="day" if streak == 1 else "days",
+                last_logged=last_log_date if last_log_date else 'Never',
+                status=status,
+            )
         else:
-            return """🔥 *Your Daily Logging Streak*
-
-You haven't started logging yet!
-Send me your first transaction to begin your streak! 💪"""
+            return _STREAK_NOT_STARTED
 
     except Exception as e:
         logger.error(f"Error getting streak for wa_id {wa_id}: {e}")
         return "❌ Sorry, there was an error getting your streak information."
 
+# Text commands keyed by the stripped, lowercased message body.
+# Handlers are looked up at call time so they can be patched in tests.
+_COMMANDS = {
+    **dict.fromkeys(('status', '/status'), lambda wa_id, body: handle_status_command(wa_id)),
+    **dict.fromkeys(('summary', '/summary'), lambda wa_id, body: handle_summary_command(wa_id)),
+    **dict.fromkeys(('streak', '/streak'), lambda wa_id, body: handle_streak_command(wa_id)),
+    **dict.fromkeys(('test_db', '/test_db', 'testdb'), lambda wa_id, body: handle_test_db_command(wa_id)),
+    **dict.fromkeys(('start', '/start', 'help', '/help'), lambda wa_id, body: handle_start_command(wa_id, body)),
+}
+
 def process_image_parallel(image_data: bytes) -> dict:
     """Process image using parallel GPT Vision and fallback text extraction."""
-    
+    # Both requests embed the same data URL; encode the image once for both
+    image_base64 = base64.b64encode(image_data).decode('utf-8')
+
     def vision_processing():
         """Primary: GPT Vision direct parsing"""
         try:
-            return parse_receipt_with_vision(image_data)
+            return parse_receipt_with_vision(image_data, image_base64)
         except Exception as e:
             logger.error(f"GPT Vision processing failed: {e}")
             return {"error": "Vision processing failed"}
@@ -3916,7 +4950,7 @@ def process_image_parallel(image_data: bytes) -> dict:
     def text_extraction_fallback():
         """Fallback: Text extraction + AI parsing"""
         try:
-            extracted_text = extract_text_from_image(image_data)
+            extracted_text = extract_text_from_image(image_data, image_base64)
             if extracted_text:
                 return parse_receipt_with_ai(extracted_text)
             else:
@@ -3925,8 +4959,10 @@ def process_image_parallel(image_data: bytes) -> dict:
             logger.error(f"Text extraction fallback failed: {e}")
             return {"error": "Text extraction failed"}
     
-    # Run both processes in parallel
-    with concurrent.futures.ThreadPoolExecutor(max_workers=2) as executor:
+    # Run both processes in parallel. No context manager here: exiting one
+    # would wait for the fallback even after Vision has already answered.
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=2)
+    try:
         # Submit both processing methods
         future_vision = executor.submit(vision_processing)
         future_text = executor.submit(text_extraction_fallback)
@@ -3937,13 +4973,20 @@ def process_image_parallel(image_data: bytes) -> dict:
         # If vision succeeded, use it; otherwise use text extraction
         if "error" not in vision_result:
             logger.info("Using GPT Vision result")
-            # Cancel the text extraction if it's still running
-            future_text.cancel()
             return vision_result
         else:
             logger.info("GPT Vision failed, using text extraction fallback")
             text_result = future_text.result()
             return text_result
+    finally:
+        # Let a still-running text extraction finish in the background
+        executor.shutdown(wait=False, cancel_futures=True)
+
+# Questions for fields a receipt parse left empty
+_RECEIPT_QUESTIONS = {
+    'items': "📦 What items were in this receipt?",
+    'amount': "💰 What was the total amount?",
+}
 
 def handle_media_message(wa_id: str, media_id: str, media_type: str) -> str:
     """Handle media messages (images/receipts)."""
@@ -3953,82 +4996,129 @@ def handle_media_message(wa_id: str, media_id: str, media_type: str) -> str:
         # Send initial processing message
         processing_msg = "📸 Processing your receipt... Please wait."
 
-        # Download the media from WhatsApp
-        image_data = download_whatsapp_media(media_id)
+        # Download the media from WhatsApp in chunks
+        media_file = spool_whatsapp_media(media_id)
 
-        if not image_data:
+        if media_file is None:
             return "❌ Sorry, I couldn't download your image. Please try again."
 
-        # Process image using parallel GPT Vision and text extraction
-        parsed_data = process_image_parallel(image_data)
-
-        if "error" in parsed_data:
-            return "🤖 Sorry, I couldn't understand the receipt. Please type the transaction manually."
+        # Closed on every return path, including the clarification and error ones
+        with media_file:
+            # A media_id names one upload, so a redelivered image reuses its parse
+            # without another downscale, OCR and OpenAI pass
+            media_key = _ai_parse_key('media', media_id)
+            parsed_data = _lookup_ai_parse(media_key)
+
+            if parsed_data is None:
+                # GPT Vision needs the bytes for its base64 data URL (WhatsApp media URLs
+                # require our bearer token, so OpenAI can't fetch them itself)
+                # A 12 MP phone photo is several MB of base64 per request; the
+                # stored receipt below still uses the original file
+                image_data = downscale_image_bytes(media_file.read())
+                media_file.seek(0)
+
+                # Process image using parallel GPT Vision and text extraction
+                parsed_data = process_image_parallel(image_data)
+                _remember_ai_parse(media_key, parsed_data)
 
-        # Check for missing critical information in receipt
-        missing_fields = []
-        clarification_questions = []
-
-        # Check for missing items
-        if not parsed_data.get('items') or parsed_data.get('items') in [None, 'null', 'N/A', '']:
-            clarification_questions.append("📦 What items were in this receipt?")
-            missing_fields.append('items')
+            if "error" in parsed_data:
+                return "🤖 Sorry, I couldn't understand the receipt. Please type the transaction manually."
 
-        # Check for missing amount
-        if not parsed_data.get('amount') or parsed_data.get('amount') in [None, 'null', 0]:
-            clarification_questions.append("💰 What was the total amount?")
-            missing_fields.append('amount')
+            # Check for missing critical information in receipt
+            missing_fields = []
 
-        # If there are missing critical fields, ask for clarification
-        if clarification_questions:
-            # Store the partial transaction
-            store_pending_transaction(wa_id, parsed_data, missing_fields)
+            # Check for missing items
+            if not parsed_data.get('items') or parsed_data.get('items') in [None, 'null', 'N/A', '']:
+                missing_fields.append('items')
 
-            clarification_text = "🤔 I found a receipt but need some clarification:\n\n"
-            clarification_text += "\n".join(clarification_questions)
-            clarification_text += "\n\nPlease provide the missing information!"
+            # Check for missing amount
+            if not parsed_data.get('amount') or parsed_data.get('amount') in [None, 'null', 0]:
+                missing_fields.append('amount')
 
-            return clarification_text
+            # If there are missing critical fields, ask for clarification
+            if missing_fields:
+                clarification_questions = [_RECEIPT_QUESTIONS[f] for f in missing_fields]
 
-        # Save to database with image and user isolation using parallel processing
-        success = save_to_mongodb_parallel(parsed_data, wa_id, image_data)
+                # Store the partial transaction
+                store_pending_transaction(wa_id, parsed_data, missing_fields)
 
-        if success:
-            # Update user's daily logging streak
-            streak_info = update_user_streak(wa_id)
+                clarification_text = "🤔 I found a receipt but need some clarification:\n\n"
+                clarification_text += "\n".join(clarification_questions)
+                clarification_text += "\n\nPlease provide the missing information!"
 
-            action = (parsed_data.get('action') or 'transaction').capitalize()
-            amount = parsed_data.get('amount', 0)
-            customer = safe_text(parsed_data.get('customer') or parsed_data.get('vendor', 'N/A'))
-            items = safe_text(parsed_data.get('items', 'N/A'))
+                return clarification_text
 
-            reply_text = f"✅ *Receipt processed!* {action} of *{amount}* with *{customer}*"
-            if items and items != 'N/A':
-                reply_text += f"\n📦 Items: {items}"
-
-            # Add streak information if updated
-            if streak_info.get('updated', False) and not streak_info.get('error', False):
-                streak = streak_info.get('streak', 0)
-                if streak_info.get('is_new', False):
-                    reply_text += f"\n\n🎯 *New daily logging streak started!* Current streak: *{streak} days*"
-                elif streak_info.get('was_broken', False):
-                    reply_text += f"\n\n🔄 *Streak restarted!* Current streak: *{streak} days*"
-                else:
-                    reply_text += f"\n\n🔥 *Streak extended!* Current streak: *{streak} days*"
-            elif not streak_info.get('updated', False) and not streak_info.get('error', False):
-                # Already logged today
-                streak = streak_info.get('streak', 0)
-                day_word = "day" if streak == 1 else "days"
-                reply_text += f"\n\n🔥 You've already logged today! Current streak: *{streak} {day_word}*"
+            # Save to database with image and update the streak in parallel.
+            # Storage streams from the spooled file rather than the in-memory copy
+            success, streak_info = persist_transaction_and_streak(parsed_data, wa_id, media_file)
 
-            return reply_text
-        else:
-            return "❌ There was an error saving your receipt to the database."
+            if success:
+                return _format_success_reply("Receipt processed!", parsed_data, streak_info)
+            else:
+                return "❌ There was an error saving your receipt to the database."
 
     except Exception as e:
         logger.error(f"Error processing media: {e}")
         return "❌ Sorry, there was an error processing your receipt. Please try again."
 
+# Message handling (OCR, OpenAI, MongoDB) runs here so the webhook can
+# acknowledge WhatsApp immediately instead of risking a timeout and retry
+_message_executor = concurrent.futures.ThreadPoolExecutor(max_workers=8, thread_name_prefix="webhook-msg")
+
+# WhatsApp redelivers a webhook it thinks timed out, possibly to the other
+# gunicorn worker; message IDs are claimed in MongoDB (processed_message_collection,
+# keyed by ID with a TTL index) so a retry doesn't log the same transaction twice.
+# The in-process cache only stands in while MongoDB is unavailable.
+_seen_message_ids = TTLCache(maxsize=20000, ttl=WEBHOOK_DEDUPE_TTL)
+_seen_message_lock = threading.Lock()
+
+def _is_new_message(message_id: str | None) -> bool:
+    """Record message_id and report whether this is its first delivery."""
+    if not message_id:
+        return True
+    if processed_message_collection is not None:
+        try:
+            processed_message_collection.insert_one({'_id': message_id, 'received_at': datetime.now(timezone.utc)})
+            return True
+        except DuplicateKeyError:
+            return False
+        except Exception as e:
+            logger.warning(f"Could not record message {message_id} in MongoDB, deduplicating in memory: {e}")
+    with _seen_message_lock:
+        if message_id in _seen_message_ids:
+            return False
+        _seen_message_ids[message_id] = True
+        return True
+
+def _process_messages(wa_id: str, messages: list) -> None:
+    """Handle one sender's webhook messages in order and send each reply."""
+    sync_cache_generation()
+    maybe_sweep_pending_categories()
+    for message in messages:
+        try:
+            message_type = message.get('type')
+
+            if message_type == 'text':
+                # Handle text messages
+                message_body = message.get('text', {}).get('body', '')
+                response_text = handle_message(wa_id, message_body)
+
+            elif message_type == 'image':
+                # Handle image messages
+                media_id = message.get('image', {}).get('id')
+                media_type = message.get('image', {}).get('mime_type', 'image/jpeg')
+                response_text = handle_media_message(wa_id, media_id, media_type)
+
+            else:
+                response_text = "🤖 Sorry, I can only process text messages and images right now."
+
+            # Send response back to user
+            if response_text:
+                send_whatsapp_message(wa_id, response_text)
+
+        except Exception as e:
+            logger.error(f"Error processing message {message.get('id')} from {wa_id}: {e}")
+
 # --- WhatsApp Webhook Routes ---
 @app.route('/whatsapp/webhook', methods=['GET'])
 def whatsapp_webhook_verify():
@@ -4052,42 +5142,48 @@ def whatsapp_webhook_verify():
 def whatsapp_webhook():
     """Handle incoming WhatsApp messages."""
     try:
-        data = request.get_json()
-        logger.info(f"Received WhatsApp webhook: {data}")
-
+        # Parse the raw body directly; cache=False avoids keeping a second copy.
+        # A malformed body is acknowledged anyway, since WhatsApp would only retry it
+        try:
+            data = json_loads(request.get_data(cache=False))
+        except ValueError as e:
+            logger.warning(f"Ignoring WhatsApp webhook with invalid JSON: {e}")
+            return jsonify({'status': 'ok'})
         if not data or 'entry' not in data:
             return jsonify({'status': 'ok'})
 
-        for entry in data['entry']:
-            for change in entry.get('changes', []):
-                if change.get('field') == 'messages':
-                    messages = change.get('value', {}).get('messages', [])
-
-                    for message in messages:
-                        message_type = message.get('type')
-                        wa_id = message.get('from')  # Sender's WhatsApp ID
-                        message_id = message.get('id')
+        message_batches = [
+            change['value']['messages']
+            for entry in data['entry']
+            for change in entry.get('changes', [])
+            if change.get('field') == 'messages' and change.get('value', {}).get('messages')
+        ]
 
-                        # Mark message as read
-                        mark_message_as_read(message_id)
+        # Most callbacks are delivery/read statuses with no messages; acknowledge
+        # them without formatting the whole payload into the INFO log
+        if not message_batches:
+            logger.debug("Received WhatsApp status webhook: %s", data)
+            return jsonify({'status': 'ok'})
 
-                        if message_type == 'text':
-                            # Handle text messages
-                            message_body = message.get('text', {}).get('body', '')
-                            response_text = handle_message(wa_id, message_body)
+        logger.info(f"Received WhatsApp webhook: {data}")
 
-                        elif message_type == 'image':
-                            # Handle image messages
-                            media_id = message.get('image', {}).get('id')
-                            media_type = message.get('image', {}).get('mime_type', 'image/jpeg')
-                            response_text = handle_media_message(wa_id, media_id, media_type)
+        by_sender = {}
+        for messages in message_batches:
+            for message in messages:
+                message_id = message.get('id')
+                if not _is_new_message(message_id):
+                    logger.info(f"Skipping redelivered message {message_id}")
+                    continue
 
-                        else:
-                            response_text = "🤖 Sorry, I can only process text messages and images right now."
+                by_sender.setdefault(message.get('from'), []).append(message)
 
-                        # Send response back to user
-                        if response_text:
-                            send_whatsapp_message(wa_id, response_text)
+        # One task per sender keeps each user's messages in order while
+        # different users are handled in parallel
+        for wa_id, sender_messages in by_sender.items():
+            # Marking a message read also marks the earlier ones in the chat,
+            # so one fire-and-forget call per sender covers the whole batch
+            _graph_executor.submit(mark_message_as_read, sender_messages[-1].get('id'))
+            _message_executor.submit(_process_messages, wa_id, sender_messages)
 
         return jsonify({'status': 'ok'})
 
@@ -4133,6 +5229,81 @@ Bot is ready to receive WhatsApp messages! 💪
         logger.error(f"Health check error: {e}")
         return f"❌ Health check failed: {str(e)}", 500
 
+# --- Cache Generation ---
+# The admin endpoint below only runs in the worker that received the request.
+# It bumps a counter in MongoDB (app_state_collection); every worker compares
+# it with the generation it last saw, at most every few seconds, and clears
+# its own caches when it has moved on.
+CACHE_GENERATION_ID = 'cache_generation'
+CACHE_GENERATION_CHECK_INTERVAL = 5  # seconds
+_cache_generation = None
+_cache_generation_checked = 0.0
+_cache_generation_lock = threading.Lock()
+
+def _clear_local_caches() -> None:
+    """Drop this process's language detection and AI caches."""
+    _detect_language_cached.cache_clear()
+    with _ai_parse_lock:
+        _ai_parse_cache.clear()
+    with _general_response_lock:
+        _general_response_cache.clear()
+
+def sync_cache_generation() -> None:
+    """Clear this process's caches if another worker has cleared its own since the last check."""
+    global _cache_generation, _cache_generation_checked
+
+    now = time.monotonic()
+    with _cache_generation_lock:
+        if app_state_collection is None or now - _cache_generation_checked < CACHE_GENERATION_CHECK_INTERVAL:
+            return
+        _cache_generation_checked = now
+    try:
+        state = app_state_collection.find_one({'_id': CACHE_GENERATION_ID}) or {}
+    except Exception as e:
+        logger.warning(f"Could not read cache generation: {e}")
+        return
+
+    generation = state.get('value', 0)
+    with _cache_generation_lock:
+        # A fresh worker has nothing stale to drop, it just adopts the generation
+        changed = _cache_generation is not None and generation != _cache_generation
+        _cache_generation = generation
+    if changed:
+        _clear_local_caches()
+        logger.info(f"Caches cleared for generation {generation}")
+
+@app.route('/admin/cache/clear', methods=['POST'])
+def admin_clear_caches():
+    """Drop the language detection and AI caches in every worker. Requires the ADMIN_TOKEN header.
+
+    This worker clears at once; the others do so before handling their next
+    message, within CACHE_GENERATION_CHECK_INTERVAL. If MongoDB is unreachable
+    only this worker is cleared and generation is null in the reply.
+    """
+    global _cache_generation
+
+    admin_token = os.getenv('ADMIN_TOKEN')
+    supplied = request.headers.get('X-Admin-Token', '')
+    if not admin_token or not hmac.compare_digest(supplied, admin_token):
+        return jsonify({'status': 'error', 'message': 'Forbidden'}), 403
+
+    generation = None
+    if app_state_collection is not None:
+        try:
+            state = app_state_collection.find_one_and_update(
+                {'_id': CACHE_GENERATION_ID}, {'$inc': {'value': 1}},
+                upsert=True, return_document=ReturnDocument.AFTER
+            )
+            generation = state['value']
+            with _cache_generation_lock:
+                _cache_generation = generation
+        except Exception as e:
+            logger.warning(f"Could not bump cache generation, clearing this worker only: {e}")
+
+    _clear_local_caches()
+    logger.info(f"Language detection and AI caches cleared via admin endpoint (pid {os.getpid()}, generation {generation})")
+    return jsonify({'status': 'ok', 'generation': generation, 'pid': os.getpid()})
+
 def main():
     """Start the WhatsApp Business API bot."""
     logger.info("🚀 MAIN FUNCTION STARTED - Initializing WhatsApp Business API Bot...")
@@ -4161,11 +5332,12 @@ def main():
     logger.info("🌐 Webhook endpoint: /whatsapp/webhook")
     logger.info("💻 Health check available at: /health")
 
-    # Start Flask app
+    # Start Flask app. Production runs under gunicorn with gevent workers
+    # (see deploy/aliran-whatsapp.service); this is the standalone fallback.
     port = int(os.getenv("WHATSAPP_PORT", "5002"))
     logger.info(f"🌐 Server starting on port {port}")
 
-    app.run(host='0.0.0.0', port=port, debug=False)
+    app.run(host='0.0.0.0', port=port, debug=False, threaded=True)
 
 if __name__ == '__main__':
     main()